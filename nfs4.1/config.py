@@ -17,6 +17,9 @@ class ConfigAction(Exception):
 def _action(value):
     raise ConfigAction
 
+def _readonly(value):
+    raise ValueError("Read only")
+
 def _int(value):
     return int(value)
 
@@ -37,7 +40,7 @@ def _statcode(value):
     try:
         return int(value)
     except ValueError:
-        rv = getattr(xdr.nfs4_const, value, None)
+        rv = getattr(xdrdef.nfs4_const, value, None)
         if rv is None or nfsstat4.get(rv, None) != value:
             raise
         else:
@@ -47,6 +50,7 @@ def _opline(value):
     """ Accept lines of form: message-type [value] [value]
 
     message-type of error has this form: "ERROR NFS4ERR_code ceiling"
+    message-type of delay has this form: "DELAY milliseconds"
     new message types and more values can be added
     """
     print '**************** OPLINE typevalue ', type(value)
@@ -63,14 +67,21 @@ def _opline(value):
             raise ValueError("ERROR messages only accepts 3 entries")
         print 'OPLINE len ', len(l)
         value = [l[0], _statcode(l[1]), int(l[2])]
+    elif l[0] == "DELAY":
+        if not len(l) == 2:
+            raise ValueError("DELAY messages only accepts 2 entries")
+        value = [l[0], int(l[1])]
+        if value[1] < 0:
+            raise ValueError("DELAY must not be negative")
     else:
-        raise ValueError("Only message-type ERROR accepted")
+        raise ValueError("Only message-types ERROR and DELAY accepted")
     print '**************** OPLINE return ', value
     return value
 
 ###################################################
 
 class ConfigLine(object):
+    live = False # value changes without being set
     def _set_value(self, value):
         try:
             self._value = self.verify(value)
@@ -78,6 +89,8 @@ class ConfigLine(object):
             e.name = self.name
             e.value = value
             raise
+        if self.notify is not None:
+            self.notify(self)
     value = property(lambda s: s._value, _set_value)
     def __init__(self, name, value, comment, verifier=None):
         if verifier is None:
@@ -90,6 +103,16 @@ class ConfigLine(object):
         self._value = value
         self.comment = comment
         self.verify = verifier # value = self.verify(value)
+        self.notify = None # If set, called with self after value changes
+
+class StatLine(ConfigLine):
+    """A read-only line, whose value is recomputed by source() each read"""
+    live = True
+    def __init__(self, name, comment):
+        ConfigLine.__init__(self, name, "", comment, _readonly)
+        self.source = None # Set by the owner of the stats
+    value = property(lambda s: s._value if s.source is None else s.source(),
+                     ConfigLine._set_value)
 
 class MetaConfig(type):
     def __init__(cls, name, bases, dict):
@@ -127,12 +150,18 @@ class ServerConfig(object):
                          "Server lease time in seconds"),
               ConfigLine("catch_ctrlc", True,
                          "Ctrl-c sends server into interactive debugging shell"),
+              ConfigLine("reply_cache_size", 16 * 1024 * 1024,
+                         "Max bytes of replies cached by all session slots"),
+              ConfigLine("record_size", 4 * 1024 * 1024,
+                         "Max bytes of traffic kept in memory per record stamp"),
+              ConfigLine("name_cache_size", 16384,
+                         "Max LOOKUP results remembered by the server"),
+              ConfigLine("page_cache_size", 64 * 1024 * 1024,
+                         "Max bytes of file data cached for disk-backed filesystems"),
               ]
 
     def __init__(self):
-        self.minor_id = os.getpid()
-        self.major_id = "PyNFSv4.1"
-        self._owner = server_owner4(self.minor_id, self.major_id)
+        self.set_owner(os.getpid(), "PyNFSv4.1")
         self.scope = "Default_Scope"
         self.impl_domain = "citi.umich.edu"
         self.impl_name = "pynfs X.X"
@@ -140,6 +169,11 @@ class ServerConfig(object):
         self.impl_id = nfs_impl_id4(self.impl_domain, self.impl_name,
                                  nfs4lib.get_nfstime(self.impl_date))
 
+    def set_owner(self, minor_id, major_id):
+        self.minor_id = minor_id
+        self.major_id = major_id
+        self._owner = server_owner4(self.minor_id, self.major_id)
+
 class ServerPerClientConfig(object):
     __metaclass__ = MetaConfig
     attrs = [ConfigLine("maxrequestsize", 16384,
@@ -181,9 +215,41 @@ class OpsConfigServer(object):
     attrs = [ConfigLine(name.lower()[3:], value, "Generic comment", _opline)
              for name in nfs_opnum4.values()]
 
+    def __init__(self, on_change=None):
+        # Compiled from attrs, holding only ops that have something set,
+        # so that the server can skip all checks when these are empty.
+        self.errors = {} # {opname: (code, ceiling)}
+        self.delays = {} # {opname: delay in seconds}
+        self.on_change = on_change # Called with opname after any change
+        for line in self.attrs:
+            line.notify = self._compile
+
+    def _compile(self, line):
+        value = line.value
+        self.errors.pop(line.name, None)
+        self.delays.pop(line.name, None)
+        if value[0] == "ERROR" and value[1] != NFS4_OK:
+            self.errors[line.name] = tuple(value[1:])
+        elif value[0] == "DELAY" and value[1] > 0:
+            self.delays[line.name] = value[1] / 1000.0
+        if self.on_change is not None:
+            self.on_change(line.name)
+
+class ServerStats(object):
+    __metaclass__ = MetaConfig
+    attrs = [StatLine("page_cache",
+                      "Page cache use, for disk-backed filesystems"),
+             StatLine("file_access",
+                      "Access patterns of the most read cached files"),
+             ]
+
 class Actions(object):
     __metaclass__ = MetaConfig
     attrs = [ConfigLine("reboot", 0,
                         "Any write here will simulate a server reboot",
                         _action),
+             ConfigLine("checkpoint", 0,
+                        "Any write here will checkpoint the metadata "
+                        "of disk filesystems",
+                        _action),
              ]
@@ -1,6 +1,7 @@
 from nfs4state import FileState
 from xdrdef.nfs4_const import *
-from xdrdef.nfs4_type import fsid4, layout4, layout_content4, nfsv4_1_file_layout4
+from xdrdef.nfs4_type import fsid4, layout4, layout_content4, nfsv4_1_file_layout4, \
+     specdata4, nfstime4
 import nfs4lib
 from nfs4lib import NFS4Error
 import struct
@@ -8,6 +9,9 @@ import logging
 from locking import Lock, RWLock
 from cStringIO import StringIO
 import time
+import bisect
+import itertools
+import os
 from xdrdef.nfs4_pack import NFS4Packer
 
 log_o = logging.getLogger("fs.obj")
@@ -33,6 +37,308 @@ class MetaData(object):
             self.linkdata = None
             self.devdata = None
 
+def fold_case(name):
+    """Returns the case-folded form of the utf8 name"""
+    try:
+        return name.decode("utf8").lower().encode("utf8")
+    except UnicodeError:
+        return name.lower()
+
+class DirIndex(dict):
+    """The {name: id} entries of a directory, in order of creation.
+
+    Each name is given a READDIR cookie when added, which stays valid
+    until the name is removed, so a directory can be paged through
+    without taking a snapshot of it.  Only use [] and del to modify.
+
+    A second map from case-folded names is kept alongside, so that
+    case-insensitive lookups are as cheap as exact ones.
+
+    generation changes whenever a name is added or removed.
+    """
+    first_cookie = 3 # Cookies 0, 1, and 2 are reserved
+
+    def __init__(self, entries=None):
+        dict.__init__(self)
+        self.verifier = struct.pack(">d", time.time())
+        self._next = self.first_cookie
+        self._cookies = [] # Sorted list of cookies
+        self._names = [] # Corresponding names, or None if removed
+        self._where = {} # {name: cookie}
+        self._removed = 0
+        self._folded = {} # {fold_case(name): [name, ...]}
+        self.generation = 0
+        if entries:
+            for name in sorted(entries):
+                self[name] = entries[name]
+
+    def __setitem__(self, name, id):
+        if name not in self:
+            self._where[name] = self._next
+            self._cookies.append(self._next)
+            self._names.append(name)
+            self._next += 1
+            self._folded.setdefault(fold_case(name), []).append(name)
+        self.generation += 1
+        dict.__setitem__(self, name, id)
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self.generation += 1
+        key = fold_case(name)
+        names = self._folded[key]
+        names.remove(name)
+        if not names:
+            del self._folded[key]
+        i = bisect.bisect_left(self._cookies, self._where.pop(name))
+        self._names[i] = None
+        self._removed += 1
+        if self._removed > len(self._cookies) // 2:
+            self._compact()
+
+    def pop(self, name, *default):
+        if name in self:
+            id = self[name]
+            del self[name]
+            return id
+        return dict.pop(self, name, *default)
+
+    def __reduce__(self):
+        # Pickle sets a dict's items before its state, but __setitem__
+        # needs the cookie tables, so the items travel with the state
+        return (DirIndex, (), (self.__dict__, dict(self)))
+
+    def __setstate__(self, state):
+        items = None
+        if isinstance(state, tuple):
+            state, items = state
+        self.__dict__.update(state)
+        if items:
+            dict.update(self, items)
+        self.__dict__.setdefault("generation", 0)
+        if "_folded" not in state:
+            # Written by an older version
+            self._folded = {}
+            for name in self:
+                self._folded.setdefault(fold_case(name), []).append(name)
+
+    def find(self, name, ignore_case=False):
+        """Returns the name as stored in the dir, or None if not there.
+
+        If ignore_case is set, a stored name differing only in case
+        will match, preferring an exact match.
+        """
+        if name in self:
+            return name
+        if ignore_case:
+            names = self._folded.get(fold_case(name))
+            if names:
+                return names[0]
+        return None
+
+    def _compact(self):
+        pairs = [(c, n) for c, n in zip(self._cookies, self._names)
+                 if n is not None]
+        # Build new lists, so that running iter_from() calls are unaffected
+        self._cookies = [c for c, n in pairs]
+        self._names = [n for c, n in pairs]
+        self._removed = 0
+
+    def valid_cookie(self, cookie):
+        """True if cookie is 0 or could have been given out by us"""
+        return cookie == 0 or self.first_cookie <= cookie < self._next
+
+    def iter_from(self, cookie):
+        """Generate (cookie, name, id) for entries after cookie"""
+        cookies, names = self._cookies, self._names
+        i = bisect.bisect_right(cookies, cookie)
+        while i < len(cookies):
+            name = names[i]
+            if name is not None:
+                id = self.get(name)
+                if id is not None:
+                    yield cookies[i], name, id
+            i += 1
+
+class SparseFile(object):
+    """An in-memory file that only stores the ranges written to.
+
+    The data is a sorted list of non-overlapping extents, each either a
+    string or, for a range that was ALLOCATEd but never written, just its
+    length.  Gaps between extents are holes.  Extending the file or
+    punching a hole only changes the list, and reading a hole returns
+    zeroes made up for that read alone.  Writes within the file run
+    alongside reads, so the public methods hold _lock.
+    """
+    sparse = True # truncate() can extend the file, leaving a hole
+
+    def __init__(self):
+        self._size = 0
+        self._starts = [] # Offset of each extent, sorted
+        self._extents = [] # str, or int size of allocated zeroes
+        self._lock = Lock("SparseFile")
+
+    def size(self):
+        return self._size
+
+    def pread(self, offset, count):
+        with self._lock:
+            return self._read(offset, min(self._size, offset + count))
+
+    def _read(self, start, end):
+        if end <= start:
+            return ""
+        starts, extents = self._starts, self._extents
+        i = max(bisect.bisect_right(starts, start) - 1, 0)
+        pieces = []
+        at = start
+        while i < len(starts) and starts[i] < end:
+            base, extent = starts[i], extents[i]
+            i += 1
+            hi = min(end, base + _extent_len(extent))
+            if hi <= at:
+                continue
+            if base > at:
+                pieces.append(chr(0) * (base - at))
+                at = base
+            if type(extent) is int:
+                pieces.append(chr(0) * (hi - at))
+            elif at == base and hi - base == len(extent):
+                pieces.append(extent)
+            else:
+                pieces.append(extent[at - base:hi - base])
+            at = hi
+        if at < end:
+            pieces.append(chr(0) * (end - at))
+        if len(pieces) == 1:
+            return pieces[0]
+        return "".join(pieces)
+
+    def pwrite(self, offset, data):
+        end = offset + len(data)
+        if not data:
+            return
+        with self._lock:
+            i = self._cut(offset, end)
+            self._starts.insert(i, offset)
+            self._extents.insert(i, data)
+            self._size = max(self._size, end)
+
+    def truncate(self, size):
+        with self._lock:
+            if size < self._size:
+                self._cut(size, self._size)
+            self._size = size
+
+    def _cut(self, start, end):
+        """Remove [start, end) from the extents, returning where it was"""
+        starts, extents = self._starts, self._extents
+        i = bisect.bisect_right(starts, start) - 1
+        if i >= 0 and starts[i] + _extent_len(extents[i]) > start:
+            base, extent = starts[i], extents[i]
+            if base < start:
+                size = _extent_len(extent)
+                extents[i] = _extent_slice(extent, 0, start - base)
+                i += 1
+                if base + size > end:
+                    # The range is inside this one extent
+                    starts.insert(i, end)
+                    extents.insert(i, _extent_slice(extent, end - base, size))
+                    return i
+        else:
+            i += 1
+        j = i
+        while j < len(starts) and starts[j] < end:
+            j += 1
+        if j > i:
+            base, extent = starts[j - 1], extents[j - 1]
+            size = _extent_len(extent)
+            del starts[i:j], extents[i:j]
+            if base + size > end:
+                starts.insert(i, end)
+                extents.insert(i, _extent_slice(extent, end - base, size))
+        return i
+
+    def punch(self, offset, length):
+        """Turn the range into a hole, without changing the size"""
+        with self._lock:
+            self._cut(offset, offset + length)
+
+    def allocate(self, offset, length):
+        """Back the holes in the range, extending the file if needed"""
+        with self._lock:
+            self._allocate(offset, offset + length)
+
+    def _allocate(self, offset, end):
+        starts, extents = self._starts, self._extents
+        at = offset
+        i = bisect.bisect_right(starts, offset) - 1
+        if i >= 0 and starts[i] + _extent_len(extents[i]) > at:
+            at = starts[i] + _extent_len(extents[i])
+        i += 1
+        while at < end:
+            next = starts[i] if i < len(starts) else end
+            if next > at:
+                hi = min(next, end)
+                starts.insert(i, at)
+                extents.insert(i, hi - at)
+                i += 1
+            if i < len(starts):
+                at = starts[i] + _extent_len(extents[i])
+                i += 1
+            else:
+                break
+        self._size = max(self._size, end)
+
+    def seek_data(self, offset):
+        """Returns the first offset >= offset not in a hole, or None"""
+        with self._lock:
+            starts, extents = self._starts, self._extents
+            i = bisect.bisect_right(starts, offset) - 1
+            if i >= 0 and starts[i] + _extent_len(extents[i]) > offset:
+                return offset
+            if i + 1 < len(starts):
+                return starts[i + 1]
+            return None
+
+    def seek_hole(self, offset):
+        """Returns the first offset >= offset in a hole, or at EOF"""
+        with self._lock:
+            starts, extents = self._starts, self._extents
+            i = bisect.bisect_right(starts, offset) - 1
+            while 0 <= i < len(starts) and starts[i] <= offset:
+                end = starts[i] + _extent_len(extents[i])
+                if end <= offset:
+                    break
+                offset = end
+                i += 1
+            return min(offset, self._size)
+
+    def close(self):
+        pass
+
+def _extent_len(extent):
+    if type(extent) is int:
+        return extent
+    return len(extent)
+
+def _extent_slice(extent, lo, hi):
+    if type(extent) is int:
+        return hi - lo
+    return extent[lo:hi]
+
+_ZERO_CHUNK = 1 << 20
+
+def _write_zeroes(file, offset, length):
+    """file.pwrite() zeroes over the range, a chunk at a time, so a
+    large range does not need a buffer as big as itself"""
+    zeroes = chr(0) * min(length, _ZERO_CHUNK)
+    end = offset + length
+    while offset < end:
+        count = min(end - offset, _ZERO_CHUNK)
+        file.pwrite(offset, zeroes if count == len(zeroes) else zeroes[:count])
+        offset += count
+
 class FSObject(object):
     """This is the in-memory depiction of an (nfs4) file-system object.
 
@@ -40,6 +346,7 @@ class FSObject(object):
     This will keep read/writes current, but will not work with
     attrs and non NF4REG files.
     """
+    cache_names = True # lookup() results depend only on the dir entries
 
     # NOTE that any change to these attrs needs to be eventually
     #      written to disk
@@ -52,28 +359,25 @@ class FSObject(object):
         return struct.pack("!QQbQ", major, minor, 0, self.id)
 
     def _getsize(self):
-        with self.seek_lock:
-            return self._getsize_locked()
+        # file.size() is safe without size_lock, which would only order
+        # this against a resize in progress.
+        return self._getsize_locked()
 
     def _getsize_locked(self):
         # STUB
         if self.fattr4_type == NF4REG:
-            if hasattr(self.file, "__len__"):
-                return len(self.file)
-            else:
-                orig = self.file.tell()
-                self.file.seek(0, 2)
-                eof = self.file.tell()
-                self.file.seek(orig)
-                return eof
+            return self.file.size()
         elif self.fattr4_type == NF4DIR:
             return len(self.entries)
         else:
             return 0
 
     def _setsize(self, value):
-        with self.seek_lock:
+        self.size_lock.acquire_write()
+        try:
             return self._setsize_locked(value)
+        finally:
+            self.size_lock.release()
 
     def _setsize_locked(self, value):
         # STUB - How should this behave on non REG files? especially a DIR?
@@ -83,10 +387,12 @@ class FSObject(object):
                 return
             elif value < size:
                 self.file.truncate(value)
+            elif getattr(self.file, "sparse", False):
+                # Extend with a hole
+                self.file.truncate(value)
             else:
                 # Pad with zeroes
-                self.file.seek(0, 2)
-                self.file.write(chr(0) * (value - size))
+                _write_zeroes(self.file, size, value - size)
             self.change_data()
         else:
             raise NFS4Error(NFS4ERR_INVAL)
@@ -134,7 +440,7 @@ class FSObject(object):
     fattr4_mode = property(lambda s: s.mode, _setmode)
     isdir = property(lambda s: s.type == NF4DIR)
     isfile = property(lambda s: s.type == NF4REG)
-    isempty = property(lambda s: s.entries == {})
+    isempty = property(lambda s: len(s.entries) == 0)
 
     def __init__(self, fs, id, kind=NF4DIR, parent=None):
         log_o.log(5, "FSObject.__init__(id=%r)" % id)
@@ -165,13 +471,13 @@ class FSObject(object):
             if 1: # NF4DIR
                 # Can't store FSObj, since needs to be pickled
                 self.parent = getattr(parent, "id", None)
-                self.entries = {} # {name:id}
-        if 1: # NF4DIR
-            self.dircache = {}
+                self.entries = DirIndex() # {name:id}
         self.state = FileState(self)
         self._set_fattrs()
         self.lock = RWLock(name=str(id))
-        self.seek_lock = Lock("SeekLock")
+        # Held shared for I/O within the file, which the file's pread()
+        # and pwrite() allow to overlap, and exclusive to change its size.
+        self.size_lock = RWLock(name="size_%s" % id)
         self.current_layout = None
         self.covered_by = None # If this is a mountpoint for fs, equals fs.root 
         # XXX Need to write to disk here?
@@ -179,7 +485,7 @@ class FSObject(object):
 
     def init_file(self):
         """Hook for subclasses that want to use their own file class"""
-        return StringIO()
+        return SparseFile()
 
     def _init_hook(self):
         pass
@@ -246,42 +552,119 @@ class FSObject(object):
         if self._last_sync == self.change:
             log_o.log(5, "sync skipped")
             return FILE_SYNC4
-        if how == UNSTABLE4: # XXX This could be incorporated into fs.sync()
+        if how == UNSTABLE4:
+            self.fs.write_behind(self)
             return UNSTABLE4
         rv = self.fs.sync(self, how)
         if rv == FILE_SYNC4:
             self._last_sync = self.change
         return rv
 
+    def commit(self, offset=0, count=0): # NF4REG only
+        """Make data written to the range stable, count 0 meaning to EOF"""
+        is_clean = getattr(self.file, "is_clean", None)
+        if is_clean is not None and is_clean(offset, count):
+            return
+        self.sync(FILE_SYNC4)
+
     def write(self, data, offset, principal): # NF4REG only
         """Return count of bytes written"""
         if not self.access4_modify(principal):
             raise NFS4Error(NFS4ERR_ACCESS)
         if len(data) == 0:
             return 0
-        with self.seek_lock:
-            self.file.seek(offset)
+        lock = self.size_lock
+        lock.acquire()
+        try:
+            if offset + len(data) > self._getsize_locked():
+                # Extending the file, which other I/O must not see half done
+                lock.upgrade()
             try:
-                self.file.write(data)
+                self.file.pwrite(offset, data)
             finally:
                 self.change_data()
+        finally:
+            lock.release()
         return len(data)
 
     def read(self, offset, count, principal): # NF4REG only
         if not self.access4_read(principal):
             raise NFS4Error(NFS4ERR_ACCESS)
-        with self.seek_lock:
-            self.file.seek(offset)
-            data = self.file.read(count)
+        with self.size_lock:
+            data = self.file.pread(offset, count)
         self.change_access()
         return data
 
+    # Files without sparse support are treated as all data, no holes
+
+    def seek(self, offset, what, principal): # NF4REG only
+        """Return (eof, offset) of the first data (or hole, as what says)
+        at or after offset.
+        """
+        if not self.access4_read(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        with self.size_lock:
+            size = self._getsize_locked()
+            if offset >= size:
+                raise NFS4Error(NFS4ERR_NXIO)
+            if what == NFS4_CONTENT_DATA:
+                find = getattr(self.file, "seek_data", None)
+                found = (offset if find is None else find(offset))
+            elif what == NFS4_CONTENT_HOLE:
+                find = getattr(self.file, "seek_hole", None)
+                found = (size if find is None else find(offset))
+            else:
+                raise NFS4Error(NFS4ERR_UNION_NOTSUPP)
+        if found is None or found >= size:
+            return True, size
+        return False, found
+
+    def allocate(self, offset, length, principal): # NF4REG only
+        """Reserve space for the range, extending the file if needed"""
+        if not self.access4_modify(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        self.size_lock.acquire_write()
+        try:
+            allocate = getattr(self.file, "allocate", None)
+            if allocate is not None:
+                _oscall(allocate, offset, length)
+                self.change_data()
+            elif offset + length > self._getsize_locked():
+                self._setsize_locked(offset + length)
+        finally:
+            self.size_lock.release()
+
+    def deallocate(self, offset, length, principal): # NF4REG only
+        """Punch a hole over the range, leaving the size alone"""
+        if not self.access4_modify(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        self.size_lock.acquire_write()
+        try:
+            end = min(offset + length, self._getsize_locked())
+            if end <= offset:
+                return
+            punch = getattr(self.file, "punch", None)
+            if punch is not None:
+                _oscall(punch, offset, end - offset)
+            else:
+                _write_zeroes(self.file, offset, end - offset)
+            self.change_data()
+        finally:
+            self.size_lock.release()
+
     def destroy(self):
         """Remove from disk"""
         log_o.info("***DESTROY*** id=%i" % self.id)
         # STUB
         pass
 
+    def evict(self):
+        """Called when the fs drops the obj from its cache, after a sync.
+
+        The obj may still be in use, and be found again.
+        """
+        pass
+
 ##     def set_fattr4_size(self, newsize):
 ##         # FRED - How should this behave on non REG files? especially a DIR?
 ##         if self.fattr4_type == NF4REG and newsize != self.fattr4_size:
@@ -427,8 +810,14 @@ class FSObject(object):
         log_o.log(5, "FSObject.exists(%r)" % name)
         if self.type != NF4DIR: # XXX STUB, also need to handle attrdir
             raise RuntimeError("Bad type %i" % self.type)
-        id = self.entries.get(name, None)
-        return id is not None
+        return self.entry_name(name) is not None
+
+    def entry_name(self, name):
+        """Returns name as spelled in the dir, or None if not there
+
+        This only differs from name on a case-insensitive fs.
+        """
+        return self.entries.find(name, self.fs.fattr4_case_insensitive)
 
     def lookup(self, name, client, principal, follow_mount=True):
         """Returns object associated with name in the dir, following mounts."""
@@ -440,7 +829,12 @@ class FSObject(object):
             raise NFS4Error(NFS4ERR_ACCESS)
         id = self.entries.get(name)
         if id is None:
-            return None
+            if not self.fs.fattr4_case_insensitive:
+                return None
+            name = self.entries.find(name, True)
+            if name is None:
+                return None
+            id = self.entries[name]
         obj = self.fs.find(id)
         if follow_mount:
             while obj.covered_by is not None:
@@ -467,11 +861,11 @@ class FSObject(object):
     def link(self, name, obj, principal):
         """Adds obj to the dir as name"""
         log_o.log(5, "FSObject.link(%r), fsid=%r" % (name, self.fs.fsid))
-        if name in self.entries:
+        if self.entry_name(name) is not None:
             raise RuntimeError
         if not self.access4_extend(principal):
             raise NFS4Error(NFS4ERR_ACCESS)
-        self.entries[name] = obj.id
+        self._add_entry(name, obj.id)
         self.change_data()
         if obj.isdir:
             obj.parent = self.id
@@ -493,29 +887,49 @@ class FSObject(object):
             obj.sync()
         finally:
             obj.lock.release()
-        del self.entries[name]
+        self._remove_entry(self.entry_name(name))
+        self.change_data()
 
-    def readdir(self, verifier, client, principal):
-        """Returns list of (name, obj) pairs"""
-        # STUB - this API will certainly change
-        # need to think how to deal with cookies
+    def respell(self, name, newname, principal):
+        """Change the case of name in the dir to that of newname"""
+        log_o.log(5, "FSObject(id=%i).respell(%r, %r)" % (self.id, name, newname))
+        if not self.access4_extend(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        id = self._remove_entry(name)
+        self._add_entry(newname, id)
+        self.change_data()
+
+    def _add_entry(self, name, id):
+        self.entries[name] = id
+
+    def _remove_entry(self, name):
+        return self.entries.pop(name)
+
+    def move(self, newname, olddir, oldname, obj, principal):
+        """Move obj, called oldname in olddir, into the dir as newname"""
+        # We need to link obj in new spot, then unlink in old
+        # We don't do it in the other order to prevent refcnt going to zero
+        self.link(newname, obj, principal)
+        olddir.unlink(oldname, principal)
+
+    def readdir(self, cookie, verifier, client, principal):
+        """Returns (iterator, verifier)
+
+        The iterator generates (cookie, name, obj) for entries after
+        cookie.  Objects are only looked up as the iterator reaches them.
+        """
         log_o.log(5, "FSObject.readdir()")
         if not self.access4_read(principal):
             raise NFS4Error(NFS4ERR_ACCESS)
-        t = struct.unpack(">d", verifier)[0]
-        if t != 0.0:
-            try:
-                return self.dircache[t], verifier
-            except KeyError:
-                raise NFS4Error(NFS4ERR_NOT_SAME)
-        res = [(name, self.fs.find(id)) for name, id in self.entries.items()]
-        while len(self.dircache) >= 4:
-            # Clean out old cache entries
-            # NOTE this system is problematic if multiple clients accessing
-            del self.dircache[min(self.dircache.keys())]
-        t = time.time()
-        self.dircache[t] = res
-        return res, struct.pack(">d", t)
+        entries = self.entries
+        if cookie != 0 and verifier != entries.verifier:
+            raise NFS4Error(NFS4ERR_NOT_SAME)
+        if not entries.valid_cookie(cookie):
+            raise NFS4Error(NFS4ERR_BAD_COOKIE)
+        def objects():
+            for c, name, id in entries.iter_from(cookie):
+                yield c, name, self.fs.find(id)
+        return objects(), entries.verifier
 
     def create(self, name, principal, kind, attrs):
         """Create and link a new object into the dir
@@ -535,14 +949,23 @@ class FSObject(object):
         return obj, bitmask
 
 class FileSystem(object):
+    # Most objects kept in memory, None for no limit.  Only an fs
+    # whose find_on_disk() can recreate an object may set a limit.
+    cache_size = None
+    writer = None # A WriteBehind, to sync UNSTABLE4 writes in the background
+    page_cache = None # The server's PageCache, if used
+    write_losses = 0 # Count of background syncs that failed
+    # Keeps data or metadata in files, which forked server workers
+    # would share without sharing the ids and tables describing them
+    on_disk = False
+
     def __init__(self, fsid=0, objclass=FSObject):
         log_fs.log(5, "FileSystem.__init__(fsid=%i)" % fsid)
         self.fsid = (1, fsid) # Return a unique 2-tuple of uint64
         self.objclass = objclass
         self._disk_lock = Lock("FSLock")
         self.read_only = False
-        # This is list of currently active objects.
-        self._ids = {} # {obj.id: obj}
+        self._init_cache()
         self._set_fattrs()
         self.mounted_on = None # obj on which fs is mounted
         # Do this last
@@ -556,8 +979,9 @@ class FileSystem(object):
         mandatory = 0x80fff
         need_for_linux = [FATTR4_FILEID, FATTR4_MAXNAME, FATTR4_MOUNTED_ON_FILEID]
         need_for_cthon = [FATTR4_MODE, FATTR4_NUMLINKS]
+        case = [FATTR4_CASE_INSENSITIVE, FATTR4_CASE_PRESERVING]
         # self.fattr4_supported_attrs = 0x80000020180fff
-        self.fattr4_supported_attrs = nfs4lib.list2bitmap(need_for_linux + need_for_cthon) | mandatory
+        self.fattr4_supported_attrs = nfs4lib.list2bitmap(need_for_linux + need_for_cthon + case) | mandatory
 
         self.fattr4_fh_expire_type = FH4_PERSISTENT
         self.fattr4_link_support = False
@@ -565,6 +989,8 @@ class FileSystem(object):
         self.fattr4_unique_handles = False
         ########
         self.fattr4_maxname = 256
+        self.fattr4_case_insensitive = False
+        self.fattr4_case_preserving = True
 
     def mount(self, dir):
         """Mount the fs at the given dir.
@@ -596,31 +1022,134 @@ class FileSystem(object):
     def layout_options(self):
         return 0
 
+    def _init_cache(self, size=None):
+        """Set up the cache of in-memory objects
+
+        This is _ids, which holds up to cache_size (if set) objects.
+        Objects without file state are evicted by the CLOCK algorithm:
+        each has a reference bit (being in _recent) set when found, and
+        the hand passes over (clearing the bit) those found since it
+        last came round.  Evicted objects are written back, then their
+        evict() hook frees what they hold.
+
+        An object still referenced elsewhere, such as a compound's cfh,
+        stays in _live, so that find() takes it back rather than making
+        a second object for the same id.
+        """
+        if size is not None:
+            self.cache_size = size
+        # This is list of currently active objects.
+        self._ids = {} # {obj.id: obj}
+        self._live = weakref.WeakValueDictionary() # {obj.id: obj}
+        self._clock = [] # ids, in the order the hand visits them
+        self._hand = 0 # Index into _clock
+        self._recent = set() # ids found since the hand last passed
+        self._evicted = [] # Dropped by _evict(), to be written back
+        self.cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
     def find(self, id):
         """ Returns a FSObject with given id
 
         There should only be one such outstanding.  If it has
         already been passed out, point to same obj.  Otherwise
         read disk info to create a new one.
-        Note : cleanup might be helped by sys.getrefcount()
         """
         log_fs.log(5, "FileSystem.find(id=%r)" % id)
         obj = self._ids.get(id, None)
         if obj is not None:
+            self.cache_stats["hits"] += 1
+            if self.cache_size is not None:
+                self._recent.add(id)
             return obj
-        else:
-            self._disk_lock.acquire()
-            try:
-                # It may have been added while we were waiting for the lock
-                obj = self._ids.get(id, None)
-                if obj is not None:
-                    return obj
+        self._disk_lock.acquire()
+        try:
+            # It may have been added while we were waiting for the lock
+            obj = self._find_cached(id)
+            if obj is None:
                 # Guess not, create a new in-memory obj using info on disk
+                self.cache_stats["misses"] += 1
                 obj = self.find_on_disk(id)
-                self._ids[id] = obj
-                return obj
-            finally:
-                self._disk_lock.release()
+                self._cache_insert(obj)
+        finally:
+            self._disk_lock.release()
+        self._finish_evictions()
+        return obj
+
+    def _find_cached(self, id):
+        """Returns the in-memory obj for id, or None.  Must hold _disk_lock."""
+        obj = self._ids.get(id)
+        if obj is None:
+            obj = self._live.get(id)
+            if obj is not None:
+                # Evicted while still in use, so take it back
+                self._cache_insert(obj)
+        return obj
+
+    def _cache_insert(self, obj):
+        """Add obj to _ids, evicting others if there are too many
+
+        Must hold _disk_lock, and call _finish_evictions() once released.
+        """
+        self._ids[obj.id] = obj
+        self._live[obj.id] = obj
+        if self.cache_size is None:
+            return
+        self._clock.append(obj.id)
+        if len(self._ids) > self.cache_size:
+            self._evict()
+
+    def _evict(self):
+        """Move the CLOCK hand, dropping objects without file state into
+        _evicted, until at most cache_size are left.  Must hold _disk_lock.
+        """
+        clock = self._clock
+        budget = 2 * len(clock) # If all have state, give up
+        while len(self._ids) > self.cache_size and clock and budget:
+            budget -= 1
+            if self._hand >= len(clock):
+                self._hand = 0
+            id = clock[self._hand]
+            obj = self._ids.get(id)
+            if obj is None or obj.id != id:
+                # Already dropped by the fs
+                clock[self._hand] = clock[-1]
+                clock.pop()
+                continue
+            if id in self._recent:
+                # Recently used, give it another round
+                self._recent.discard(id)
+                self._hand += 1
+                continue
+            if not obj.state.has_no_state():
+                self._hand += 1
+                continue
+            del self._ids[id]
+            clock[self._hand] = clock[-1]
+            clock.pop()
+            self._evicted.append(obj)
+            self.cache_stats["evictions"] += 1
+
+    def _finish_evictions(self):
+        """Write back and evict() the objects _evict() dropped.
+
+        Called without _disk_lock, as both may wait on the obj's locks.
+        """
+        for i in range(len(self._evicted)):
+            try:
+                obj = self._evicted.pop()
+            except IndexError:
+                return # Another thread took the rest
+            try:
+                self.sync(obj, FILE_SYNC4)
+            except Exception:
+                log_fs.exception("Could not write back id=%r" % obj.id)
+                # Keep it, to try again when the hand comes round
+                with self._disk_lock:
+                    if obj.id not in self._ids:
+                        self._ids[obj.id] = obj
+                        self._clock.append(obj.id)
+                continue
+            obj.evict()
 
     def find_on_disk(self, id):
         """Returns a FSObject created from disk info pointed to by id"""
@@ -630,6 +1159,11 @@ class FileSystem(object):
         """Syncs object to disk, returns value from enum stable_how4"""
         raise NotImplementedError
 
+    def write_behind(self, obj):
+        """Called when obj was written UNSTABLE4"""
+        if self.writer is not None:
+            self.writer.add(obj)
+
     def create(self, kind, force=False):
         """Allocs disk space and returns a FSObject associated with it.
 
@@ -642,11 +1176,13 @@ class FileSystem(object):
         id = self.alloc_id()
         try:
             obj = self.objclass(self, id, kind)
-            self._ids[id] = obj # XXX Not needed if object creation does it
+            with self._disk_lock:
+                self._cache_insert(obj)
         except:
             log_fs.exception("fs.create failed")
             # traceback.print_exc()
             self.dealloc_id(id)
+        self._finish_evictions()
         return obj
 
     def alloc_id(self):
@@ -659,9 +1195,64 @@ class FileSystem(object):
         """Free up disk space associated with id. """
         raise NotImplementedError
 
+class IdAllocator(object):
+    """Hands out unique, increasing ids, reserving them a batch at a time.
+
+    Only the high-water mark, the first id past the reserved batch, is
+    passed to save(), so a fs that must never reuse an id across restarts
+    pays for one write per batch instead of one per id.  Whatever is left
+    of the batch when the server stops is skipped on restart.
+
+    Within a batch alloc() takes no lock, since itertools.count hands out
+    values atomically under the GIL.  IdLock is held while save() runs,
+    so save() must not wait on anything held by callers of alloc().
+    """
+    def __init__(self, first=1, batch=1024, save=None):
+        self.batch = batch
+        self._save = save
+        self._lock = Lock("IdLock")
+        self._count = itertools.count(first)
+        self.high_water = first
+
+    def alloc(self):
+        id = next(self._count)
+        if id >= self.high_water:
+            self._reserve(id)
+        return id
+
+    def _reserve(self, id):
+        """Move the high-water mark past id"""
+        with self._lock:
+            if id >= self.high_water:
+                mark = id + self.batch
+                if self._save is not None:
+                    self._save(mark)
+                # Only now may other threads skip the lock for ids below it
+                self.high_water = mark
+
+class ExtentAllocator(IdAllocator):
+    """An IdAllocator that hands out runs of consecutive ids, such as
+    device blocks.  Every alloc() takes the lock.
+    """
+    def __init__(self, first=0, batch=1024, save=None):
+        IdAllocator.__init__(self, first, batch, save)
+        self._next = first
+
+    def alloc(self, count=1):
+        """Returns the first of count consecutive unused ids"""
+        with self._lock:
+            rv = self._next
+            self._next += count
+            if self._next > self.high_water:
+                mark = self._next + self.batch
+                if self._save is not None:
+                    self._save(mark)
+                self.high_water = mark
+            return rv
+
 class RootFS(FileSystem):
     def __init__(self):
-        self._nextid = 0
+        self._id_alloc = IdAllocator()
         FileSystem.__init__(self)
         self.fattr4_maxwrite = 4096
         self.fattr4_maxread = 4096
@@ -671,8 +1262,7 @@ class RootFS(FileSystem):
         self.read_only = True
 
     def alloc_id(self):
-        self._nextid += 1
-        return self._nextid
+        return self._id_alloc.alloc()
 
     def dealloc_id(self, id):
         pass
@@ -681,17 +1271,17 @@ class RootFS(FileSystem):
         return FILE_SYNC4
 
 class StubFS_Mem(FileSystem):
-    def __init__(self, fsid):
-        self._nextid = 0
+    def __init__(self, fsid, case_insensitive=False):
+        self._id_alloc = IdAllocator()
         FileSystem.__init__(self)
         self.fsid = (2, fsid)
+        self.fattr4_case_insensitive = case_insensitive
 
     def alloc_id(self):
         """Alloc disk space for an FSObject, and return an identifier
         that will allow us to find the disk space later.
         """
-        self._nextid += 1
-        return self._nextid
+        return self._id_alloc.alloc()
 
     def dealloc_id(self, id):
         """Free up disk space associated with id. """
@@ -703,18 +1293,22 @@ class StubFS_Mem(FileSystem):
 from config import ServerPerClientConfig, ConfigAction
 
 class ConfigObj(FSObject):
+    cache_names = False # Entries are built per client
+
     def associate(self, configline):
         self.configline = configline
         self._reset()
 
     def _reset(self):
-        self.file = StringIO()
-        self.file.write("# %s\n" % self.configline.comment)
+        text = "# %s\n" % self.configline.comment
         value = self.configline.value
-        if type(value) is list:
-            self.file.write(" ".join([str(i) for i in value]))
+        if self.configline.live:
+            text += value
+        elif type(value) is list:
+            text += " ".join([str(i) for i in value])
         else:
-            self.file.write("%r\n" % value)
+            text += "%r\n" % value
+        self.file = StringFile(text)
         self.change_data()
         self.dirty = False
 
@@ -722,6 +1316,16 @@ class ConfigObj(FSObject):
         FSObject.change_data(self)
         self.dirty = True
 
+    def _getsize_locked(self):
+        if self.fattr4_type == NF4REG and self.configline.live:
+            self._reset() # Size is checked before reading, so refresh here
+        return FSObject._getsize_locked(self)
+
+    def read(self, offset, count, principal):
+        if offset == 0 and self.configline.live:
+            self._reset()
+        return FSObject.read(self, offset, count, principal)
+
     def create(self, *args, **kwargs):
         raise NFS4Error(NFS4ERR_ACCESS)
 
@@ -750,6 +1354,8 @@ class ConfigObj(FSObject):
         except ConfigAction, e:
             if e.name == "reboot":
                 self.fs.server.reboot()
+            elif e.name == "checkpoint":
+                self.fs.server.checkpoint()
         except:
             log_o.info("close() verify failed", exc_info=True)
         self._reset()
@@ -765,7 +1371,7 @@ class ConfigObj(FSObject):
         entries = self._build_entries(Fake())
         return entries.get(name, None)
 
-    def lookup(self, name, client, principal):
+    def lookup(self, name, client, principal, follow_mount=True):
         """Returns FSObject associated with name in the dir"""
         log_o.log(5, "ConfigObj.lookup(%r, %r)" % (name, principal))
         entries = self._build_entries(client)
@@ -774,14 +1380,15 @@ class ConfigObj(FSObject):
             return None
         return self.fs.find(id)
 
-    def readdir(self, verifier, client, principal):
+    def readdir(self, cookie, verifier, client, principal):
         v0 = "\x00" * 8
         v1 = "\x01" * 8
         if verifier not in (v0, v1):
             raise NFS4Error(NFS4ERR_NOT_SAME)
         entries = self._build_entries(client)
-        res = [(name, self.fs.find(id)) for name, id in entries.items()]
-        return res, v1
+        res = [(i + DirIndex.first_cookie, name, self.fs.find(entries[name]))
+               for i, name in enumerate(sorted(entries))]
+        return res[max(cookie - DirIndex.first_cookie + 1, 0):], v1
 
     def _build_entries(self, client):
         def makefh(code, mask=0):
@@ -806,6 +1413,7 @@ class ConfigObj(FSObject):
                        "serverwide": makefh(2),
                        "perclient" : makefh(3, cid_mask),
                        "ops"       : makefh(4),
+                       "stats"     : makefh(5),
                        }
         elif id == 8:
             # This is actions dir
@@ -827,6 +1435,11 @@ class ConfigObj(FSObject):
             entries = {}
             for i, attr in enumerate(self.fs.server.opsconfig.attrs):
                 entries[attr.name] = 4 | obj_mask(i)
+        elif id == 5:
+            # This is stats dir
+            entries = {}
+            for i, attr in enumerate(self.fs.server.stats.attrs):
+                entries[attr.name] = 5 | obj_mask(i)
         else:
             raise RuntimeError("Called readdir with id=%i" % id)
         return entries
@@ -901,6 +1514,9 @@ class ConfigFS(FileSystem):
             elif dcode == 4:
                 # parent = config/ops/
                 config = self.server.opsconfig
+            elif dcode == 5:
+                # parent = config/stats/
+                config = self.server.stats
             else:
                 raise RuntimeError("id=%x" % id)
             obj = self.objclass(self, id, NF4REG)
@@ -910,7 +1526,7 @@ class ConfigFS(FileSystem):
             #                       config (1)
             #        ______________/ /   \  \______________      
             #       /               /     \                \
-            # actions (8)   serverwide (2)  perclient (3)  ops (4)
+            # actions (8)   serverwide (2)  perclient (3)  ops (4)  stats (5)
             #
             if line_code() != 0:
                 raise RuntimeError("id=%x" % id)
@@ -920,26 +1536,963 @@ class ConfigFS(FileSystem):
         obj.refcnt = 1
         return obj
 
+class StringFile(object):
+    """Positional I/O onto a StringIO, for small files kept in memory.
+
+    A StringIO has a single position, so each call holds a lock.
+    """
+    def __init__(self, data=""):
+        self._io = StringIO()
+        self._io.write(data)
+        self._lock = Lock("StringFile")
+
+    def size(self):
+        with self._lock:
+            self._io.seek(0, os.SEEK_END)
+            return self._io.tell()
+
+    def pread(self, offset, count):
+        with self._lock:
+            self._io.seek(offset)
+            return self._io.read(count)
+
+    def pwrite(self, offset, data):
+        with self._lock:
+            self._io.seek(offset)
+            self._io.write(data) # Pads any gap with zeroes
+
+    def truncate(self, size):
+        with self._lock:
+            self._io.truncate(size)
+
+    def getvalue(self):
+        return self._io.getvalue()
+
+    def close(self):
+        pass
+
 ###################################################
 
-import os
-import pickle
+import cPickle as pickle
 import shutil
 import shelve
+import mmap
+import collections
+import threading
+import weakref
+import zlib
+import stat
+import errno
+import pwd
+
+# lseek whence values, and pread(2), pwrite(2) and fallocate(2),
+# which python2 lacks.  Called through ctypes, pread and pwrite also
+# release the GIL, so I/O to one fd from several threads can overlap.
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _fallocate = _libc.fallocate64
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_int64, ctypes.c_int64]
+    _pread = _libc.pread64
+    _pread.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                       ctypes.c_size_t, ctypes.c_int64]
+    _pread.restype = ctypes.c_ssize_t
+    _pwrite = _libc.pwrite64
+    _pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                        ctypes.c_size_t, ctypes.c_int64]
+    _pwrite.restype = ctypes.c_ssize_t
+except (ImportError, OSError, AttributeError):
+    log_fs.info("No fallocate() or pread(), disk I/O will be serialized")
+    _fallocate = _pread = _pwrite = None
+_fd_pos_lock = threading.Lock() # Held across lseek() and I/O, if no pread()
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+def pread(fd, count, offset):
+    """os.pread, which python2 lacks.  Short only at EOF."""
+    chunks = []
+    while count > 0:
+        if _pread is not None:
+            buf = ctypes.create_string_buffer(count)
+            data = ctypes.string_at(buf, _check(_pread(fd, buf, count, offset)))
+        else:
+            with _fd_pos_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, count)
+        if not data:
+            break
+        chunks.append(data)
+        count -= len(data)
+        offset += len(data)
+    if len(chunks) == 1:
+        return chunks[0]
+    return "".join(chunks)
+
+def pwrite(fd, data, offset):
+    """os.pwrite, which python2 lacks"""
+    if type(data) is not str:
+        data = str(data)
+    done = 0
+    while done < len(data):
+        if _pwrite is not None:
+            piece = (data[done:] if done else data)
+            done += _check(_pwrite(fd, piece, len(piece), offset + done))
+        else:
+            with _fd_pos_lock:
+                os.lseek(fd, offset + done, os.SEEK_SET)
+                done += os.write(fd, buffer(data, done))
+    return done
+
+def fallocate(fd, mode, offset, length):
+    """Returns True on success, False if unsupported"""
+    if _fallocate is None:
+        return False
+    if _fallocate(fd, mode, offset, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+        return False
+    raise OSError(err, os.strerror(err))
+
+class DiskFile(object):
+    """Positional I/O onto an object's data file, a range at a time.
+
+    Reads and writes go straight to the file at the requested offset,
+    instead of holding the whole file in memory.  The ranges written
+    since the last flush() are kept in dirty, as sorted (start, end)
+    pairs.  The fd is opened on first use.  Any number of threads may
+    read and write at once; _lock guards the fd and dirty.  Resizing
+    must not overlap other I/O, which obj.size_lock sees to.
+    """
+    sparse = True # truncate() can extend the file, leaving a hole
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self.dirty = [] # Sorted, non-overlapping [(start, end)]
+        self.resized = False # Truncated since the last flush()
+        self._lock = Lock("DiskFile")
+        self._flush_lock = Lock("FlushLock") # Held while syncing
+
+    def fileno(self):
+        if self._fd is None:
+            with self._lock:
+                if self._fd is None:
+                    self._fd = self._open()
+        return self._fd
+
+    def _open(self):
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+
+    def size(self):
+        return os.fstat(self.fileno()).st_size
+
+    def pread(self, offset, count):
+        return pread(self.fileno(), count, offset)
+
+    def pwrite(self, offset, data):
+        pwrite(self.fileno(), data, offset)
+        with self._lock:
+            self._mark_dirty(offset, offset + len(data))
+
+    def truncate(self, size):
+        os.ftruncate(self.fileno(), size)
+        with self._lock:
+            self.resized = True
+
+    def seek_data(self, offset):
+        """Returns the first offset >= offset not in a hole, or None"""
+        try:
+            found = os.lseek(self.fileno(), offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                return None
+            raise
+        return (found if found < self.size() else None)
+
+    def seek_hole(self, offset):
+        """Returns the first offset >= offset in a hole, or at EOF"""
+        try:
+            found = os.lseek(self.fileno(), offset, SEEK_HOLE)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                return self.size()
+            raise
+        return min(found, self.size())
+
+    def punch(self, offset, length):
+        """Turn the range into a hole, without changing the size"""
+        if not fallocate(self.fileno(), FALLOC_FL_PUNCH_HOLE |
+                         FALLOC_FL_KEEP_SIZE, offset, length):
+            # Holes can't be made here, but zeroes read the same
+            _write_zeroes(self, offset, length)
+            return
+        with self._lock:
+            self._mark_dirty(offset, offset + length)
+
+    def allocate(self, offset, length):
+        """Back the holes in the range, extending the file if needed"""
+        end = offset + length
+        # Reserve before extending, so running out of space (ENOSPC) or
+        # past the largest file (EFBIG) leaves the size alone.  Without
+        # fallocate the range stays sparse, which reads the same.
+        fallocate(self.fileno(), FALLOC_FL_KEEP_SIZE, offset, length)
+        if end > self.size():
+            self.truncate(end)
+        with self._lock:
+            self._mark_dirty(offset, end)
+
+    def _mark_dirty(self, start, end):
+        """Add [start, end) to dirty.  Caller must hold _lock."""
+        dirty = self.dirty
+        i = bisect.bisect_left(dirty, (start,))
+        if i > 0 and dirty[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(dirty) and dirty[j][0] <= end:
+            start = min(start, dirty[j][0])
+            end = max(end, dirty[j][1])
+            j += 1
+        dirty[i:j] = [(start, end)]
+
+    def flush(self, how):
+        """Make written data stable, as asked for by how (a stable_how4)
+
+        Writes may go on while the sync runs, and are left dirty for the
+        next flush.  Returns the stable_how4 actually achieved.
+        """
+        if how == UNSTABLE4:
+            return UNSTABLE4
+        # A flush already under way has taken the dirty ranges, so wait
+        # for it rather than assume they are stable.
+        with self._flush_lock:
+            with self._lock:
+                if not (self.dirty or self.resized):
+                    return how
+                if self.resized:
+                    how = FILE_SYNC4
+                dirty, resized = self.dirty, self.resized
+                self.dirty = []
+                self.resized = False
+                # A dup, in case the file is closed during the sync
+                fd = os.dup(self.fileno())
+            try:
+                if how == DATA_SYNC4:
+                    os.fdatasync(fd)
+                else:
+                    os.fsync(fd)
+                    how = FILE_SYNC4
+            except:
+                with self._lock:
+                    for start, end in dirty:
+                        self._mark_dirty(start, end)
+                    self.resized |= resized
+                raise
+            finally:
+                os.close(fd)
+        return how
+
+    def is_clean(self, offset, count):
+        """True if no data written to the range still needs flushing.
+
+        count 0 means to EOF.
+        """
+        end = (offset + count if count else None)
+        with self._flush_lock:
+            with self._lock:
+                if self.resized:
+                    return False
+                for start, stop in self.dirty:
+                    if stop > offset and (end is None or start < end):
+                        return False
+                return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class PageCache(object):
+    """File data shared by the CachedFiles of all fs, in page_size pages.
+
+    At most config.page_cache_size bytes are kept.  Pages are dropped
+    in the order cached, except that a page read since it was last
+    passed over gets another pass (CLOCK, which is cheaper per hit than
+    strict LRU).  The last page of a file may be short.  The file keeps
+    in tail where its short page ends, so that a write or truncate
+    growing the file past it can drop it.  When a file is read
+    sequentially, the pages after the read are queued for a background
+    thread to read ahead, the window doubling with each sequential read
+    up to readahead_max pages.
+    """
+    page_size = 64 << 10
+    readahead_max = 16
+
+    def __init__(self, config):
+        self.config = config
+        self.used = 0 # Bytes cached
+        self.stats = dict.fromkeys(("hits", "misses", "readahead",
+                                    "evictions"), 0)
+        self.files = weakref.WeakValueDictionary() # {path: CachedFile}
+        self._pages = {} # {(file, index): data}
+        self._ring = collections.deque() # Keys in eviction order
+        self._referenced = set() # Keys read since last passed over
+        self._lock = Lock("PageCache")
+        self._jobs = collections.deque() # [(file, first, count, generation)]
+        self._cond = threading.Condition()
+        self._thread = None
+
+    enabled = property(lambda s: s.config.page_cache_size > 0)
+
+    def get(self, file, index):
+        # No lock needed, a page that is being invalidated is the data
+        # from just before the write that did it.
+        key = (file, index)
+        data = self._pages.get(key)
+        if data is None:
+            self.stats["misses"] += 1
+        else:
+            self._referenced.add(key)
+            self.stats["hits"] += 1
+        return data
+
+    def put(self, file, index, data, generation=None):
+        """Cache a page of file.
+
+        Returns False if generation is given and file has changed since.
+        """
+        key = (file, index)
+        limit = self.config.page_cache_size
+        with self._lock:
+            if generation is not None and generation != file.generation:
+                return False
+            pages, ring, referenced = self._pages, self._ring, self._referenced
+            old = pages.get(key)
+            if old is None:
+                ring.append(key)
+            else:
+                self.used -= len(old)
+            pages[key] = data
+            file.pages.add(index)
+            if len(data) < self.page_size:
+                file.tail = index * self.page_size + len(data)
+            self.used += len(data)
+            while self.used > limit and ring:
+                key = ring.popleft()
+                if key not in pages:
+                    continue # Invalidated
+                if key in referenced:
+                    referenced.discard(key)
+                    ring.append(key)
+                    continue
+                old_file, i = key
+                old_file.pages.discard(i)
+                self._forget_tail(old_file, i)
+                self.used -= len(pages.pop(key))
+                self.stats["evictions"] += 1
+            if len(ring) > 2 * len(pages) + 64:
+                # Drop the keys of invalidated pages
+                self._ring = collections.deque(k for k in ring if k in pages)
+        return True
+
+    def invalidate(self, file, start=0, end=None):
+        """Drop cached pages of file overlapping [start, end)"""
+        size = self.page_size
+        with self._lock:
+            file.generation += 1
+            for i in [i for i in file.pages if (i + 1) * size > start and
+                      (end is None or i * size < end)]:
+                self.used -= len(self._pages.pop((file, i)))
+                self._referenced.discard((file, i))
+                file.pages.discard(i)
+                self._forget_tail(file, i)
+
+    def _forget_tail(self, file, index):
+        """Page index of file was dropped.  Must hold _lock."""
+        if file.tail is not None and file.tail // self.page_size == index:
+            file.tail = None
+
+    def report(self):
+        """Summary of cache use, for /config/stats"""
+        stats = self.stats
+        return ("%i of %i bytes used, in %i pages of %i\n"
+                "hits %i misses %i readahead %i evictions %i\n" %
+                (self.used, self.config.page_cache_size, len(self._pages),
+                 self.page_size, stats["hits"], stats["misses"],
+                 stats["readahead"], stats["evictions"]))
+
+    def report_files(self, count=20):
+        """Access patterns of the count most read files, for /config/stats"""
+        files = sorted(self.files.values(),
+                       key=lambda f: f.access["reads"], reverse=True)
+        lines = []
+        for file in files[:count]:
+            access = file.access
+            lines.append("%s reads %i sequential %i hits %i misses %i "
+                         "readahead %i\n" %
+                         (file.path, access["reads"], access["sequential"],
+                          access["hits"], access["misses"],
+                          access["readahead"]))
+        return "".join(lines)
+
+    def read_ahead(self, file, first, count):
+        """Queue count pages of file from first to be read in"""
+        with self._cond:
+            self._jobs.append((file, first, count, file.generation))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="ReadAhead")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        size = self.page_size
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                file, first, count, generation = self._jobs.popleft()
+            # Our own fd, so no need to touch the file's.  Anything
+            # written meanwhile bumps generation, and stops the put().
+            try:
+                fd = os.open(file.path, os.O_RDONLY)
+            except OSError:
+                continue # Removed
+            try:
+                for i in xrange(first, first + count):
+                    if (file, i) in self._pages:
+                        continue
+                    data = pread(fd, size, i * size)
+                    if not data or \
+                           not self.put(file, i, data, generation) or \
+                           len(data) < size:
+                        break
+                    self.stats["readahead"] += 1
+                    file.access["readahead"] += 1
+            except OSError:
+                log_fs.exception("Read ahead of %s failed" % file.path)
+            finally:
+                os.close(fd)
+
+class CachedFile(DiskFile):
+    """A DiskFile read through fs.page_cache, when the fs has one.
+
+    A read starting where the last one ended is counted as sequential,
+    and has the cache read ahead of it.  The counts are kept in access.
+    With reads of the file running at once these are only estimates,
+    but the data is not: a page read from disk is only cached if no
+    write has invalidated the file since the read began.
+    """
+    def __init__(self, fs, path):
+        DiskFile.__init__(self, path)
+        self.fs = fs
+        self.generation = 0 # Bumped by PageCache.invalidate()
+        self.pages = set() # Indexes of our pages in the cache
+        self.tail = None # Where our cached short last page ends
+        self.access = dict.fromkeys(("reads", "sequential", "hits",
+                                     "misses", "readahead"), 0)
+        self._next_read = 0 # Where a sequential read would start
+        self._window = 0 # Pages to read ahead
+        self._ahead = -1 # Last page queued for read ahead
+        if fs.page_cache is not None:
+            fs.page_cache.files[path] = self
+
+    def pread(self, offset, count):
+        cache = self.fs.page_cache
+        if cache is None or count <= 0 or not cache.enabled:
+            return DiskFile.pread(self, offset, count)
+        access = self.access
+        access["reads"] += 1
+        start = offset
+        end = start + count
+        if start == self._next_read:
+            access["sequential"] += 1
+            if self._window < cache.readahead_max:
+                self._window = min(2 * self._window or 1,
+                                   cache.readahead_max)
+        else:
+            self._window = 0
+            self._ahead = -1
+        self._next_read = end
+        size = cache.page_size
+        pieces = []
+        for i in xrange(start // size, (end - 1) // size + 1):
+            base = i * size
+            page = cache.get(self, i)
+            if page is None:
+                access["misses"] += 1
+                generation = self.generation
+                page = pread(self.fileno(), size, base)
+                if page:
+                    cache.put(self, i, page, generation)
+            else:
+                access["hits"] += 1
+            pieces.append(page[start - base if start > base else 0:
+                               end - base])
+            if len(page) < size:
+                break # At EOF
+        else:
+            if self._window:
+                first = max(i + 1, self._ahead + 1)
+                last = i + self._window
+                if first <= last:
+                    cache.read_ahead(self, first, last - first + 1)
+                    self._ahead = last
+        if len(pieces) == 1:
+            return pieces[0]
+        return "".join(pieces)
+
+    def _invalidate(self, start, end=None):
+        """Drop cached pages over [start, end), and the short last page
+        if the file may have grown past it"""
+        cache = self.fs.page_cache
+        if cache is None:
+            return
+        tail = self.tail
+        if tail is not None and (end is None or end > tail):
+            start = min(start, tail)
+        cache.invalidate(self, start, end)
+
+    def pwrite(self, offset, data):
+        DiskFile.pwrite(self, offset, data)
+        # After the write, so a read racing it cannot cache old data
+        self._invalidate(offset, offset + len(data))
+
+    def truncate(self, size):
+        DiskFile.truncate(self, size)
+        self._invalidate(size)
+
+    def punch(self, offset, length):
+        DiskFile.punch(self, offset, length)
+        self._invalidate(offset, offset + length)
+
+    def close(self):
+        # A reopened file gets a new CachedFile, so our pages are dead
+        if self.fs.page_cache is not None:
+            self.fs.page_cache.invalidate(self)
+        DiskFile.close(self)
+
+class WriteBehind(object):
+    """Syncs objects written UNSTABLE4 in the background.
+
+    Objects are queued by add(), and a thread started on first use syncs
+    them delay seconds later.  So a stream of writes to a file costs one
+    sync per delay, done while the writes go on, and a COMMIT usually
+    finds nothing left to do.  If a sync fails the data may be lost, so
+    fs.write_losses is bumped, changing the write verifier the server
+    hands out, which makes clients send the data again.
+    """
+    def __init__(self, fs, delay=0.05):
+        self.fs = fs
+        self.delay = delay
+        self._queue = {} # {id: obj}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.stats = {"queued": 0, "synced": 0, "failed": 0}
+
+    def add(self, obj):
+        with self._cond:
+            if obj.id in self._queue:
+                return
+            self._queue[obj.id] = obj
+            self.stats["queued"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="WriteBehind")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            # Let more writes pile up behind the first
+            time.sleep(self.delay)
+            with self._cond:
+                objs = self._queue.values()
+                self._queue = {}
+            for obj in objs:
+                if obj.refcnt < 1:
+                    continue # Removed, its data need not survive
+                try:
+                    obj.sync(FILE_SYNC4)
+                    self.stats["synced"] += 1
+                except Exception:
+                    log_fs.exception("Background sync of %i failed" % obj.id)
+                    self.stats["failed"] += 1
+                    self.fs.write_losses += 1
+
+class MmapFile(DiskFile):
+    """A DiskFile accessed through mmap windows instead of read/write.
+
+    The windows are window_size pieces of the file, mapped on demand and
+    shared with the fs, which unmaps the least recently used ones to keep
+    within fs.map_limit.  A read within one window returns a buffer onto
+    the mapping, so READ data is not copied before being packed.
+
+    Shrinking the file punches out the data but leaves the file at its
+    largest size, so mappings still held by unpacked replies stay valid.
+    """
+    def __init__(self, fs, path):
+        DiskFile.__init__(self, path)
+        self.fs = fs
+        self._size = 0 # Size seen by clients
+        self._extent = 0 # Real size of the file, never shrinks
+
+    def size(self):
+        return self._size
+
+    def pread(self, offset, count):
+        start = offset
+        end = min(self._size, start + count)
+        if end <= start:
+            return ""
+        size = self.fs.window_size
+        first, last = start // size, (end - 1) // size
+        if first == last:
+            return buffer(self.fs.map_window(self, first),
+                          start - first * size, end - start)
+        pieces = []
+        for i in xrange(first, last + 1):
+            base = i * size
+            window = self.fs.map_window(self, i)
+            pieces.append(window[max(start, base) - base:
+                                 min(end, base + size) - base])
+        return "".join(pieces)
+
+    def pwrite(self, offset, data):
+        start = offset
+        end = start + len(data)
+        if end > self._size:
+            self.truncate(end)
+        size = self.fs.window_size
+        first, last = start // size, (end - 1) // size
+        for i in xrange(first, last + 1):
+            base = i * size
+            lo, hi = max(start, base), min(end, base + size)
+            if hi - lo == len(data):
+                piece = data
+            else:
+                piece = data[lo - start:hi - start]
+            self.fs.map_window(self, i)[lo - base:hi - base] = piece
+        with self._lock:
+            self._mark_dirty(start, end)
+
+    def truncate(self, size):
+        fd = self.fileno()
+        if size > self._extent:
+            os.ftruncate(fd, size)
+            if self._extent % self.fs.window_size:
+                # The last window has grown
+                self.fs.unmap_window(self, self._extent // self.fs.window_size)
+            self._extent = size
+        elif size < self._size:
+            os.ftruncate(fd, size)
+            os.ftruncate(fd, self._extent)
+        self._size = size
+        with self._lock:
+            self.resized = True
+
+    def extent(self, index):
+        """Returns (offset, length) of window index"""
+        offset = index * self.fs.window_size
+        return offset, min(self.fs.window_size, self._extent - offset)
+
+    def close(self):
+        self.fs.unmap_window(self)
+        DiskFile.close(self)
+
+class DiskObj(FSObject):
+    """An FSObject whose regular file data stays on disk"""
+    def init_file(self):
+        if self.type == NF4REG:
+            return self.fs.open_data(self.id)
+        return StringFile()
+
+    def destroy(self):
+        FSObject.destroy(self)
+        if self.type == NF4REG:
+            self.file.close()
+
+    def evict(self):
+        if self.type == NF4REG:
+            # It may still be in use, so wait for any I/O
+            self.size_lock.acquire_write()
+            try:
+                self.file.close()
+            finally:
+                self.size_lock.release()
+
+# Kinds of MetaLog record
+LOG_META = 1 # Packed meta of an object, from _pack_meta()
+LOG_LINK = 2 # (dir id, obj id, name), a name added to a dir
+LOG_UNLINK = 3 # (dir id, name), a name removed from a dir
+LOG_ID_MARK = 4 # High-water mark of the fs's IdAllocator
+
+# id, change, type, refcnt, mode, flags, time_access, time_modify,
+# time_create, parent
+_meta_struct = struct.Struct("!QQIiIBqIqIqIQ")
+_refcnt_offset = 20
+_type_offset = 16
+_META_NO_PARENT = 1
+_META_LINKDATA = 2
+_META_DEVDATA = 4
+_link_struct = struct.Struct("!QQ")
+_unlink_struct = struct.Struct("!Q")
+_mark_struct = struct.Struct("!Q")
+
+def _opaque(data):
+    return struct.pack("!I", len(data)) + data
+
+def _unopaque(data, pos):
+    """Return (data, pos) of opaque starting at pos"""
+    size = struct.unpack_from("!I", data, pos)[0]
+    pos += 4
+    return data[pos:pos + size], pos + size
+
+def _pack_meta(id, meta):
+    """Returns a LOG_META record body for meta"""
+    flags = 0
+    parent = meta.parent
+    if parent is None:
+        flags |= _META_NO_PARENT
+        parent = 0
+    tail = [_opaque(meta.owner), _opaque(meta.createverf)]
+    if meta.linkdata is not None:
+        flags |= _META_LINKDATA
+        tail.append(_opaque(meta.linkdata))
+    if meta.devdata is not None:
+        flags |= _META_DEVDATA
+        tail.append(struct.pack("!II", meta.devdata.specdata1,
+                                meta.devdata.specdata2))
+    ta, tm, tc = meta.time_access, meta.time_modify, meta.time_create
+    return _meta_struct.pack(id, meta.change, meta.type, meta.refcnt,
+                             meta.mode, flags, ta.seconds, ta.nseconds,
+                             tm.seconds, tm.nseconds, tc.seconds, tc.nseconds,
+                             parent) + "".join(tail)
+
+def _unpack_meta(data):
+    """Inverse of _pack_meta, returns (id, meta)"""
+    (id, change, type, refcnt, mode, flags, ta_s, ta_ns, tm_s, tm_ns,
+     tc_s, tc_ns, parent) = _meta_struct.unpack_from(data)
+    meta = MetaData()
+    meta.change = change
+    meta.type = type
+    meta.refcnt = refcnt
+    meta.mode = mode
+    meta.time_access = nfstime4(ta_s, ta_ns)
+    meta.time_modify = nfstime4(tm_s, tm_ns)
+    meta.time_create = nfstime4(tc_s, tc_ns)
+    meta.parent = (None if flags & _META_NO_PARENT else parent)
+    pos = _meta_struct.size
+    meta.owner, pos = _unopaque(data, pos)
+    meta.createverf, pos = _unopaque(data, pos)
+    if flags & _META_LINKDATA:
+        meta.linkdata, pos = _unopaque(data, pos)
+    if flags & _META_DEVDATA:
+        meta.devdata = specdata4(*struct.unpack_from("!II", data, pos))
+    return id, meta
+
+class MetaLog(object):
+    """An append-only log of metadata records, with group commit.
+
+    append() just queues a record in memory.  The first caller of
+    commit() writes out everything queued with one write and one
+    fdatasync, while later callers wait for it and then find their
+    records already done, so concurrent syncs share the cost.
+
+    Each record is (crc32, kind, length) and length bytes of body,
+    the crc covering the rest, so a torn write at the end of the log
+    is found on replay.  The log is split into numbered files, a new
+    one being started by rotate().
+    """
+    _header = struct.Struct("!IBI")
+
+    def __init__(self, dir, gen):
+        self.dir = dir
+        self.gen = gen
+        self._fd = self._open(gen)
+        self.size = os.fstat(self._fd).st_size
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = []
+        self._seq = 0 # Count of records appended
+        self._durable = 0 # Count of records written and synced
+        self._flushing = False
+        self.stats = {"records": 0, "commits": 0}
+
+    @staticmethod
+    def log_path(dir, gen):
+        return os.path.join(dir, "meta_log.%i" % gen)
+
+    def _open(self, gen):
+        return os.open(self.log_path(self.dir, gen), os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                       0600)
+
+    @classmethod
+    def pack(cls, kind, body):
+        head = cls._header.pack(0, kind, len(body))[4:]
+        return struct.pack("!I", zlib.crc32(head + body) & 0xffffffff) + \
+               head + body
+
+    @classmethod
+    def records(cls, data):
+        """Generate (kind, body, end) for each good record in data"""
+        pos = 0
+        size = cls._header.size
+        while pos + size <= len(data):
+            crc, kind, length = cls._header.unpack_from(data, pos)
+            end = pos + size + length
+            if end > len(data) or \
+               zlib.crc32(buffer(data, pos + 4, end - pos - 4)) & 0xffffffff != crc:
+                return
+            yield kind, data[pos + size:end], end
+            pos = end
+
+    def append(self, kind, body):
+        """Queue a record, returns its sequence number for commit()"""
+        rec = self.pack(kind, body)
+        with self._cond:
+            self._pending.append(rec)
+            self._seq += 1
+            self.stats["records"] += 1
+            return self._seq
+
+    def commit(self, seq=None):
+        """Make sure records up to seq (default all) are on disk"""
+        with self._cond:
+            if seq is None:
+                seq = self._seq
+            while self._durable < seq:
+                if self._flushing:
+                    # Someone else is writing, maybe our records too
+                    self._cond.wait()
+                else:
+                    self._flush()
+
+    def _flush(self):
+        """Write out all queued records.  Must hold _cond."""
+        data = "".join(self._pending)
+        self._pending = []
+        target = self._seq
+        fd = self._fd
+        self._flushing = True
+        self._cond.release()
+        try:
+            done = 0
+            while done < len(data):
+                done += os.write(fd, buffer(data, done))
+            os.fdatasync(fd)
+        except:
+            self._cond.acquire()
+            self._pending.insert(0, data[done:])
+            self._flushing = False
+            self._cond.notify_all()
+            raise
+        self._cond.acquire()
+        self.size += len(data)
+        self._durable = target
+        self._flushing = False
+        self.stats["commits"] += 1
+        self._cond.notify_all()
+
+    def rotate(self, snapshot):
+        """Write out all records, then move on to the next log file.
+
+        snapshot() is called just before the move, with appends held
+        off, and its return value is returned.
+        """
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            self._flush()
+            rv = snapshot(self.gen + 1)
+            os.close(self._fd)
+            self.gen += 1
+            self._fd = self._open(self.gen)
+            self.size = 0
+            return rv
+
+    def close(self):
+        self.commit()
+        os.close(self._fd)
+
+class JournalObj(DiskObj):
+    """A DiskObj whose dir changes are recorded in the fs's MetaLog"""
+    def _add_entry(self, name, id):
+        with self.fs._tables_lock:
+            self.entries[name] = id
+
+    def _remove_entry(self, name):
+        with self.fs._tables_lock:
+            return self.entries.pop(name)
+
+    def link(self, name, obj, principal):
+        FSObject.link(self, name, obj, principal)
+        self.fs.log_link(self, name, obj)
+
+    def unlink(self, name, principal): # NF4DIR only
+        name = self.entry_name(name)
+        id = self.entries.get(name)
+        FSObject.unlink(self, name, principal)
+        self.fs.log_unlink(self, name, self.fs.find(id))
+
+    def respell(self, name, newname, principal):
+        obj = self.fs.find(self.entries[name])
+        FSObject.respell(self, name, newname, principal)
+        self.fs.log_unlink(self, name, None)
+        self.fs.log_link(self, newname, obj)
 
 class StubFS_Disk(FileSystem):
+    """An fs kept under path, that survives restarts.
+
+    Regular file data is kept in a file per object.  All metadata,
+    including dir entries, is kept in memory, with changes recorded in
+    a MetaLog, and stable once sync() returns.  When the log grows past
+    checkpoint_size, the tables are written to a checkpoint file and
+    a new log is started.  On restart the checkpoint is loaded and the
+    logs since replayed.  Ids are reserved id_batch at a time, each batch
+    costing one log record, and are never reused.
+
+    _tables_lock covers the tables and every dir's entries, so that a
+    checkpoint sees none of them change.
+    """
     _fs_data_name = "fs_info" # DB name where we store persistent data
-    def __init__(self, path, reset=False, fsid=None):
-        self._nextid = 0
+    _checkpoint_name = "meta_checkpoint"
+    checkpoint_size = 64 << 20
+    on_disk = True
+    id_batch = 1024
+
+    def __init__(self, path, reset=False, fsid=None, case_insensitive=False,
+                 cache_size=4096):
+        self._id_mark = 1 # High-water mark, as last passed to the log
         self.path = path
         self._fs_data = None # The DB itself
+        self.cache_size = cache_size
+        self._meta = {} # {id: packed meta} of every object
+        self._entries = {} # {id: DirIndex} of every dir
+        self._tables_lock = Lock("TablesLock(Disk)")
+        self._checkpoint_lock = Lock("CheckpointLock")
+        self.writer = WriteBehind(self)
         if reset:
-            self._reset(path, fsid)
+            self._reset(path, fsid, case_insensitive)
         else:
+            # case_insensitive is fixed when the fs is created
             self._init(path)
         # XXX Note shelve DB is still open
 
-    def _reset(self, path, fsid):
+    def _reset(self, path, fsid, case_insensitive=False):
         """Create an empty fs, overwriting all existing data."""
         # Check path exists
         if not os.path.exists(path):
@@ -952,10 +2505,13 @@ class StubFS_Disk(FileSystem):
         # This needs to be open before calling __init__
         d = self._fs_data = shelve.open(os.path.join(path, self._fs_data_name),
                                         "n")
-        d["_nextid"] = self._nextid
+        self._log = MetaLog(path, 0)
+        self._id_alloc = IdAllocator(self._id_mark, self.id_batch,
+                                     self._save_id_mark)
         # normal __init__
-        FileSystem.__init__(self)
+        FileSystem.__init__(self, objclass=JournalObj)
         self.fsid = (3, fsid)
+        self.fattr4_case_insensitive = case_insensitive
         self.sync(self.root, FILE_SYNC4)
         # Write persistent fs data
         d["root"] = self.root.id
@@ -974,97 +2530,920 @@ class StubFS_Disk(FileSystem):
         d = self._fs_data = shelve.open(os.path.join(path, self._fs_data_name),
                                         "w") # w needed for later allocation
         # Do __init__ portion that is needed
-        self.objclass = FSObject
+        self.objclass = JournalObj
         self._disk_lock = Lock("FSLock(Disk)")
         self.read_only = False
-        self._ids = {} # {obj.id: obj}
+        self._init_cache()
 
         # Copy persistent data
         self._fs_data = d
         for attr in d:
             setattr(self, attr, d[attr])
 
+        self._recover()
         # Read in root data
         self.root = self.find(d["root"])
 
-    def find_on_disk(self, id):
-        fd = open(os.path.join(self.path, "m_%i" % id), "r")
-        # BUG - need to trap for file not found error
-        meta = pickle.load(fd)
+    def _recover(self):
+        """Rebuild the metadata tables from the checkpoint and logs"""
+        gen = 0
+        path = os.path.join(self.path, self._checkpoint_name)
+        if os.path.exists(path):
+            fd = open(path, "rb")
+            saved = pickle.load(fd)
+            fd.close()
+            gen = saved["gen"]
+            self._meta = saved["meta"]
+            self._entries = saved["entries"]
+            self._id_mark = max(self._id_mark, saved.get("id_mark", 1))
+        elif not os.path.exists(MetaLog.log_path(self.path, 0)):
+            # Written by an older version, with a pickle per object
+            self._import_pickles()
+        while True:
+            self._replay(gen)
+            if not os.path.exists(MetaLog.log_path(self.path, gen + 1)):
+                break
+            gen += 1
+        self._log = MetaLog(self.path, gen)
+        if self._meta:
+            # Covers ids from an older version, which did not log a mark
+            self._id_mark = max(self._id_mark, max(self._meta) + 1)
+        self._id_alloc = IdAllocator(self._id_mark, self.id_batch,
+                                     self._save_id_mark)
+
+    def _replay(self, gen):
+        path = MetaLog.log_path(self.path, gen)
+        if not os.path.exists(path):
+            return
+        fd = open(path, "rb")
+        data = fd.read()
         fd.close()
+        end = 0
+        for kind, body, end in MetaLog.records(data):
+            if kind == LOG_META:
+                id = _meta_struct.unpack_from(body)[0]
+                self._meta[id] = body
+                type = struct.unpack_from("!I", body, _type_offset)[0]
+                if type == NF4DIR and id not in self._entries:
+                    self._entries[id] = DirIndex()
+            elif kind == LOG_LINK:
+                dir, id = _link_struct.unpack_from(body)
+                name = body[_link_struct.size:]
+                self._entries.setdefault(dir, DirIndex())[name] = id
+            elif kind == LOG_UNLINK:
+                dir = _unlink_struct.unpack_from(body)[0]
+                name = body[_unlink_struct.size:]
+                entries = self._entries.get(dir)
+                if entries is not None and name in entries:
+                    del entries[name]
+            elif kind == LOG_ID_MARK:
+                mark = _mark_struct.unpack_from(body)[0]
+                self._id_mark = max(self._id_mark, mark)
+        if end < len(data):
+            log_fs.warning("Dropping %i bytes of torn records from %s" %
+                           (len(data) - end, path))
+            fd = open(path, "r+b")
+            fd.truncate(end)
+            fd.close()
+
+    def _import_pickles(self):
+        """Load the m_<id> and dir d_<id> files of an older version"""
+        old = []
+        for name in os.listdir(self.path):
+            if not name.startswith("m_"):
+                continue
+            id = int(name[2:])
+            path = os.path.join(self.path, name)
+            old.append(path)
+            fd = open(path, "rb")
+            data = fd.read()
+            fd.close()
+            if not data:
+                continue # Allocated, but never synced
+            meta = pickle.loads(data)
+            self._meta[id] = _pack_meta(id, meta)
+            if meta.type == NF4DIR:
+                path = self.data_path(id)
+                old.append(path)
+                fd = open(path, "rb")
+                entries = pickle.load(fd)
+                fd.close()
+                if not isinstance(entries, DirIndex):
+                    entries = DirIndex(entries)
+                self._entries[id] = entries
+        if old:
+            with self._tables_lock:
+                data = self._snapshot(0)
+            self._write_checkpoint(data)
+            for path in old:
+                os.remove(path)
+
+    def data_path(self, id):
+        return os.path.join(self.path, "d_%i" % id)
+
+    def open_data(self, id):
+        return CachedFile(self, self.data_path(id))
+
+    def attach_to_server(self, server):
+        self.page_cache = server.page_cache
+
+    def find_on_disk(self, id):
+        id, meta = _unpack_meta(self._meta[id])
         obj = self.objclass(self, id, meta)
+        obj._logged_meta = self._meta[id] # So writing back is free
         if obj.type == NF4REG:
-            fd = open(os.path.join(self.path, "d_%i" % id), "r")
-            obj.file = StringIO(fd.read())
-            fd.close()
+            obj.file = self.open_data(id)
         elif obj.type == NF4DIR:
-            fd = open(os.path.join(self.path, "d_%i" % id), "r")
-            obj.entries = pickle.load(fd)
-            fd.close()
+            # Under _disk_lock, so leave adding to _entries to log_meta()
+            obj.entries = self._entries.get(id)
+            if obj.entries is None:
+                obj.entries = DirIndex()
         return obj
 
     def alloc_id(self):
         """Alloc disk space for an FSObject, and return an identifier
         that will allow us to find the disk space later.
         """
-        self._disk_lock.acquire()
-        try:
-            # Get id
-            self._nextid += 1
-            id = self._nextid
-            self._fs_data["_nextid"] = id
-            self._fs_data.sync()
-            # Create meta-data file
-            fd = open(os.path.join(self.path, "m_%i" % id), "w")
-            fd.close()
-            # Create data file
-            # fd = open(os.path.join(self.path, "d_%i" % id), "w")
-            # fd.close()
-        finally:
-            self._disk_lock.release()
-        return id
+        # Nothing is written until the object is logged
+        return self._id_alloc.alloc()
+
+    def _save_id_mark(self, mark):
+        """Make the IdAllocator's new high-water mark stable"""
+        # Set first, so a checkpoint rotating away the record has it
+        self._id_mark = mark
+        self._log.commit(self._log.append(LOG_ID_MARK,
+                                          _mark_struct.pack(mark)))
 
     def dealloc_id(self, id):
         """Free up disk space associated with id. """
-        self._disk_lock.acquire()
+        with self._tables_lock:
+            self._meta.pop(id, None)
+            self._entries.pop(id, None)
+        data = self.data_path(id)
+        if os.path.isfile(data):
+            os.remove(data)
+
+    def log_meta(self, obj):
+        """Record obj.meta in the log, if it has changed"""
+        packed = _pack_meta(obj.id, obj.meta)
+        if packed != getattr(obj, "_logged_meta", None):
+            with self._tables_lock:
+                if obj.type == NF4DIR:
+                    self._entries[obj.id] = obj.entries
+                self._meta[obj.id] = packed
+            obj._log_seq = self._log.append(LOG_META, packed)
+            obj._logged_meta = packed
+
+    def log_link(self, dir, name, obj):
+        """Record that dir has gained an entry name for obj"""
+        self.log_meta(obj)
+        dir._log_seq = self._log.append(LOG_LINK,
+                                        _link_struct.pack(dir.id, obj.id) + name)
+        self.log_meta(dir)
+
+    def log_unlink(self, dir, name, obj):
+        """Record that dir has lost entry name, which was for obj"""
+        dir._log_seq = self._log.append(LOG_UNLINK,
+                                        _unlink_struct.pack(dir.id) + name)
+        if obj is not None:
+            self.log_meta(obj)
+        self.log_meta(dir)
+
+    def sync(self, obj, how):
+        log_fs.log(5, "DISK.sync()")
+        if self.read_only:
+            # Nothing changed, and forked workers share the log
+            return FILE_SYNC4
+        # Each obj has its own data file, so syncs of different objs
+        # need not wait on each other, and the log commits them together.
+        if obj.type == NF4REG:
+            # Data was written in place, it just needs flushing
+            how = obj.file.flush(how)
+        else:
+            how = FILE_SYNC4
+        with obj.size_lock:
+            self.log_meta(obj)
+        if how != UNSTABLE4:
+            self._log.commit(getattr(obj, "_log_seq", 0))
+            if self._log.size > self.checkpoint_size:
+                self.checkpoint()
+        return how
+
+    def _snapshot(self, gen):
+        """Returns pickled tables, for a checkpoint replaying from log gen
+
+        Must hold _tables_lock.  Changes may be in the tables whose
+        records are not yet in the log, and replaying those is harmless.
+        """
+        return pickle.dumps({"gen": gen, "id_mark": self._id_mark,
+                             "meta": self._meta, "entries": self._entries},
+                            pickle.HIGHEST_PROTOCOL)
+
+    def _write_checkpoint(self, data):
+        path = os.path.join(self.path, self._checkpoint_name)
+        fd = open(path + ".tmp", "wb")
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+        fd.close()
+        os.rename(path + ".tmp", path)
+        dirfd = os.open(self.path, os.O_RDONLY)
         try:
-            # Remove meta-data file
-            meta = os.path.join(self.path, "m_%i" % id)
-            if os.path.isfile(meta):
-                os.remove(meta)
-            # Remove data file
-            data = os.path.join(self.path, "d_%i" % id)
-            if os.path.isfile(data):
-                os.remove(data)
+            os.fsync(dirfd)
         finally:
-            self._disk_lock.release()
+            os.close(dirfd)
+
+    def checkpoint(self):
+        """Save the tables, so the logs so far are no longer needed"""
+        if self.read_only:
+            return # Nothing to save, and forked workers share the files
+        if not self._checkpoint_lock.acquire(False):
+            return # Someone else is doing it
+        try:
+            with self._tables_lock:
+                # Forget objects with no links that are not in use
+                dead = [id for id, packed in self._meta.items()
+                        if struct.unpack_from("!i", packed,
+                                              _refcnt_offset)[0] <= 0
+                        and id not in self._live and id != self.root.id]
+                for id in dead:
+                    self._meta.pop(id, None)
+                    self._entries.pop(id, None)
+                old_gen = self._log.gen
+                data = self._log.rotate(self._snapshot)
+            self._write_checkpoint(data)
+            for gen in range(old_gen, self._log.gen):
+                os.remove(MetaLog.log_path(self.path, gen))
+            for id in dead:
+                path = self.data_path(id)
+                if os.path.exists(path):
+                    os.remove(path)
+            log_fs.info("Checkpointed metadata of %i objects" % len(self._meta))
+        finally:
+            self._checkpoint_lock.release()
+
+class StubFS_Mmap(StubFS_Mem):
+    """An in-memory fs, except that file data is kept on disk.
+
+    Each regular file is a sparse file under path, accessed through mmap.
+    Only about map_limit bytes are mapped at once, so memory use does not
+    grow with the amount of data exported.  Contents are lost on restart,
+    so path must be empty or missing, unless reset is set to clear it.
+    """
+    window_size = 1 << 20 # Must be a multiple of mmap.ALLOCATIONGRANULARITY
+    on_disk = True
+
+    def __init__(self, fsid, path, reset=False, map_limit=64 << 20,
+                 case_insensitive=False):
+        if reset and os.path.exists(path):
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        elif os.listdir(path):
+            # Ids start over, so old data files would show up in new files
+            raise RuntimeError("%s is not empty, try using '--reset' option"
+                               % path)
+        self.path = path
+        self.map_limit = map_limit
+        self.mapped = 0 # Bytes currently mapped
+        self._windows = collections.OrderedDict() # {(file, index): mmap}
+        self._map_lock = Lock("MapLock")
+        self.writer = WriteBehind(self)
+        self._id_alloc = IdAllocator()
+        FileSystem.__init__(self, objclass=DiskObj)
+        self.fsid = (5, fsid)
+        self.fattr4_case_insensitive = case_insensitive
+
+    def data_path(self, id):
+        return os.path.join(self.path, "d_%i" % id)
+
+    def open_data(self, id):
+        return MmapFile(self, self.data_path(id))
+
+    def map_window(self, file, index):
+        """Returns mmap of window index of file"""
+        key = (file, index)
+        with self._map_lock:
+            window = self._windows.pop(key, None)
+            if window is None:
+                offset, length = file.extent(index)
+                window = mmap.mmap(file.fileno(), length, offset=offset)
+                self.mapped += length
+                while self.mapped > self.map_limit and self._windows:
+                    # Replies may still reference the mapping, so leave
+                    # the unmap to garbage collection
+                    old_key, old = self._windows.popitem(last=False)
+                    self.mapped -= len(old)
+            self._windows[key] = window
+            return window
+
+    def unmap_window(self, file, index=None):
+        """Forget window index of file, or all its windows if index is None"""
+        with self._map_lock:
+            if index is None:
+                keys = [k for k in self._windows if k[0] is file]
+            else:
+                keys = [(file, index)]
+            for key in keys:
+                window = self._windows.pop(key, None)
+                if window is not None:
+                    self.mapped -= len(window)
 
     def sync(self, obj, how):
-        log_fs.log(5, "DISK.sync()")
-        id = obj.id
-        self._disk_lock.acquire()
+        if obj.type != NF4REG:
+            return FILE_SYNC4
+        return obj.file.flush(how)
+
+class PassthroughFile(DiskFile):
+    """A DiskFile onto an existing file, which it never creates"""
+    def _open(self):
         try:
-            # Create meta-data file
-            log_fs.debug("writing metadata for id=%i" % id)
-            fd = open(os.path.join(self.path, "m_%i" % id), "w")
-            log_fs.debug("%r" % obj.meta.__dict__)
-            pickle.dump(obj.meta, fd)
-            fd.close()
-            if obj.type == NF4REG:
-                # Create data file
-                fd = open(os.path.join(self.path, "d_%i" % id), "w")
-                obj.file.seek(0)
-                fd.write(obj.file.read())
-                fd.close()
-            elif obj.type == NF4DIR:
-                # Create dir entries
-                log_fs.debug("writing dir %r" % obj.entries.keys())
-                fd = open(os.path.join(self.path, "d_%i" % id), "w")
-                pickle.dump(obj.entries, fd)
-                fd.close()
+            return os.open(self.path, os.O_RDWR | os.O_NOFOLLOW)
+        except OSError, e:
+            if e.errno not in (errno.EACCES, errno.EROFS, errno.ETXTBSY):
+                raise
+            # Reads can still be served
+            return os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)
+
+_errno_map = {
+    errno.EPERM: NFS4ERR_PERM,
+    errno.ENOENT: NFS4ERR_NOENT,
+    errno.ENXIO: NFS4ERR_NXIO,
+    errno.EACCES: NFS4ERR_ACCESS,
+    errno.EEXIST: NFS4ERR_EXIST,
+    errno.EXDEV: NFS4ERR_XDEV,
+    errno.ENOTDIR: NFS4ERR_NOTDIR,
+    errno.EISDIR: NFS4ERR_ISDIR,
+    errno.EINVAL: NFS4ERR_INVAL,
+    errno.EFBIG: NFS4ERR_FBIG,
+    errno.ENOSPC: NFS4ERR_NOSPC,
+    errno.EROFS: NFS4ERR_ROFS,
+    errno.EMLINK: NFS4ERR_MLINK,
+    errno.ENAMETOOLONG: NFS4ERR_NAMETOOLONG,
+    errno.ENOTEMPTY: NFS4ERR_NOTEMPTY,
+    errno.EDQUOT: NFS4ERR_DQUOT,
+    errno.ESTALE: NFS4ERR_STALE,
+    errno.ELOOP: NFS4ERR_SYMLINK,
+    }
+
+def _oscall(funct, *args):
+    """Returns funct(*args), turning any OSError into an NFS4Error"""
+    try:
+        return funct(*args)
+    except OSError, e:
+        raise NFS4Error(_errno_map.get(e.errno, NFS4ERR_IO), tag=str(e))
+
+_ftypes = {stat.S_IFREG: NF4REG, stat.S_IFDIR: NF4DIR, stat.S_IFLNK: NF4LNK,
+           stat.S_IFBLK: NF4BLK, stat.S_IFCHR: NF4CHR,
+           stat.S_IFSOCK: NF4SOCK, stat.S_IFIFO: NF4FIFO}
+_fmodes = dict((v, k) for k, v in _ftypes.items())
+
+def _ftype(mode):
+    return _ftypes.get(stat.S_IFMT(mode), NF4REG)
+
+def _unix_time(value):
+    """Convert a settime4 to time.time() format"""
+    if value.set_it == SET_TO_CLIENT_TIME4:
+        return value.time.seconds + value.time.nseconds / 1e9
+    return time.time()
+
+class PassthroughObj(FSObject):
+    """An FSObject standing for a file in a PassthroughFS.
+
+    The meta is refreshed from os.lstat() of path once it is more than
+    fs.attr_timeout seconds old, or after we change the file ourselves.
+    change is made from the ctime, with a count of our own changes in
+    the low bits, so that it still moves when the ctime is too coarse
+    to show them.
+    """
+    cache_names = False # The tree can change behind our back
+
+    isempty = property(lambda s: not _oscall(os.listdir, s.path))
+
+    def __init__(self, fs, id, path, st, parent=None):
+        meta = MetaData()
+        meta.parent = parent
+        FSObject.__init__(self, fs, id, meta)
+        self.path = path
+        self.gone = False # Set once the file is found to be deleted
+        self._size = 0
+        self._ctime = None
+        self._bumps = 0 # Our changes since the ctime last moved
+        self._entries_key = None # self.change when entries were read
+        if stat.S_ISREG(st.st_mode):
+            self.file = PassthroughFile(path)
+        else:
+            self.file = StringFile()
+        self.entries = DirIndex() # {name: inode}, filled in by readdir
+        self._checked = 0 # When the meta was last refreshed
+        self.revalidate(st)
+
+    def __getattr__(self, name):
+        # Note only get here if self.name does not exist
+        if "_checked" in self.__dict__:
+            self.revalidate()
+        return getattr(self.meta, name)
+
+    def revalidate(self, st=None):
+        """Refresh the meta from st, or from disk if it is out of date"""
+        now = time.time()
+        if st is None:
+            if self.gone or now < self._checked + self.fs.attr_timeout:
+                return
+            st = self._lstat()
+            if st is None:
+                self.gone = True
+                self.meta.refcnt = 0
+                return
+        self._checked = now
+        meta = self.meta
+        meta.type = _ftype(st.st_mode)
+        meta.mode = stat.S_IMODE(st.st_mode)
+        meta.refcnt = st.st_nlink
+        meta.owner = self.fs.owner_name(st.st_uid)
+        meta.time_access = nfs4lib.get_nfstime(st.st_atime)
+        meta.time_modify = nfs4lib.get_nfstime(st.st_mtime)
+        self._size = st.st_size
+        ctime = int(st.st_ctime * 1000000)
+        if ctime != self._ctime:
+            self._ctime = ctime
+            self._bumps = 0
+        meta.change = (ctime << 8) | min(self._bumps, 255)
+        if meta.type == NF4LNK and meta.linkdata is None:
+            meta.linkdata = _oscall(os.readlink, self.path)
+        elif meta.type in (NF4BLK, NF4CHR):
+            meta.devdata = specdata4(os.major(st.st_rdev),
+                                     os.minor(st.st_rdev))
+
+    def _lstat(self):
+        """Returns os.lstat() of the file, looking for it if it has moved"""
+        try:
+            st = os.lstat(self.path)
+            if st.st_ino == self.id:
+                return st
+        except OSError:
+            pass
+        path = self.fs.locate(self.id, self.meta.parent)
+        if path is None:
+            return None
+        if stat.S_ISDIR(os.lstat(path).st_mode):
+            self.fs.moved(self.path, path)
+        else:
+            self.set_path(path)
+        return os.lstat(path)
+
+    def set_path(self, path):
+        self.path = path
+        if isinstance(self.file, PassthroughFile):
+            self.file.path = path # Any open fd stays valid
+        with self.fs._disk_lock:
+            self.fs._remember_path(self.id, path)
+
+    def change_data(self):
+        self._bumps += 1
+        self._checked = 0 # Make next access look at the disk
+        self._entries_key = None
+
+    change_meta = change_data
+
+    def change_access(self):
+        pass
+
+    def _getsize_locked(self):
+        if self.type == NF4REG and self.file._fd is not None:
+            # Our own writes may be newer than the last lstat()
+            return self.file.size()
+        return self._size
+
+    def _setsize_locked(self, value):
+        _oscall(FSObject._setsize_locked, self, value)
+
+    def _setmode(self, value):
+        if self.type != NF4LNK: # chmod would follow the link
+            value &= 07777 & ~(stat.S_ISUID | stat.S_ISGID)
+            _oscall(os.chmod, self.path, value)
+
+    def _set_owner(self, value):
+        if self.fs.owner_id(value) != _oscall(os.lstat, self.path).st_uid:
+            raise NFS4Error(NFS4ERR_PERM, tag="Cannot change owner")
+
+    def _set_times(self, atime=None, mtime=None):
+        if self.type == NF4LNK: # utime would follow the link
+            return
+        st = _oscall(os.lstat, self.path)
+        times = (st.st_atime if atime is None else _unix_time(atime),
+                 st.st_mtime if mtime is None else _unix_time(mtime))
+        _oscall(os.utime, self.path, times)
+
+    def _set_time_access(self, value):
+        self._set_times(atime=value)
+
+    def _set_time_modify(self, value):
+        self._set_times(mtime=value)
+
+    fattr4_owner = property(lambda s: s.owner, _set_owner)
+    fattr4_time_access_set = property(lambda s: s.time_access, _set_time_access)
+    fattr4_time_modify_set = property(lambda s: s.time_modify, _set_time_modify)
+    fattr4_mode = property(lambda s: s.mode, _setmode)
+
+    def close(self):
+        FSObject.close(self)
+        if self.type == NF4REG:
+            # Don't hold an fd for every file ever opened, but wait
+            # for any I/O still using it
+            self.size_lock.acquire_write()
+            try:
+                self.file.close()
+            finally:
+                self.size_lock.release()
+
+    def write(self, data, offset, principal): # NF4REG only
+        return _oscall(FSObject.write, self, data, offset, principal)
+
+    def read(self, offset, count, principal): # NF4REG only
+        return _oscall(FSObject.read, self, offset, count, principal)
+
+    def seek(self, offset, what, principal): # NF4REG only
+        return _oscall(FSObject.seek, self, offset, what, principal)
+
+    def allocate(self, offset, length, principal): # NF4REG only
+        return _oscall(FSObject.allocate, self, offset, length, principal)
+
+    def deallocate(self, offset, length, principal): # NF4REG only
+        return _oscall(FSObject.deallocate, self, offset, length, principal)
+
+    def destroy(self):
+        FSObject.destroy(self)
+        self.file.close()
+        self.fs.forget(self)
+
+    def evict(self):
+        if self.type == NF4REG:
+            # It may still be in use, so wait for any I/O
+            self.size_lock.acquire_write()
+            try:
+                self.file.close()
+            finally:
+                self.size_lock.release()
+
+    #######################
+    # These all assume is a directory
+    #######################
+    def _join(self, name):
+        if name in (".", ".."):
+            raise NFS4Error(NFS4ERR_BADNAME)
+        if "\0" in name:
+            raise NFS4Error(NFS4ERR_BADCHAR)
+        return os.path.join(self.path, name)
+
+    def exists(self, name):
+        return os.path.lexists(self._join(name))
+
+    def entry_name(self, name):
+        return (name if self.exists(name) else None)
+
+    def lookup(self, name, client, principal, follow_mount=True):
+        """Returns object associated with name in the dir, following mounts."""
+        log_o.log(5, "PassthroughObj.lookup(%r, %r)" % (name, principal))
+        if self.type != NF4DIR:
+            raise RuntimeError("Bad type %i" % self.type)
+        if not self.access4_lookup(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        obj = self.fs.find_path(self._join(name), self)
+        if obj is not None and follow_mount:
+            while obj.covered_by is not None:
+                # Directory is hidden by a mount
+                obj = obj.covered_by
+        return obj
+
+    def link(self, name, obj, principal):
+        """Adds obj to the dir as name"""
+        log_o.log(5, "PassthroughObj.link(%r)" % name)
+        if not self.access4_extend(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        _oscall(os.link, obj.path, self._join(name))
+        self.change_data()
+        obj.change_meta()
+
+    def unlink(self, name, principal): # NF4DIR only
+        """Removes name from directory"""
+        log_o.log(5, "PassthroughObj(id=%i).unlink(%r)" % (self.id, name))
+        if not self.access4_delete(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        path = self._join(name)
+        st = _oscall(os.lstat, path)
+        if stat.S_ISDIR(st.st_mode):
+            _oscall(os.rmdir, path)
+        else:
+            _oscall(os.unlink, path)
+        self.change_data()
+        obj = self.fs._live.get(st.st_ino)
+        if obj is not None:
+            obj.change_meta()
+            if st.st_nlink <= 1 or stat.S_ISDIR(st.st_mode):
+                # No need to search for another link
+                obj.gone = True
+                obj.meta.refcnt = 0
+
+    def move(self, newname, olddir, oldname, obj, principal):
+        """Move obj, called oldname in olddir, into the dir as newname"""
+        if not (self.access4_extend(principal) and
+                olddir.access4_delete(principal)):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        old, new = olddir._join(oldname), self._join(newname)
+        _oscall(os.rename, old, new)
+        if obj.isdir:
+            self.fs.moved(old, new)
+            obj.meta.parent = self.id
+        else:
+            obj.set_path(new)
+        olddir.change_data()
+        self.change_data()
+        obj.change_meta()
+
+    def readdir(self, cookie, verifier, client, principal):
+        """Returns (iterator, verifier)
+
+        The entries are reread from disk if the dir has changed, keeping
+        the cookies of names that are still there.
+        """
+        log_o.log(5, "PassthroughObj.readdir()")
+        if not self.access4_read(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        # Rereading the entries changes the dir's size
+        self.size_lock.acquire_write()
+        try:
+            self._read_entries()
         finally:
-            self._disk_lock.release()
-        return FILE_SYNC4
+            self.size_lock.release()
+        entries = self.entries
+        if cookie != 0 and verifier != entries.verifier:
+            raise NFS4Error(NFS4ERR_NOT_SAME)
+        if not entries.valid_cookie(cookie):
+            raise NFS4Error(NFS4ERR_BAD_COOKIE)
+        def objects():
+            for c, name, id in entries.iter_from(cookie):
+                obj = self.fs.find_path(os.path.join(self.path, name), self)
+                if obj is not None:
+                    yield c, name, obj
+        return objects(), entries.verifier
+
+    def _read_entries(self):
+        if self.change == self._entries_key:
+            return
+        key = self.change
+        names = _oscall(os.listdir, self.path)
+        entries = self.entries
+        for name in set(entries).difference(names):
+            del entries[name]
+        for name in sorted(names):
+            if name in entries:
+                continue
+            try:
+                st = os.lstat(os.path.join(self.path, name))
+            except OSError:
+                continue # Already gone
+            if st.st_dev == self.fs.dev: # Other devices are not exported
+                entries[name] = st.st_ino
+        self._entries_key = key
+
+    def create(self, name, principal, kind, attrs):
+        """Create and link a new object into the dir
+
+        kind can be either an int (from enum nfs_ftype4) or a createtype4
+        attrs is a dictionary of {bitnum: attr_value}
+        """
+        log_o.log(5, "PassthroughObj.create(%r, %r)" % (name, principal))
+        if not self.access4_extend(principal):
+            raise NFS4Error(NFS4ERR_ACCESS)
+        if self.fs.read_only and not principal.skip_checks:
+            raise NFS4Error(NFS4ERR_ROFS, tag="fs.create failed")
+        path = self._join(name)
+        ftype = (kind if type(kind) is int else kind.type)
+        if ftype == NF4DIR:
+            _oscall(os.mkdir, path, 0777)
+        elif ftype == NF4REG:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            os.close(_oscall(os.open, path, flags, 0666))
+        elif ftype == NF4LNK:
+            _oscall(os.symlink, kind.linkdata, path)
+        elif ftype in (NF4SOCK, NF4FIFO):
+            _oscall(os.mknod, path, 0666 | _fmodes[ftype])
+        else:
+            # Device nodes would give clients the server's access to them
+            raise NFS4Error(NFS4ERR_BADTYPE)
+        self.change_data()
+        obj = self.fs.find_path(path, self)
+        if obj is None:
+            raise NFS4Error(NFS4ERR_NOENT, tag="removed while creating")
+        bitmask = obj.set_attrs(attrs)
+        return obj, bitmask
+
+class PassthroughFS(FileSystem):
+    """Exports an existing local directory tree.
+
+    Objects are identified by inode number, so filehandles survive
+    renames and server restarts.  Attributes come from os.lstat(), and
+    file data is read and written in place.  Changes made by local
+    processes show up within attr_timeout seconds.  Subtrees on other
+    devices are hidden.
+
+    Inode numbers are reused after a file is deleted, so without the
+    inode generation number a handle to the old file may find the new one.
+    A handle is found again through the last known path of its inode, or
+    of its parent dir, of which path_cache_size are kept.  Files moved
+    to another dir by local processes go stale.
+
+    Everything runs as the server's own user, and callers are not mapped
+    to local accounts.  So the export is read-only unless asked otherwise,
+    and even then setuid/setgid bits, device nodes and ownership changes
+    are refused.
+    """
+    on_disk = True
+
+    def __init__(self, fsid, path, attr_timeout=1.0, read_only=True,
+                 cache_size=4096, path_cache_size=65536):
+        self.path = os.path.abspath(path)
+        st = os.lstat(self.path)
+        if not stat.S_ISDIR(st.st_mode):
+            raise RuntimeError("%s is not a directory" % path)
+        self.dev = st.st_dev
+        self.attr_timeout = attr_timeout
+        # Do __init__ portion that is needed
+        self.fsid = (6, fsid)
+        self.objclass = PassthroughObj
+        self._disk_lock = Lock("FSLock(Passthrough)")
+        self.writer = WriteBehind(self)
+        self.read_only = read_only
+        self._init_cache(cache_size)
+        self.root_id = st.st_ino
+        self.path_cache_size = path_cache_size
+        # {inode: last known path}, oldest first
+        self._paths = collections.OrderedDict([(st.st_ino, self.path)])
+        self._owners = {} # {uid: name}
+        self._set_fattrs()
+        self.mounted_on = None
+        self.root = self.find(st.st_ino)
+
+    def _set_fattrs(self):
+        FileSystem._set_fattrs(self)
+        self.fattr4_link_support = True
+        self.fattr4_symlink_support = True
+        self.fattr4_maxname = os.pathconf(self.path, "PC_NAME_MAX")
+
+    def find(self, id):
+        obj = FileSystem.find(self, id)
+        obj.revalidate()
+        if obj.gone:
+            self.forget(obj)
+            raise NFS4Error(NFS4ERR_STALE)
+        return obj
+
+    def find_on_disk(self, id):
+        path = self._paths.get(id)
+        try:
+            st = os.lstat(path)
+        except (OSError, TypeError):
+            st = None
+        if st is None or st.st_ino != id or st.st_dev != self.dev:
+            # Without the parent there is nowhere left to look
+            raise NFS4Error(NFS4ERR_STALE)
+        return self.objclass(self, id, path, st, self._parent_id(path))
+
+    def find_path(self, path, parent=None):
+        """Returns the object at path, or None if there is none"""
+        try:
+            st = os.lstat(path)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+        if st.st_dev != self.dev:
+            return None
+        id = st.st_ino
+        with self._disk_lock:
+            if parent is None:
+                parent = self._parent_id(path)
+            else:
+                parent = parent.id
+            obj = self._find_cached(id)
+            new = (obj is None or obj.gone or
+                   obj.meta.type != _ftype(st.st_mode))
+            if new:
+                # Not seen before, or the inode has been reused
+                obj = self.objclass(self, id, path, st, parent)
+                self._remember_path(id, path)
+                self._cache_insert(obj)
+        self._finish_evictions()
+        if new:
+            return obj
+        if obj.path != path:
+            if obj.isdir:
+                # Renamed by someone else
+                self.moved(obj.path, path)
+            else:
+                # Just use the latest of its links
+                obj.set_path(path)
+        obj.meta.parent = parent
+        obj.revalidate(st)
+        return obj
+
+    def _parent_id(self, path):
+        """Must hold _disk_lock"""
+        if path == self.path:
+            return None
+        dir = os.path.dirname(path)
+        id = os.lstat(dir).st_ino
+        self._remember_path(id, dir)
+        return id
+
+    def _remember_path(self, id, path):
+        """Record path as the last known path of inode id, forgetting the
+        oldest others not in _ids once there are over path_cache_size.
+        Must hold _disk_lock.
+        """
+        paths = self._paths
+        paths.pop(id, None)
+        paths[id] = path
+        excess = len(paths) - self.path_cache_size
+        budget = len(paths) # If all are in use, give up
+        while excess > 0 and budget:
+            budget -= 1
+            old, old_path = paths.popitem(last=False)
+            if old in self._live or old == self.root_id:
+                paths[old] = old_path # In use, so move to the back
+            else:
+                excess -= 1
+
+    def locate(self, id, parent):
+        """Returns a path to inode id found in dir parent, or None
+
+        Only the last known parent is searched, as walking the tree for
+        every stale handle would let clients keep the server busy.
+        """
+        dir = self._paths.get(parent)
+        try:
+            if dir is None or os.lstat(dir).st_ino != parent:
+                return None
+            names = os.listdir(dir)
+        except OSError:
+            return None
+        log_fs.info("Searching %s for inode %i" % (dir, id))
+        for name in names:
+            path = os.path.join(dir, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if st.st_ino == id and st.st_dev == self.dev:
+                with self._disk_lock:
+                    self._remember_path(id, path)
+                return path
+        return None
+
+    def moved(self, old, new):
+        """Update the paths of everything at or under old to be under new"""
+        prefix = old + "/"
+        with self._disk_lock:
+            for id, path in self._paths.items():
+                if path == old or path.startswith(prefix):
+                    self._paths[id] = new + path[len(old):]
+        for obj in self._live.values():
+            if obj.path == old or obj.path.startswith(prefix):
+                obj.set_path(new + obj.path[len(old):])
+
+    def forget(self, obj):
+        """Drop a deleted obj"""
+        with self._disk_lock:
+            if self._ids.get(obj.id) is obj:
+                del self._ids[obj.id]
+            if self._live.get(obj.id) is obj:
+                del self._live[obj.id]
+            if self._paths.get(obj.id) == obj.path:
+                del self._paths[obj.id]
+
+    def owner_name(self, uid):
+        name = self._owners.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            self._owners[uid] = name
+        return name
+
+    def owner_id(self, name):
+        if name.isdigit():
+            return int(name)
+        try:
+            return pwd.getpwnam(name.split("@")[0]).pw_uid
+        except KeyError:
+            raise NFS4Error(NFS4ERR_BADOWNER, tag="Unknown owner %r" % name)
+
+    def sync(self, obj, how):
+        if obj.type != NF4REG:
+            return FILE_SYNC4
+        return _oscall(obj.file.flush, how)
 
 ###################################################
 
@@ -1233,8 +3612,7 @@ class LayoutFSObj(FSObject):
     def read(self, offset, count, principal): # NF4REG only
         # STUB - need to acces scsi device - for now just return poison
         return ("poisoned" * (count >> 3))[0:count]
-        self.file.seek(offset)
-        data = self.file.read(count)
+        data = self.file.pread(offset, count)
         self.change_access()
         return data
 
@@ -1272,7 +3650,8 @@ class BlockLayoutFS(FileSystem):
     """
     def __init__(self, fsid, backing_device):
         # STUB - need some way to specify layout
-        self._nextid = 0
+        self._id_alloc = IdAllocator(first=0)
+        self._blocks = ExtentAllocator(first=19)
         FileSystem.__init__(self, objclass=LayoutFSObj)
         self.fsid = (3, fsid)
         self.fattr4_fs_layout_types = [LAYOUT4_BLOCK_VOLUME]
@@ -1285,7 +3664,6 @@ class BlockLayoutFS(FileSystem):
         self.fattr4_supported_attrs |= 1 << FATTR4_MAXREAD
         self.volume = backing_device # of type BlockVolume for now
         self._make_files(backing_device)
-        self._allocated = 19
 
     def _make_files(self, dev):
         # STUB - hard code some test files with various properties
@@ -1331,17 +3709,13 @@ class BlockLayoutFS(FileSystem):
         server.assign_deviceid(self.volume)
 
     def alloc_id(self):
-        rv = self._nextid
-        self._nextid += 1
+        rv = self._id_alloc.alloc()
         if rv > 4:
             test_layout_dict[rv] = []
         return rv
 
     def _alloc_blocks(self, count):
-        # This needs to be lock protected
-        rv = self._allocated
-        self._allocated += count
-        return rv
+        return self._blocks.alloc(count)
 
     def dealloc_id(self, id):
         pass
@@ -1405,7 +3779,7 @@ class FSLayoutFSObj(FSObject):
     def init_file(self):
         self.stripe_size = NFL4_UFLG_STRIPE_UNIT_SIZE_MASK & 0x4000
         if self.fs.dsdevice.mdsds:
-            return StringIO()
+            return StringFile()
         else:
             return FileLayoutFile(self)
 
@@ -1419,7 +3793,7 @@ class FileLayoutFS(FileSystem):
     """Exports a filesystem using a simple file layout pfs protocol
     """
     def __init__(self, fsid, dsdevice):
-        self._nextid = 0
+        self._id_alloc = IdAllocator()
         self.dsdevice = dsdevice
         FileSystem.__init__(self, objclass=FSLayoutFSObj)
         self.fsid = (2, fsid)
@@ -1438,8 +3812,7 @@ class FileLayoutFS(FileSystem):
         """Alloc disk space for an FSObject, and return an identifier
         that will allow us to find the disk space later.
         """
-        self._nextid += 1
-        return self._nextid
+        return self._id_alloc.alloc()
 
     def dealloc_id(self, id):
         """Free up disk space associated with id. """
@@ -1463,44 +3836,23 @@ class FileLayoutFile(object): # XXX This should inherit from fs_base.py
     """Emulate the file object by passing data through MDS to DS"""
     def __init__(self, obj):
         self._size = 0
-        self._pos = 0
         self._obj = obj
 
-    def __len__(self):
+    def size(self):
         self._size = self._query_size()
         return self._size
 
-    def seek(self, offset, whence=0):
-        # Find new pos
-        if whence == 0: # From file start
-            newpos = offset
-        elif whence == 1: # Relative to pos
-            newpos = self._pos + offset
-        elif whence == 2: # Relative to end
-            self._size = self._query_size()
-            newpos = self._size + offset
-        self._pos = newpos
-
-    def tell(self):
-        return self._pos
-
-    def read(self, count=None):
+    def pread(self, offset, count):
         out = []
-        self._size = self._query_size()
-        bytes_to_read = max(0, self._size - self._pos)
-        # Note count < 0 is equiv to count == None
-        if count is not None and count >= 0:
-            bytes_to_read = min(bytes_to_read, count)
+        bytes_to_read = max(0, min(self.size() - offset, count))
         while bytes_to_read:
-            vol, v_pos, length = self._find_extent(self._pos)
+            vol, v_pos, length = self._find_extent(offset)
             limit = min(length, bytes_to_read)
-            vol.seek(v_pos)
-            segment = vol.read(limit)
-            bytes = len(segment)
-            if bytes == 0:
+            segment = vol.pread(v_pos, limit)
+            if not segment:
                 break
             out.append(segment)
-            self._pos += len(segment)
+            offset += len(segment)
             bytes_to_read -= len(segment)
         return ''.join(out)
 
@@ -1514,30 +3866,27 @@ class FileLayoutFile(object): # XXX This should inherit from fs_base.py
     def _create_hole(self, offset, length):
         while length:
             vol, v_pos, v_len = self._find_extent(offset)
-            vol.seek(v_pos)
             v_len = min(v_len, length)
             v_len = min(v_len, 8192) # Don't overwhelm MDS/DS channel limits
-            vol.write('\0' * v_len)
+            vol.pwrite(v_pos, '\0' * v_len)
+            offset += v_len
             length -= v_len
 
-    def write(self, data):
-        self._size = self._query_size()
-        if data and self._pos > self._size:
-            self._create_hole(self._size, self._pos - self._size)
+    def pwrite(self, offset, data):
+        size = self.size()
+        if data and offset > size:
+            self._create_hole(size, offset - size)
         while data:
-            vol, v_pos, length = self._find_extent(self._pos)
+            vol, v_pos, length = self._find_extent(offset)
             length = min(length, 8192) # Don't overwhelm MDS/DS channel limits
-            vol.seek(v_pos)
             segment = data[:length]
             # Need to deal with short writes
-            vol.write(segment)
-            self._pos += len(segment)
+            vol.pwrite(v_pos, segment)
+            offset += len(segment)
             data = data[length:]
-        self._size = max(self._size, self._pos)
+        self._size = max(self._size, offset)
 
-    def truncate(self, size=None):
-        if size is None:
-            size = self._pos
+    def truncate(self, size):
         self._size = size
         device = self._obj.fs.dsdevice
         for vol in device.list:
@@ -1562,19 +3911,12 @@ class FilelayoutVolWrapper(object):
         self._obj = obj
         self._ds = dataserver
         self._fh = dataserver.filehandles[obj.fh][0]
-        self._pos = 0
-
-    def read(self, count):
-        data = self._ds.read(self._fh, self._pos, count)
-        self._pos += len(data)
-        return data
 
-    def seek(self, offset):
-        self._pos = offset
+    def pread(self, offset, count):
+        return self._ds.read(self._fh, offset, count)
 
-    def write(self, data):
-        self._ds.write(self._fh, self._pos, data)
-        self._pos += len(data)
+    def pwrite(self, offset, data):
+        self._ds.write(self._fh, offset, data)
 
     def truncate(self, size):
         self._ds.truncate(self._fh, size)
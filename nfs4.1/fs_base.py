@@ -1,3 +1,5 @@
+import threading
+
 # These are the extent types
 # HOLE - no disk mapping, read returns 0's
 # VALID - mapped to disk and initialized
@@ -15,7 +17,12 @@ class Extent(object):
         self.volume = volume
 
 class LayoutFile(object):
-    """A file-like object"""
+    """A file-like object
+
+    pread() and pwrite() take the offset, so need not share a position.
+    The volumes are python files, whose seek+read/write is done under
+    _lock.  seek(), read() and write() work on top of them, as for a file.
+    """
     def __init__(self, inode, fs, size=None):
         # inode is identifier that fs assigns this object
         if size is None:
@@ -27,6 +34,10 @@ class LayoutFile(object):
         self._pos = 0
         self._fs = fs
         self._inode = inode
+        self._lock = threading.Lock()
+
+    def size(self):
+        return self._size
 
     def seek(self, offset, whence=0):
         # Find new pos
@@ -46,43 +57,54 @@ class LayoutFile(object):
         return self._pos
 
     def read(self, count=None):
+        if count is None or count < 0:
+            count = self._size
+        data = self.pread(self._pos, count)
+        self._pos += len(data)
+        return data
+
+    def write(self, str):
+        self.pwrite(self._pos, str)
+        self._pos += len(str)
+
+    def pread(self, offset, count):
         out = []
-        bytes_to_read = max(0, self._size - self._pos)
-        if count is not None and count >= 0:
-            bytes_to_read = min(bytes_to_read, count)
+        bytes_to_read = max(0, min(self._size - offset, count))
         while bytes_to_read:
-            e = self._find_extent(self._pos)
+            e = self._find_extent(offset)
             limit = min(e.length, bytes_to_read)
             if e.type == HOLE:
                 segment = '\0' * limit
             else:
-                e.volume.seek(e.v_pos)
-                segment = e.volume.read(limit)
+                with self._lock:
+                    e.volume.seek(e.v_pos)
+                    segment = e.volume.read(limit)
             out.append(segment)
-            self._pos += len(segment)
+            offset += len(segment)
             bytes_to_read -= len(segment)
         return "".join(out)
 
-    def write(self, str):
+    def pwrite(self, offset, str):
         # Note here we need not check >=, since = results in a nop
-        if str and self._pos > self._size:
-            self._create_hole(self._size, self._pos - self._size)
+        if str and offset > self._size:
+            self._create_hole(self._size, offset - self._size)
         while str:
-            e = self._find_extent(self._pos)
+            e = self._find_extent(offset)
             if e.type == EOF:
                 # Cause next _find_extent to return initialized valid extent
-                self._map_extent(self._pos, len(str))
+                self._map_extent(offset, len(str))
             elif e.type == HOLE:
                 # Cause next _find_extent to return initialized valid extent
-                self._map_extent(self._pos, min(e.length, len(str)))
+                self._map_extent(offset, min(e.length, len(str)))
                 continue
-            e.volume.seek(e.v_pos)
             segment = str[:e.length]
-            e.volume.write(segment)
-            self._pos += len(segment)
+            with self._lock:
+                e.volume.seek(e.v_pos)
+                e.volume.write(segment)
+            offset += len(segment)
             str = str[e.length:]
-        if self._pos > self._size:
-            self._size = self._pos
+        if offset > self._size:
+            self._size = offset
 
     def _find_extent(self, pos):
         e = self._fs._find_extent(pos, self._inode)
@@ -1,8 +1,36 @@
+"""Locks used by the server, with optional tracing and contention stats.
+
+Lock hierarchy - a thread holding a lock may only wait for one lower down:
+
+    dir      FSObject.lock of a directory, held for write while entries
+             change.  With two dirs (RENAME) take both in sorted order.
+    file     FSObject.lock of a non-dir object.
+    state    FSObject.state (its StateLock), then any stateid lock.
+    flush    DiskFile._flush_lock, held across an fsync of the file.
+    size     FSObject.size_lock, shared by reads and by writes within the
+             file, exclusive to change its size.  Never taken twice by a
+             thread, as a waiting writer blocks new readers.
+    tables   StubFS_Disk._tables_lock, held by a checkpoint while it
+             waits on the MetaLog, so no metadata changes under it.
+    leaf     FileSystem._disk_lock, the locks inside file objects
+             (DiskFile._lock, SparseFile, PageCache...), the MetaLog,
+             and the server table locks (ClientList, Slot, ReplyArena,
+             NameCache...).  Held briefly, never while waiting on another
+             lock.
+
+So COMPOUNDs on different files share no lock outside the leaf level.
+
+Setting DEBUG prints every acquire and release.  Setting PROFILE instead
+counts, for each lock name, how often acquire had to wait and for how
+long; see contention_report().
+"""
 from __future__ import with_statement
 import threading
+import time
 
 
 DEBUG = False # Note this only affects locks at creation 
+PROFILE = False # Note this only affects locks at creation
 
 class Counter(object):
     def __init__(self, first_value=0, name="counter"):
@@ -16,31 +44,85 @@ class Counter(object):
         return out
 
 def Lock(name=""):
-    if DEBUG:
+    if DEBUG or PROFILE:
         return _DebugLock(name)
     else:
         return threading.Lock()
 
 def RWLock(name=""):
-    if DEBUG:
+    if DEBUG or PROFILE:
         return _RWLockVerbose(name)
     else:
         return _RWLock()
 
+class _LockStats(object):
+    """Per lock name: [acquires, waits, wait_time, max_wait, hold_time]"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.data = {}
+
+    def acquired(self, name, waited):
+        with self._lock:
+            d = self.data.get(name)
+            if d is None:
+                d = self.data[name] = [0, 0, 0.0, 0.0, 0.0]
+            d[0] += 1
+            if waited is not None:
+                d[1] += 1
+                d[2] += waited
+                d[3] = max(d[3], waited)
+
+    def released(self, name, held):
+        with self._lock:
+            d = self.data.get(name)
+            if d is not None:
+                d[4] += held
+
+    def clear(self):
+        with self._lock:
+            self.data.clear()
+
+stats = _LockStats()
+
+def contention_report(count=20):
+    """Returns text listing the count most waited on lock names"""
+    with stats._lock:
+        items = [(name, list(d)) for name, d in stats.data.items()]
+    items.sort(key=lambda i: (-i[1][2], -i[1][1], i[0]))
+    lines = ["%-24s %9s %8s %10s %9s %10s" %
+             ("lock", "acquires", "waits", "wait_ms", "max_ms", "held_ms")]
+    for name, (acquires, waits, wait, max_wait, held) in items[:count]:
+        lines.append("%-24s %9i %8i %10.1f %9.2f %10.1f" %
+                     (name[:24], acquires, waits, wait * 1000,
+                      max_wait * 1000, held * 1000))
+    return "\n".join(lines)
+
 def _collect_acq_data(suffix=""):
-    """Debugging decorator for lock acquire"""
+    """Debugging decorator for lock acquire
+
+    The decorated function returns True if it had to wait for the lock.
+    """
     def _deco(acquire):
         def wrapper(self):
             suf = ("" if not suffix else "_%s" % suffix)
-            print "ACQUIRE%s tried for lock %s" % (suf.upper(), self.name)
-            t = threading.currentThread()
-            try:
-                t.locks[self.name] = "waiting%s" % suf
-            except AttributeError:
-                t.locks = {self.name: "waiting%s" % suf}
-            acquire(self)
-            t.locks[self.name] = "holding%s" % suf
-            print "ACQUIRE%s succeeded for lock %s" % (suf.upper(), self.name)
+            if DEBUG:
+                print "ACQUIRE%s tried for lock %s" % (suf.upper(), self.name)
+                t = threading.currentThread()
+                try:
+                    t.locks[self.name] = "waiting%s" % suf
+                except AttributeError:
+                    t.locks = {self.name: "waiting%s" % suf}
+            start = time.time()
+            waited = acquire(self)
+            now = time.time()
+            if suffix != "read":
+                # Only exclusive holds are timed
+                self.acquired_at = now
+            if PROFILE:
+                stats.acquired(self.name, now - start if waited else None)
+            if DEBUG:
+                t.locks[self.name] = "holding%s" % suf
+                print "ACQUIRE%s succeeded for lock %s" % (suf.upper(), self.name)
         return wrapper
     return _deco
 
@@ -49,9 +131,12 @@ def _collect_rel_data(suffix=""):
     def _deco(release):
         def wrapper(self, *args, **kwargs):
             suf = ("" if not suffix else "_%s" % suffix)
-            print "RELEASE%s lock %s" % (suf.upper(), self.name)
-            t = threading.currentThread()
-            t.locks[self.name] = "released%s" % suf
+            if DEBUG:
+                print "RELEASE%s lock %s" % (suf.upper(), self.name)
+                t = threading.currentThread()
+                t.locks[self.name] = "released%s" % suf
+            if PROFILE and suffix != "read":
+                stats.released(self.name, time.time() - self.acquired_at)
             release(self, *args, **kwargs)
         return wrapper
     return _deco
@@ -65,7 +150,10 @@ class _DebugLock(object):
     
     @_collect_acq_data()
     def acquire(self):
+        if self.lock.acquire(False):
+            return False
         self.lock.acquire()
+        return True
 
     __enter__ = acquire
 
@@ -88,27 +176,35 @@ class _RWLock(object):
     # revert to NOPs, while acquire-write should raise error.
     
     def __init__(self):
-        self._cond = threading.Condition()
+        # _mutex is taken directly, as Condition.__enter__ is slower
+        self._mutex = threading.Lock()
+        self._cond = threading.Condition(self._mutex)
         self._write_lock = threading.Lock()
         self._write_count = 0 # Number who *want* or *have* write lock
         self._read_count = 0 # Number who *want* or *have* read lock
         self._read_lock = 0 # Number who *have* read lock
 
     def acquire(self):
-        with self._cond:
+        with self._mutex:
             self._acquire_read()
 
+    # As a context manager, takes the read lock
+    __enter__ = acquire
+
+    def __exit__(self, t, v, tb):
+        self.release()
+
     def acquire_write(self):
         """Acquire write lock.
 
         Note this will deadlock if thread also has a read lock.
         """
-        with self._cond:
+        with self._mutex:
             self._acquire_write()
 
     def release(self):
         """Releases lock, first determining the correct type"""
-        with self._cond:
+        with self._mutex:
             if self._read_lock:
                 self._release_read()
             else:
@@ -116,29 +212,34 @@ class _RWLock(object):
 
     def upgrade(self):
         """Upgrade to write lock, assuming thread has read lock already"""
-        with self._cond:
+        with self._mutex:
             self._release_read(notify=False)
             self._acquire_write()
 
     def downgrade(self):
         """Downgrade to read lock, assuming thread has write lock already"""
-        with self._cond:
+        with self._mutex:
             self._release_write()
             self._acquire_read()
 
     def _acquire_read(self):
+        """Returns True if had to wait"""
+        waited = False
         self._read_count += 1
         while self._write_count > 0:
+            waited = True
             self._cond.wait()
         else:
             self._read_lock += 1
+        return waited
 
     def _release_read(self, notify=True):
         self._read_count -= 1
         self._read_lock -= 1
-        if notify and self._read_lock == 0:
+        if notify and self._read_lock == 0 and self._write_count:
             # We really want to only wake one write thread, but there
-            # might be read threads waiting too.
+            # might be read threads waiting too.  With no writer, no
+            # one is waiting.
             self._cond.notifyAll()
         elif self._read_lock < 0:
             raise ValueError("Unmatched release")
@@ -147,13 +248,18 @@ class _RWLock(object):
         """Acquire write lock.
 
         Note this will deadlock if thread also has a read lock.
+        Returns True if had to wait.
         """
+        waited = False
         self._write_count += 1
         while self._read_lock > 0:
+            waited = True
             self._cond.wait()
         else:
             while not self._write_lock.acquire(False):
+                waited = True
                 self._cond.wait()
+        return waited
 
     def _release_write(self):
         self._write_count -= 1
@@ -178,7 +284,7 @@ class _RWLockVerbose(_RWLock):
 
     @_collect_acq_data("read")
     def _acquire_read(self):
-        super(_RWLockVerbose, self)._acquire_read()
+        return super(_RWLockVerbose, self)._acquire_read()
 
     @_collect_rel_data("read")
     def _release_read(self, *args, **kwargs):
@@ -186,7 +292,7 @@ class _RWLockVerbose(_RWLock):
 
     @_collect_acq_data("write")
     def _acquire_write(self):
-        super(_RWLockVerbose, self)._acquire_write()
+        return super(_RWLockVerbose, self)._acquire_write()
 
     @_collect_rel_data("write")
     def _release_write(self):
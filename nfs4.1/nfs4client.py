@@ -153,11 +153,7 @@ class NFS4Client(rpc.Client, rpc.Server):
             data = p.get_buffer()
             # Stuff the replay cache
             if env.cache is not None:
-                p.reset()
-                p.pack_CB_COMPOUND4res(CB_COMPOUND4res(env.results.cache.status,
-                                                       env.results.cache.tag,
-                                                       env.results.cache.results))
-                env.cache.data = p.get_buffer()
+                env.cache.data = env.results.packed_cache(data)
                 env.cache.valid.set()
         except NFS4Replay, e:
             log_cb.info("Replay...waiting for valid data")
@@ -470,6 +466,7 @@ class SessionRecord(object):
         self.cred = client.cred
         self.fore_channel = SendChannel(csr.csr_fore_chan_attrs)
         self.back_channel = RecvChannel(csr.csr_back_chan_attrs)
+        self.fh_cache = {} # {tuple of path components: fh}
         # STUB - and other stuff
 
     def seq_op(self, slot=None, seq_delta=1, cache_this=False):
@@ -544,6 +541,58 @@ class SessionRecord(object):
         res = self.remove_seq_op(res)
         return res
 
+    def lookup_path(self, path, **kwargs):
+        """Returns the fh of path, a list of components.
+
+        Every dir fh seen along the way is cached, and resolution starts
+        from the parent's fh if known, so repeated lookups under a deep
+        dir cost one LOOKUP each.  The leaf is always sent to the server.
+        If a LOOKUP under a cached fh fails with NOENT or STALE, the cached
+        fhs under that prefix are dropped and the path is looked up again
+        from the root.  Cached fhs are not otherwise revalidated, so a dir
+        moved by another client may still be found at its old path, and
+        callers doing the rename should call forget_path().
+        """
+        path = tuple(path)
+        for retry in (True, False):
+            start, fh = len(path) - 1, None
+            while retry and start > 0:
+                fh = self.fh_cache.get(path[:start])
+                if fh is not None:
+                    break
+                start -= 1
+            if fh is None:
+                start = 0
+                ops = [op4.putrootfh()]
+            else:
+                ops = [op4.putfh(fh)]
+            if not path:
+                ops.append(op4.getfh())
+            for comp in path[start:]:
+                ops += [op4.lookup(comp), op4.getfh()]
+            res = self.compound(ops, **kwargs)
+            if res.status in (NFS4ERR_STALE, NFS4ERR_NOENT) and start \
+                   and retry:
+                self.forget_path(path[:start])
+                continue
+            break
+        done = start
+        for r in res.resarray:
+            if r.resop == OP_GETFH and r.status == NFS4_OK:
+                done += 1
+                fh = r.object
+                if path:
+                    self.fh_cache[path[:done]] = fh
+        nfs4lib.check(res)
+        return fh
+
+    def forget_path(self, path=()):
+        """Drop cached fhs for path and everything under it"""
+        path = tuple(path)
+        for key in self.fh_cache.keys():
+            if key[:len(path)] == path:
+                del self.fh_cache[key]
+
     def update_seq_state(self, res, slot):
         seq_res = res.resarray[0]
         slot.finish_call(seq_res)
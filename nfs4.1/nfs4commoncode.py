@@ -4,6 +4,7 @@
 """
 
 import nfs4lib
+import rpc
 from xdrdef.nfs4_const import *
 import sys
 import xdrdef.nfs4_type, xdrdef.nfs4_const
@@ -48,6 +49,26 @@ def %(encode_status)s_by_name(name, status, *args, **kwargs):
         pass
     raise RuntimeError("Problem with name %%r" %% name)
         
+def %(encode_status)s_encoder(name):
+    """Returns funct(status, *args, **kwargs) equivalent to
+    %(encode_status)s_by_name(name, status, *args, **kwargs),
+    with the lookups done once up front.
+    """
+    name_l = name.lower()
+    name_u = name.upper()
+    res4_class = getattr(xdrdef.nfs4_type, name_u + "4res")
+    opnum = getattr(xdrdef.nfs4_const, "OP_" + name_u)
+    attr = %(mangle)s
+    def encode(status, *args, **kwargs):
+        tag = kwargs.pop("msg", None)
+        result = %(nfs_resop4)s(opnum)
+        setattr(result, attr, res4_class(status, *args, **kwargs))
+        result.status = status # HACK, see %(encode_status)s_by_name
+        if tag:
+            result.tag = tag
+        return result
+    return encode
+
 def %(encode_status)s(status, *args, **kwargs):
     """Called from function op_<name>, encodes the operations response.
 
@@ -82,6 +103,15 @@ class %(CompoundArgResults)s(object):
         self.packed.append(self._p.get_buffer())
         self._base_len += len(self.packed[-1])
 
+    def pop(self):
+        """Remove the last nfs_resop4 added"""
+        self.results.pop()
+        self._base_len -= len(self.packed.pop())
+        if self.results:
+            self.status = self.results[-1].status
+        else:
+            self.status = NFS4_OK
+
     def __getitem__(self, key):
         return self.results[key]
 
@@ -108,9 +138,16 @@ class %(PairedResults)s(object):
         #                         \should be SEQ
         
         # STUB - do size checking on self.reply
-        if self.env.caching or self.env.index == 0:
+        if self.env.caching:
+            # self.cache would just copy self.reply, see packed_cache()
+            limit = self.env.cache_limit
+            if limit is not None and self.reply.size > limit:
+                self.reply.pop()
+                name = %(nfs_opnum4)s[result.resop].lower()[3:]
+                self.reply.append(%(encode_status)s_by_name(name,
+                                  NFS4ERR_REP_TOO_BIG_TO_CACHE))
+        elif self.env.index == 0:
             self.cache.append(result)
-            # STUB - do size checking on self.cache
         elif self.env.index == 1:
             name = %(nfs_opnum4)s[result.resop].lower()[3:]
             res = %(encode_status)s_by_name(name, NFS4ERR_RETRY_UNCACHED_REP)
@@ -118,6 +155,22 @@ class %(PairedResults)s(object):
         else:
             pass
 
+    def packed_cache(self, reply):
+        """Given the XDR encoded reply, return XDR encoding of self.cache"""
+        cache = self.cache
+        if self.env.caching:
+            # Only the tag differs from the reply, so splice it in
+            # rather than encoding all the results again
+            p = nfs4lib.FancyNFS4Packer()
+            p.pack_nfsstat4(self.reply.status)
+            p.pack_utf8str_cs(cache.tag)
+            return p.get_buffer() + reply[4 + nfs4lib.xdrlen(self.reply.tag):]
+        p = nfs4lib.FancyNFS4Packer()
+        p.pack_nfsstat4(cache.status)
+        p.pack_utf8str_cs(cache.tag)
+        p.pack_array(cache.results, p.pack_%(nfs_resop4)s)
+        return p.get_buffer()
+
     def set_empty_return(self, status, tag=None):
         self.reply.status = self.cache.status = status
         if tag is not None:
@@ -143,6 +196,7 @@ class %(CompoundState)s(object):
         self.cid = None # Current stateid
         self.sid = None # Saved stateid
         self.caching = True # Cache the response
+        self.cache_limit = None # Max size of cached response, if caching
         # XXX Do we want a setter funct, since resetting would be bad?
         self.cache = None # Where to cache it, of type Cache
         self.session = None
@@ -166,7 +220,13 @@ class %(CompoundState)s(object):
 
     def get_principal(self, cred):
         """Pull principal from credential"""
-        return nfs4lib.NFS4Principal(cred.credinfo.principal)
+        raw = cred.raw_cred
+        if raw.flavor == rpc.RPCSEC_GSS:
+            # The cred changes every call, but the context handle does not
+            key = (raw.flavor, cred.credinfo.context)
+        else:
+            key = (raw.flavor, getattr(raw, "raw", raw.body))
+        return nfs4lib.principals.lookup(key, cred.credinfo)
 
     def get_sec_triple(self, cred):
         """Pull security triple of (OID, QOP, service) from cred"""
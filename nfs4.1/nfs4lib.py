@@ -2,6 +2,7 @@ from __future__ import with_statement
 import rpc
 import xdrdef.nfs4_const
 from xdrdef.nfs4_pack import NFS4Packer, NFS4Unpacker
+from xdrlib import Error as XDRError
 import xdrdef.nfs4_type
 import nfs_ops
 import time
@@ -10,6 +11,7 @@ import hmac
 import struct
 import random
 import re
+import os
 from locking import Lock
 try:
     from Crypto.Cipher import AES
@@ -204,15 +206,33 @@ class FancyNFS4Packer(NFS4Packer):
             data = dict2fattr(data)
         return data
 
-    def filter_dirlist4(self, data):
-        """Change simple list of entry4 into strange chain structure"""
-        out = []
-        for e in data.entries[::-1]:
-            # print "handle", e
-            # This reverses the direction of the list, so start with reversed
-            out = [xdrdef.nfs4_type.entry4(e.cookie, e.name, e.attrs, out)]
-        # Must not modify original data structure
-        return xdrdef.nfs4_type.dirlist4(out, data.eof)
+    def pack_dirlist4(self, data):
+        """Pack simple list of entry4 as the strange chain structure.
+
+        The generated code recurses for each entry, which overflows the
+        stack for large directories.
+        """
+        for e in data.entries:
+            self.pack_uint(1) # Array of length one holding entry
+            self.pack_nfs_cookie4(e.cookie)
+            self.pack_component4(e.name)
+            self.pack_fattr4(e.attrs)
+        self.pack_uint(0) # Empty array ends chain
+        self.pack_bool(data.eof)
+
+    def pack_READ4resok(self, data):
+        """Write data given as a buffer without first copying to a string.
+
+        StubFS_Mmap returns a buffer onto its file mapping.
+        """
+        if type(data.data) is not buffer:
+            return NFS4Packer.pack_READ4resok(self, data)
+        self.pack_bool(data.eof)
+        size = len(data.data)
+        self.pack_uint(size)
+        out = self._Packer__buf # xdrlib keeps its StringIO private
+        out.write(data.data)
+        out.write("\0" * (-size % 4))
 
 class FancyNFS4Unpacker(NFS4Unpacker):
     def filter_bitmap4(self, data):
@@ -228,19 +248,22 @@ class FancyNFS4Unpacker(NFS4Unpacker):
         """Return as dict, instead of opaque attrlist"""
         return fattr2dict(data)
 
-    def filter_dirlist4(self, data):
+    def unpack_dirlist4(self):
         """Return as simple list, instead of strange chain structure"""
-        chain = data.entries
         list = []
-        while chain:
-            # Pop first entry off chain
-            e = chain[0]
-            chain = e.nextentry
-            # Add to list
+        while True:
+            count = self.unpack_uint()
+            if count == 0:
+                break
+            if count > 1:
+                raise XDRError("array length too long for entry4 chain")
+            e = xdrdef.nfs4_type.entry4()
+            e.cookie = self.unpack_nfs_cookie4()
+            e.name = self.unpack_component4()
+            e.attrs = self.unpack_fattr4()
             e.nextentry = None # XXX Do we really want to do this?
             list.append(e)
-        data.entries = list
-        return data
+        return xdrdef.nfs4_type.dirlist4(list, self.unpack_bool())
             
 def dict2fattr(dict):
     """Convert a dictionary of form {numb:value} to a fattr4 object.
@@ -310,7 +333,12 @@ def str_xor(a, b):
 
 def random_string(size):
     """Returns a random string of given length."""
-    return "".join([chr(random.randint(0, 255)) for i in xrange(size)])
+    return os.urandom(size)
+
+def _xdr_opaque(data):
+    """Returns XDR encoding of opaque<> data, without using a Packer"""
+    pad = (4 - len(data)) & 3
+    return struct.pack('>L', len(data)) + data + '\0' * pad
 
 class SSVContext(object):
     """Holds algorithms and keys needed for SSV encryption and hashing"""
@@ -326,6 +354,7 @@ class SSVContext(object):
         self.local = client # True for client, False for server
         self.ssv_len = hash_funct().digest_size
         self.ssvs = collections.deque()
+        self.macs = collections.deque() # hmac templates, parallel to ssvs
         self.ssv_seq = 0 # This basically counts the number of SET_SSV calls
         self.lock = Lock("ssv")
         # Per draft 26:
@@ -344,9 +373,14 @@ class SSVContext(object):
         """Adds the literal string ssv and its associated subkeys"""
         # Lock held by caller
         keys = [self._subkey(ssv, i) for i in range(5)]
+        # Computing the key schedule is the expensive part of hmac.new(),
+        # so do it once here and just copy() the result for each message.
+        macs = [hmac.new(key, digestmod=self.hash) for key in keys]
         self.ssvs.appendleft(keys)
+        self.macs.appendleft(macs)
         if len(self.ssvs) > self.window:
             self.ssvs.pop()
+            self.macs.pop()
 
     def set_ssv(self, ssv):
         """Handles the state management of SET_SSV call, XORing for new ssv."""
@@ -355,25 +389,31 @@ class SSVContext(object):
             self._add_ssv(new_ssv)
             self.ssv_seq += 1 # draft26 18.47.3
 
+    @staticmethod
+    def _digest(mac, data):
+        """Use the precomputed hmac template mac to hash data"""
+        mac = mac.copy()
+        mac.update(data)
+        return mac.digest()
+
     def hmac(self, data, key_index):
-        return hmac.new(self.ssvs[0][key_index], data, self.hash).digest()
+        return self._digest(self.macs[0][key_index], data)
 
-    def _computeMIC(self, data, key, seqnum):
+    def _computeMIC(self, data, mac, seqnum):
         """Compute getMIC token from given data"""
         # See draft26 2.10.9
-        p = FancyNFS4Packer()
-        p.pack_ssv_mic_plain_tkn4(xdrdef.nfs4_type.ssv_mic_plain_tkn4(seqnum, data))
-        hash = hmac.new(key, p.get_buffer(), self.hash).digest()
-        p.reset()
-        p.pack_ssv_mic_tkn4(xdrdef.nfs4_type.ssv_mic_tkn4(seqnum, hash))
-        return p.get_buffer()
+        # Both ssv_mic_plain_tkn4 and ssv_mic_tkn4 are just a uint32
+        # followed by an opaque, so encode them directly.
+        seq = struct.pack('>L', seqnum)
+        hash = self._digest(mac, seq + _xdr_opaque(data))
+        return seq + _xdr_opaque(hash)
 
     def getMIC(self, data):
         dir = (SSV4_SUBKEY_MIC_I2T if self.local else SSV4_SUBKEY_MIC_T2I)
         with self.lock:
             seqnum = self.ssv_seq
-            key = self.ssvs[0][dir]
-        return self._computeMIC(data, key, seqnum)
+            mac = self.macs[0][dir]
+        return self._computeMIC(data, mac, seqnum)
 
     def verifyMIC(self, data, checksum):
         p = FancyNFS4Unpacker(checksum)
@@ -388,10 +428,10 @@ class SSVContext(object):
         with self.lock:
             index = self.ssv_seq - token.smt_ssv_seq
             try:
-                key = self.ssvs[index][dir]
+                mac = self.macs[index][dir]
             except KeyError:
                 raise "Need error here" # STUB
-        expect = self._computeMIC(data, key, token.smt_ssv_seq)
+        expect = self._computeMIC(data, mac, token.smt_ssv_seq)
         if expect != checksum:
             raise "Need error here" # STUB
         return 0 # default qop
@@ -401,28 +441,27 @@ class SSVContext(object):
         # See draft26 2.10.9
         with self.lock:
             keys = self.ssvs[0]
+            macs = self.macs[0]
             seqnum = self.ssv_seq
         blocksize = self.encrypt.block_size
         cofounder = random_string(4) # '4' pulled out of nowhere
+        # The pad is chosen so that the XDR encoded ssv_seal_plain_tkn4 is
+        # a multiple of blocksize.  Everything but the pad is a fixed
+        # size, so the needed length can be computed up front.
+        base = xdrlen(cofounder) + 4 + xdrlen(data) + 4
+        pad = '\0' * (-base % blocksize)
+        input = xdrdef.nfs4_type.ssv_seal_plain_tkn4(cofounder, seqnum, data, pad)
         p = FancyNFS4Packer()
-        # We need to compute pad.  Easiest (though not fastest) way
-        # is to pack w/o padding, determine padding needed, then repack.
-        input = xdrdef.nfs4_type.ssv_seal_plain_tkn4(cofounder, seqnum, data, "")
         p.pack_ssv_seal_plain_tkn4(input)
-        offset = len(p.get_buffer()) % blocksize
-        if offset:
-            pad = '\0' * (blocksize - offset)
-            p.reset()
-            input = xdrdef.nfs4_type.ssv_seal_plain_tkn4(cofounder, seqnum, data, pad)
-            p.pack_ssv_seal_plain_tkn4(input)
         plain_xdr = p.get_buffer()
         p.reset()
         iv = random_string(blocksize)
         dir = (SSV4_SUBKEY_SEAL_I2T if self.local else SSV4_SUBKEY_SEAL_T2I)
+        # CBC state is bound to the IV, so a new cipher object is needed
         obj = self.encrypt.new(keys[dir], IV=iv)
         encrypted = obj.encrypt(plain_xdr)
         dir = (SSV4_SUBKEY_MIC_I2T if self.local else SSV4_SUBKEY_MIC_T2I)
-        hash = hmac.new(keys[dir], plain_xdr, self.hash).digest()
+        hash = self._digest(macs[dir], plain_xdr)
         token = xdrdef.nfs4_type.ssv_seal_cipher_tkn4(seqnum, iv, encrypted, hash)
         p.pack_ssv_seal_cipher_tkn4(token)
         return p.get_buffer()
@@ -441,13 +480,14 @@ class SSVContext(object):
             index = self.ssv_seq - token.ssct_ssv_seq
             try:
                 keys = self.ssvs[index]
+                macs = self.macs[index]
             except KeyError:
                 raise "Need error here" # STUB
         dir = (SSV4_SUBKEY_SEAL_T2I if self.local else SSV4_SUBKEY_SEAL_I2T)
         obj = self.encrypt.new(keys[dir], IV=token.ssct_iv)
         xdr = obj.decrypt(token.ssct_encr_data)
         dir = (SSV4_SUBKEY_MIC_T2I if self.local else SSV4_SUBKEY_MIC_I2T)
-        hash = hmac.new(keys[dir], xdr, self.hash).digest()
+        hash = self._digest(macs[dir], xdr)
         if hash != token.ssct_hmac:
             raise "Need error here" # STUB
         p.reset(xdr)
@@ -599,11 +639,51 @@ class NFS4Principal(object):
 
     def __eq__(self, other):
         # STUB - ignores mappings
-        return self.name == other.name
+        # Principals are interned by PrincipalTable, so usually identical
+        return self is other or self.name == other.name
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+class PrincipalTable(object):
+    """Interns principals, so repeated creds map to the same NFS4Principal.
+
+    Lookups are keyed by (flavor, raw cred), with a second map by name so
+    that different creds for the same principal also share an object.
+    Both maps are bounded by size.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self._lock = Lock("PrincipalTable")
+        self._by_cred = {} # {(flavor, raw cred): NFS4Principal}
+        self._by_name = {} # {name: NFS4Principal}
+
+    def _bounded_set(self, d, key, value):
+        if len(d) >= self.size:
+            d.popitem()
+        d[key] = value
+
+    def lookup(self, key, credinfo):
+        """Return principal for key, using credinfo if it is not cached"""
+        principal = self._by_cred.get(key)
+        if principal is not None:
+            return principal
+        name = credinfo.principal
+        with self._lock:
+            principal = self._by_name.get(name)
+            if principal is None:
+                principal = NFS4Principal(name)
+                self._bounded_set(self._by_name, name, principal)
+            self._bounded_set(self._by_cred, key, principal)
+        return principal
+
+    def clear(self):
+        with self._lock:
+            self._by_cred.clear()
+            self._by_name.clear()
+
+principals = PrincipalTable()
+
 def check(res, expect=xdrdef.nfs4_const.NFS4_OK, msg=None):
     if res.status == expect:
         return
@@ -9,17 +9,22 @@ from xdrdef.nfs4_type import *
 from xdrdef.sctrl_pack import SCTRLPacker, SCTRLUnpacker
 import xdrdef.sctrl_type, xdrdef.sctrl_const
 import traceback, threading
+import os
+import errno
 from locking import Lock, Counter
 import time
 import hmac
 import random
 import struct
 import collections
+import heapq
 import logging
 from nfs4state import find_state
-from nfs4commoncode import CompoundState, encode_status, encode_status_by_name
-from fs import RootFS, ConfigFS
-from config import ServerConfig, ServerPerClientConfig, OpsConfigServer, Actions
+from nfs4commoncode import CompoundState, encode_status, encode_status_by_name, \
+     encode_status_encoder
+from fs import RootFS, ConfigFS, PageCache
+from config import ServerConfig, ServerPerClientConfig, OpsConfigServer, Actions, \
+     ServerStats
 
 logging.basicConfig(level=logging.WARN,
                     format="%(levelname)-7s:%(name)s:%(message)s")
@@ -48,9 +53,16 @@ def create_default_replays():
     p.pack_COMPOUND4res(COMPOUND4res(NFS4ERR_SEQ_MISORDERED, tag, [res]))
     s2 = p.get_buffer()
 
-    return s1, s2
+    # Used when a cached reply has been dropped, see ReplyArena
+    res = encode_status_by_name("sequence", NFS4ERR_RETRY_UNCACHED_REP)
+    p.reset()
+    p.pack_COMPOUND4res(COMPOUND4res(NFS4ERR_RETRY_UNCACHED_REP, tag, [res]))
+    s3 = p.get_buffer()
+
+    return s1, s2, s3
 
-default_replay_client, default_replay_slot = create_default_replays()
+default_replay_client, default_replay_slot, uncached_replay_slot = \
+    create_default_replays()
 
 ##################################################
 # global functions
@@ -105,9 +117,109 @@ def check_seqid(seqid):
 # Supporting class definitions
 ##################################################
 
+# Format of files written by RecordQueue, big endian throughout:
+#     file header:   magic, version
+#     each record:   time (double), call length, reply length, call, reply
+RECORD_MAGIC = "PYNR"
+RECORD_HEADER = struct.Struct(">4sL")
+RECORD_ENTRY = struct.Struct(">dLL")
+
+def read_recording(path):
+    """Generate (time, call, reply) for each record spilled to path"""
+    fd = open(path, "rb")
+    try:
+        magic, version = RECORD_HEADER.unpack(fd.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC or version != 1:
+            raise ValueError("%s is not a recording" % path)
+        while True:
+            header = fd.read(RECORD_ENTRY.size)
+            if len(header) < RECORD_ENTRY.size:
+                return
+            stamp, call_len, reply_len = RECORD_ENTRY.unpack(header)
+            yield stamp, fd.read(call_len), fd.read(reply_len)
+    finally:
+        fd.close()
+
+def open_recording(base):
+    """Create a new recording file named from base, and return it open.
+
+    The name has our pid in it, since each forked worker keeps its own
+    recordings, and O_EXCL with a counter keeps two stamps that map to
+    the same base from sharing a file.
+    """
+    base = "%s.%i" % (base, os.getpid())
+    path = "%s.rec" % base
+    count = 0
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        count += 1
+        path = "%s-%i.rec" % (base, count)
+    spill = os.fdopen(fd, "wb")
+    spill.write(RECORD_HEADER.pack(RECORD_MAGIC, 1))
+    return spill
+
+class RecordQueue(object):
+    """Ring buffer of (call, reply) strings, holding at most
+    config.record_size bytes.
+
+    Used like a deque, adding with appendleft() and removing the oldest
+    with pop().  Records pushed out to stay within the limit are appended
+    to the open file spill, if given, otherwise they are dropped.
+    """
+    def __init__(self, config, spill=None):
+        self.config = config
+        self.size = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._lock = Lock("RecordQueue")
+        self._spill = spill
+
+    def __len__(self):
+        return len(self._queue)
+
+    def appendleft(self, record):
+        size = len(record[0]) + len(record[1])
+        with self._lock:
+            self._queue.appendleft((time.time(), record))
+            self.size += size
+            limit = self.config.record_size
+            while self.size > limit and len(self._queue) > 1:
+                stamp, (call, reply) = self._queue.pop()
+                self.size -= len(call) + len(reply)
+                if self._spill is None:
+                    self.dropped += 1
+                else:
+                    self._spill.write(RECORD_ENTRY.pack(stamp, len(call),
+                                                        len(reply)))
+                    self._spill.write(call)
+                    self._spill.write(reply)
+
+    def pop(self):
+        with self._lock:
+            stamp, record = self._queue.pop()
+            self.size -= len(record[0]) + len(record[1])
+            return record
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
 class Recording(object):
-    """Store RPC traffic for client"""
-    def __init__(self):
+    """Store RPC traffic for client
+
+    Callers should check self.on before calling add, so recording costs
+    nothing while off.
+    """
+    def __init__(self, config, spill_dir=None):
+        self.config = config
+        self.spill_dir = spill_dir # If set, overflow is saved here
+        self.queues = {}
         self.reset()
         
     def add(self, call, reply):
@@ -118,13 +230,19 @@ class Recording(object):
     def set_stamp(self, stamp):
         queue = self.queues.get(stamp, None)
         if queue is None:
-            queue = collections.deque()
+            spill = None
+            if self.spill_dir is not None:
+                name = "".join([c if c.isalnum() else "_" for c in stamp])
+                spill = open_recording(os.path.join(self.spill_dir, name))
+            queue = RecordQueue(self.config, spill)
             self.queues[stamp] = queue
         self.queue = queue
         
     def reset(self):
         self.stamp = "default"
         self.on = False
+        for queue in self.queues.values():
+            queue.close()
         self.queues = {}
         self.queue = None
 
@@ -208,11 +326,25 @@ class ClientList(object):
     client supplied ownerid to server supplied clientid, and
     the mapping of either to ClientRecords, where all of the 
     server's state data related to the client can be accessed.
+
+    Clientids are handed out as first, first + step, first + 2*step...,
+    which lets server processes partition the clientid space.
+
+    Also tracks leases, using a heap of (lastused, clientid) ordered by
+    when each lease was last known to be renewed.
     """
-    def __init__(self):
+    def __init__(self, first=0, step=1):
         self._data = {}
+        self._leases = []
         self.lock = Lock("ClientList")
-        self._nextid = 0L
+        self._nextid = long(first)
+        self._step = step
+
+    def partition(self, first, step):
+        """Hand out future clientids as first, first + step, ..."""
+        with self.lock:
+            self._nextid = long(first)
+            self._step = step
 
     def __getitem__(self, key):
         return self._data.get(key)
@@ -246,16 +378,43 @@ class ClientList(object):
         # accomodate ConfigFS, which embeds clientid into fileid.
         # BUG - clientid is supposed to be unique, even across
         # server reboots (2.4 of draft22, line 1408)
-        self._nextid += 1
+        self._nextid += self._step
         # Since ownerid is a string, and clientid an integer, we
         # can record both without fear of collision.
         self._data[c.ownerid] = c
         self._data[c.clientid] = c
+        heapq.heappush(self._leases, (c.lastused, c.clientid))
         return c
 
+    def expired(self, lease_time, now):
+        """Return list of clients whose lease has expired.
+
+        Lock needs to be held.
+        """
+        out = []
+        leases = self._leases
+        while leases and leases[0][0] + lease_time <= now:
+            lastused, clientid = heapq.heappop(leases)
+            c = self._data.get(clientid)
+            if c is None:
+                # Client already removed
+                continue
+            if c.lastused + lease_time > now:
+                # Renewed since it was queued, so requeue
+                heapq.heappush(leases, (c.lastused, clientid))
+            else:
+                out.append(c)
+        return out
+
+    def next_renewal(self):
+        """Return oldest queued lastused time, or None if no clients"""
+        if self._leases:
+            return self._leases[0][0]
+
     def wipe(self):
         with self.lock:
             self._data = {}
+            self._leases = []
 
 class VerboseDict(dict):
     def __init__(self, config):
@@ -363,7 +522,7 @@ class ClientRecord(object):
 
 class SessionRecord(object):
     """The server's representation of a session and its state"""
-    def __init__(self, client, csa):
+    def __init__(self, client, csa, arena=None):
         self.client = client # reference back to client which created this session
         self.sessionid = "%08x%08x" % (client.clientid,
                                     client.session_replay.seqid) # XXX does this work?
@@ -376,9 +535,21 @@ class SessionRecord(object):
         #self.ssv = None # crypto hash for securing channel binding
         #            short for "Secret Session Verifier"
         self.cb_prog = None # callback rpc program number
+        # Memory used by cached replies of channel_fore, see ReplyArena
+        self.cache_stats = dict.fromkeys(("bytes", "replies", "stored",
+                                          "dropped"), 0)
+        self.arena = arena
+        for slot in self.channel_fore.slots:
+            slot.arena = arena
+            slot.stats = self.cache_stats
         # NOTE 2.10.6.3 implies multiple principals can use a session
         # but 2.4 implies principal linked with ownerid (ie client)
 
+    def release_cache(self):
+        """Free cached replies, called when the session goes away"""
+        if self.arena is not None:
+            self.arena.release(self.channel_fore.slots)
+
     def get_nonce(self, connection, client_nonce):
         """Get (and remember) nonce for the connection"""
         # NOTE XXX nonce records should have timestamps to allow removal
@@ -449,11 +620,24 @@ class Channel(object):
                               
         
 class Cache(object):
-    def __init__(self, data=None):
+    def __init__(self, data=None, slot=None):
         self.data = data
+        self.slot = slot # Slot this caches the reply for
         self.valid = threading.Event() # XXX Is anyone waiting on this?
         if data is not None:
             self.valid.set()
+
+    def fill(self, data):
+        """Store the reply, and wake anyone waiting to replay it"""
+        if self.slot is not None and self.slot.arena is not None:
+            self.slot.arena.store(self.slot, self, data)
+        else:
+            self.data = data
+        self.valid.set()
+
+    def size(self):
+        """Bytes of packed reply held"""
+        return len(self.data) if isinstance(self.data, str) else 0
             
 class Slot(object):
     def __init__(self, index, default=default_replay_slot):
@@ -464,6 +648,8 @@ class Slot(object):
         self.lock = Lock("Slot")
         self.inuse = False # client has outstanding message
         self.xid = None # rpc xid of outstanding message, only set on async calls
+        self.arena = None # If set, ReplyArena holding replay_cache.data
+        self.stats = None # Session's cache_stats, used by arena
 
     def check_seqid(self, seqid):
         """Server replay checking"""
@@ -473,7 +659,7 @@ class Slot(object):
             if seqid == expected:
                 # All is good
                 self.seqid = expected
-                self.replay_cache = Cache()
+                self.replay_cache = Cache(slot=self)
                 self.seen = False
                 return self.replay_cache
             elif seqid == self.seqid:
@@ -502,6 +688,106 @@ class Slot(object):
 
     # STUB - for client, need to track slot usage
 
+class ReplyArena(object):
+    """Holds the cached replies of all session slots within a byte budget.
+
+    The budget is config.reply_cache_size.  When it is exceeded, the
+    oldest replies are dropped, and a retry of those requests gets
+    NFS4ERR_RETRY_UNCACHED_REP, see draft22 2.10.6.1.3.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.size = 0 # Bytes currently held
+        self.dropped = 0 # Replies dropped to stay within budget
+        self._slots = collections.OrderedDict() # {slot: (cache, size)}
+        self.lock = Lock("ReplyArena")
+
+    def store(self, slot, cache, data):
+        with self.lock:
+            self._forget(slot)
+            cache.data = data
+            self._slots[slot] = (cache, len(data))
+            self.size += len(data)
+            slot.stats["bytes"] += len(data)
+            slot.stats["replies"] += 1
+            slot.stats["stored"] += 1
+            limit = self.config.reply_cache_size
+            while self.size > limit and len(self._slots) > 1:
+                old, (old_cache, size) = self._slots.popitem(last=False)
+                self.size -= size
+                old.stats["bytes"] -= size
+                old.stats["replies"] -= 1
+                old.stats["dropped"] += 1
+                self.dropped += 1
+                old_cache.data = uncached_replay_slot
+
+    def release(self, slots):
+        """Stop accounting for replies cached by slots"""
+        with self.lock:
+            for slot in slots:
+                self._forget(slot)
+
+    def _forget(self, slot):
+        """Lock needs to be held"""
+        cache, size = self._slots.pop(slot, (None, 0))
+        if cache is not None:
+            self.size -= size
+            slot.stats["bytes"] -= size
+            slot.stats["replies"] -= 1
+
+class NameCache(object):
+    """Remembers the result of LOOKUP, keyed by (parent fh, name).
+
+    Names that were not found are remembered too.  An entry is only
+    used while the generation of the parent's DirIndex is unchanged,
+    so any link, unlink, or rename in the dir invalidates it.  At most
+    config.name_cache_size entries are kept, oldest dropped first.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.stats = {"hits": 0, "misses": 0, "negative": 0}
+        self._names = collections.OrderedDict() # {key: (entries, gen, id)}
+        self.lock = Lock("NameCache")
+
+    def lookup(self, dir, name, client, principal):
+        """Returns dir.lookup(name), without following mounts
+
+        dir.lock is only taken if the answer is not cached.
+        """
+        if not dir.cache_names or self.config.name_cache_size <= 0:
+            return self._lookup(dir, name, client, principal)
+        entries = dir.entries
+        gen = entries.generation
+        key = (dir.fs.fsid, dir.id, name)
+        item = self._names.get(key)
+        if item is not None and item[0] is entries and item[1] == gen:
+            if not dir.access4_lookup(principal):
+                raise NFS4Error(NFS4ERR_ACCESS)
+            self.stats["hits"] += 1
+            if item[2] is None:
+                self.stats["negative"] += 1
+                return None
+            return dir.fs.find(item[2])
+        self.stats["misses"] += 1
+        obj = self._lookup(dir, name, client, principal)
+        with self.lock:
+            self._names.pop(key, None)
+            self._names[key] = (entries, gen, None if obj is None else obj.id)
+            while len(self._names) > self.config.name_cache_size:
+                self._names.popitem(last=False)
+        return obj
+
+    def _lookup(self, dir, name, client, principal):
+        dir.lock.acquire()
+        try:
+            return dir.lookup(name, client, principal, follow_mount=False)
+        finally:
+            dir.lock.release()
+
+    def clear(self):
+        with self.lock:
+            self._names.clear()
+
 class SummaryOutput:
     def __init__(self, enabled=True):
         self._enabled = enabled
@@ -563,6 +849,7 @@ class NFS4Server(rpc.Server):
             log_cfg.setLevel(20)
 
         self.summary = SummaryOutput(kwargs.pop('show_summary', False))
+        record_dir = kwargs.pop('record_dir', None)
 
         rpc.Server.__init__(self, prog=NFS4_PROGRAM, versions=[4], port=port,
                             **kwargs)
@@ -570,22 +857,61 @@ class NFS4Server(rpc.Server):
         self._fsids = {self.root.fs.fsid: self.root.fs} # {fsid: fs}
         self.clients = ClientList() # List of attached clients
         self.sessions = {} # List of attached sessions
-        self.minor_versions = [1]
+        self.minor_versions = [1, 2]
         self.config = ServerConfig()
-        self.opsconfig = OpsConfigServer()
+        self.reply_arena = ReplyArena(self.config)
+        self.names = NameCache(self.config)
+        self.opsconfig = OpsConfigServer(self.opsconfig_changed)
         self.actions = Actions()
+        self.page_cache = PageCache(self.config)
+        self.stats = ServerStats()
+        self.stats.attrs[0].source = self.page_cache.report
+        self.stats.attrs[1].source = self.page_cache.report_files
         self.mount(ConfigFS(self), path="/config")
         self.verifier = struct.pack('>d', time.time())
-        self.recording = Recording()
+        self.recording = Recording(self.config, record_dir)
         self.devid_counter = Counter(name="devid_counter")
         self.devids = {} # {devid: device}
+        # Totals of what the lease reaper has freed
+        self.reaped = dict.fromkeys(("clients", "sessions", "states",
+                                     "cache_bytes"), 0)
         # default cred for the backchannel -- currently supports only AUTH_SYS
         rpcsec = rpc.security.instance(rpc.AUTH_SYS)
         self.default_cred = rpcsec.init_cred(uid=4321,gid=42,name="mystery")
         self.err_inc_dict = self.init_err_inc_dict()
+        self.build_op_table()
+
+    def fork_workers(self, count):
+        """Split into count processes, see rpc.Server.fork_workers.
+
+        Exports kept on disk are made read-only first.  Each worker would
+        otherwise allocate the same ids, and write the same data files
+        and metadata log, from its own copy of the tables.
+        """
+        for fs in self._fsids.values():
+            if fs.on_disk and not fs.read_only:
+                log_41.warn("Serving %s read-only, as %i workers share it" %
+                            (fs.path, count))
+                fs.read_only = True
+        return rpc.Server.fork_workers(self, count)
+
+    def worker_started(self, index, count):
+        """Set up one of count server processes sharing our port.
+
+        Each process hands out its own slice of clientids (and thus of
+        sessionids, which embed them), so a request landing on the wrong
+        worker fails with STALE_CLIENTID or BADSESSION instead of touching
+        some other client's state.  The distinct server owner tells clients
+        the workers are separate servers, so they do not trunk across them.
+        """
+        self.clients.partition(index, count)
+        self.config.set_owner(os.getpid(), "PyNFSv4.1 worker %i" % index)
 
     def start(self):
         """Cause the server to start listening on the previously bound port"""
+        t = threading.Thread(target=self.reap_leases, name="lease_reaper")
+        t.setDaemon(True)
+        t.start()
         try:
             rpc.Server.start(self)
         except KeyboardInterrupt:
@@ -600,6 +926,17 @@ class NFS4Server(rpc.Server):
             readline.parse_and_bind("tab: complete")
             code.InteractiveConsole(d).interact("Interact now")
 
+    def write_verifier(self, fs):
+        """The verifier for WRITE and COMMIT to fs.
+
+        It changes on reboot, and whenever data written UNSTABLE4 to fs
+        may have been lost, so that clients write it again.
+        """
+        if not fs.write_losses:
+            return self.verifier
+        verf = struct.unpack(">Q", self.verifier)[0] ^ fs.write_losses
+        return struct.pack(">Q", verf)
+
     def reboot(self):
         # STUB - all sorts of locking issues to think through
         log_41.warn("CALLING REBOOT")
@@ -608,6 +945,12 @@ class NFS4Server(rpc.Server):
         self.sessions = {}
         self.clients.wipe()
 
+    def checkpoint(self):
+        """Have filesystems that keep a metadata log checkpoint it"""
+        for fs in self._fsids.values():
+            if hasattr(fs, "checkpoint"):
+                fs.checkpoint()
+
     def mount(self, fs, path):
         """Mount the fs at the given path, creating the path if in RootFS.
 
@@ -715,12 +1058,7 @@ class NFS4Server(rpc.Server):
             reply = p.get_buffer()
             # Stuff the replay cache
             if env.cache is not None:
-                p.reset()
-                p.pack_COMPOUND4res(COMPOUND4res(env.results.cache.status,
-                                                 env.results.cache.tag,
-                                                 env.results.cache.results))
-                env.cache.data = p.get_buffer()
-                env.cache.valid.set()
+                env.cache.fill(env.results.packed_cache(reply))
         except NFS4Replay, e:
             log_41.info("Replay...waiting for valid data")
             e.cache.valid.wait()
@@ -730,7 +1068,8 @@ class NFS4Server(rpc.Server):
             show = unpacker.unpack_COMPOUND4res()
             unpacker.done()
             log_41.info(repr(show))
-        self.recording.add(data, reply)
+        if self.recording.on:
+            self.recording.add(data, reply)
         return rpc.SUCCESS, reply
 
     def init_err_inc_dict(self):
@@ -749,46 +1088,57 @@ class NFS4Server(rpc.Server):
         return value
 
     def check_opsconfig(self, env, opname):
-        log_cfg.debug("FRED - in opsconfig")
         config = self.opsconfig
-        # API is a list whose first element is a string determining messagetype
-        # Subsequent list values are determined by messagetype
-        l = getattr(config, opname)
-        if l[0] == "ERROR":
-            # Format is ["ERROR", code, freq]
-            # Interrupts normal processing to return 'code' every 'freq' calls
-            # Special case for freq==0 is to return 'code a single time
-            error, ceiling = l[1:]
-            if error == NFS4_OK:
-                # Proceed with normal processing
-                return
-            if ceiling == 0:
-                # Special case, trigger the error once then return to normal
-                log_41.debug("ERROR: check_opsconfig RESET to NORMAL")
-                setattr(config, opname, ["ERROR", 0, 0])
-                raise NFS4Error(error)
-            else:
-                inc = self.increment_error_count(opname, ceiling)
-                log_41.debug("ERROR: %d check_opsconfig incrementor: %d "
-                             "ceiling:%d)" % (error, inc, ceiling))
-                if inc == 0:
-                    raise NFS4Error(error)
+        # Only ops with an ERROR line set are in config.errors
+        injected = config.errors.get(opname)
+        if injected is None:
+            # Proceed with normal processing
+            return
+        # Format is ["ERROR", code, freq]
+        # Interrupts normal processing to return 'code' every 'freq' calls
+        # Special case for freq==0 is to return 'code a single time
+        error, ceiling = injected
+        if ceiling == 0:
+            # Special case, trigger the error once then return to normal
+            log_41.debug("ERROR: check_opsconfig RESET to NORMAL")
+            setattr(config, opname, ["ERROR", 0, 0])
+            raise NFS4Error(error)
         else:
-            # This shouldn't happen
-            raise RuntimeError("Unknown config messagetype")
+            inc = self.increment_error_count(opname, ceiling)
+            log_41.debug("ERROR: %d check_opsconfig incrementor: %d "
+                         "ceiling:%d)" % (error, inc, ceiling))
+            if inc == 0:
+                raise NFS4Error(error)
+
+    def opsconfig_changed(self, opname):
+        if opname in self.opsconfig.delays or opname in self.op_table_delays:
+            self.build_op_table()
+
+    @staticmethod
+    def delayed(funct, delay):
+        """Wrap op handler so that it sleeps first, for DELAY in opsconfig"""
+        def op_delayed(arg, env):
+            time.sleep(delay)
+            if funct is None:
+                raise NFS4Error(NFS4ERR_NOTSUPP)
+            return funct(arg, env)
+        return op_delayed
 
     def check_utf8str_cs(self, str):
         # STUB - raises NFS4Error if appropriate.
         # Can be NFS4ERR_INVAL, NFS4ERR_BADCHAR, NFS4ERR_BADNAME
-        pass
+        try:
+            str.decode("utf8")
+        except UnicodeError:
+            raise NFS4Error(NFS4ERR_INVAL, tag="Invalid utf8")
 
     def check_utf8str_cis(self, str):
-        # STUB
-        pass
+        # Case only matters when comparing, which the fs does
+        self.check_utf8str_cs(str)
 
     def check_utf8str_mixed(self, str):
-        # STUB
-        pass
+        # The prefix before any '@' is case insensitive, the rest is not
+        self.check_utf8str_cs(str)
 
     def check_component(self, str):
         # XXX Want to look at config if interpret dots
@@ -799,6 +1149,33 @@ class NFS4Server(rpc.Server):
         if '/' in str:
             raise NFS4Error(NFS4ERR_BADCHAR)
     
+    def build_op_table(self):
+        """Precompute what op_compound needs to dispatch each opcode.
+
+        self.op_tables[minorversion] is indexed by opcode, holding
+        (self.op_<name> or None, name, result encoder).
+        Opcodes not in nfs_opnum4, or added after the compound's minor
+        version, get self.op_illegal_entry.
+        Any DELAY set in opsconfig is compiled into the handler,
+        so this must be rebuilt when those change.
+        """
+        delays = dict(self.opsconfig.delays)
+        def entry(opname):
+            name = opname.lower()[3:]
+            funct = getattr(self, "op_" + name, None)
+            if name in delays:
+                funct = self.delayed(funct, delays[name])
+            return (funct, name, encode_status_encoder(name))
+        self.op_illegal_entry = entry("OP_ILLEGAL")
+        size = max([op for op in nfs_opnum4 if op != OP_ILLEGAL]) + 1
+        table = [self.op_illegal_entry] * size
+        for op, opname in nfs_opnum4.items():
+            if op < size:
+                table[op] = entry(opname)
+        # 4.2 only adds ops after RECLAIM_COMPLETE, the last 4.1 op
+        self.op_tables = {1: table[:OP_RECLAIM_COMPLETE + 1], 2: table}
+        self.op_table_delays = delays
+
     def op_compound(self, args, cred):
         env = CompoundState(args, cred)
         env.is_ds = self.is_ds
@@ -814,16 +1191,18 @@ class NFS4Server(rpc.Server):
         # Handle the individual operations
         status = NFS4_OK
         opnames = []
+        table = self.op_tables[args.minorversion]
         for arg in args.argarray:
-            opname = nfs_opnum4.get(arg.argop, 'op_illegal')
-            log_41.info("*** %s (%d) ***" % (opname, arg.argop))
+            argop = arg.argop
+            if 0 <= argop < len(table):
+                funct, name, encode = table[argop]
+            else:
+                funct, name, encode = self.op_illegal_entry
+            log_41.info("*** %s (%d) ***", name, argop)
             env.index += 1
-            # Look for function self.op_<name>
-            funct = getattr(self, opname.lower(), None)
             if funct is None:
-                # If it doesn't exist, return _NOTSUPP
-                result = encode_status_by_name(opname.lower()[3:],
-                                               NFS4ERR_NOTSUPP)
+                # If self.op_<name> doesn't exist, return _NOTSUPP
+                result = encode(NFS4ERR_NOTSUPP)
             else:
                 try:
                     # Otherwise, call the function
@@ -832,19 +1211,17 @@ class NFS4Server(rpc.Server):
                     # XXX NOTE this only works for error returns that
                     # include no data.  Must ensure others (eg setattr)
                     # catch error themselves to encode properly.
-                    result = encode_status_by_name(opname.lower()[3:],
-                                                   e.status, msg=e.tag)
+                    result = encode(e.status, msg=e.tag)
                 except NFS4Replay:
                     # Just pass this on up
                     raise
                 except StandardError:
                     # Uh-oh.  This is a server bug
                     traceback.print_exc()
-                    result = encode_status_by_name(opname.lower()[3:],
-                                                   NFS4ERR_SERVERFAULT)
+                    result = encode(NFS4ERR_SERVERFAULT)
             env.results.append(result)
-            opnames.append(opname.lower()[3:])
-            status = result.status
+            opnames.append(name)
+            status = env.results.reply.status # May differ from result.status
             if status != NFS4_OK:
                 break
         log_41.info("Replying.  Status %s (%d)" % (nfsstat4[status], status))
@@ -857,6 +1234,7 @@ class NFS4Server(rpc.Server):
         log_41.info("delete_session REMOVE SESSION")
         del self.sessions[sessionid]
         session.client.sessions.remove(session)
+        session.release_cache()
 
     def error_set_session(self, session, sessionid, err):
         if (err == NFS4ERR_BADSESSION or err == NFS4ERR_DEADSESSION):
@@ -904,6 +1282,7 @@ class NFS4Server(rpc.Server):
         env.cache = slot.check_seqid(arg.sa_sequenceid)
         # At this point we are not allowed to return an error
         env.caching = arg.sa_cachethis
+        env.cache_limit = channel.maxresponsesize_cached
         env.session = session
         session.client.renew_lease() # Lease only renewed in non-error case
         # STUB - figure out return flags
@@ -944,7 +1323,7 @@ class NFS4Server(rpc.Server):
                 # STUB - need to purge state of any previous, and
                 # adjust ClientList appropriately
         # Go through args and use/adjust them
-        session = SessionRecord(c, arg)
+        session = SessionRecord(c, arg, self.reply_arena)
         connection = env.connection
         channel = session.channel_fore
         cb_channel = session.channel_back
@@ -1105,10 +1484,68 @@ class NFS4Server(rpc.Server):
                                 [self.config.impl_id])
         return encode_status(NFS4_OK, res, msg="draft21")
 
+    def reap_leases(self):
+        """Expire clients whose lease has run out.
+
+        It is called in its own thread, and never returns.
+        """
+        while True:
+            lease_time = self.config.lease_time
+            now = time.time()
+            with self.clients.lock:
+                expired = self.clients.expired(lease_time, now)
+                for c in expired:
+                    self.clients.remove(c.clientid)
+                oldest = self.clients.next_renewal()
+            # ClientList.lock is a leaf lock, so tear down state after
+            # dropping it.  Once removed, no new request can find c.
+            for c in expired:
+                self.expire_client(c)
+            # Sleep until the oldest lease runs out.  Since lease_time
+            # may be changed through /config, never sleep longer than it.
+            if oldest is None:
+                delay = lease_time
+            else:
+                delay = min(oldest + lease_time - now, lease_time)
+            time.sleep(max(delay, 0.5))
+
+    def expire_client(self, c):
+        """Remove all sessions and state of client c.
+
+        c must already be removed from self.clients, and self.clients.lock
+        must not be held, since this takes the locks of c's state entries.
+        """
+        # STUB - like client_reboot, ignores requests still in progress
+        freed = collections.defaultdict(int)
+        for sess in c.sessions:
+            self.sessions.pop(sess.sessionid, None)
+            freed["sessions"] += 1
+            freed["cache_bytes"] += sess.cache_stats["bytes"]
+            sess.release_cache()
+        freed["cache_bytes"] += c.session_replay.replay_cache.size()
+        c.sessions = []
+        # Remove locks before the opens they depend on
+        for entry in sorted(c.state.values(), key=lambda e: -e.type):
+            try:
+                with entry.lock:
+                    if not entry.invalid:
+                        entry.delete()
+                        freed["states"] += 1
+            except StandardError, e:
+                log_41.exception("Ignoring problem during state removal")
+        freed["clients"] = 1
+        for key, value in freed.items():
+            self.reaped[key] += value
+        log_41.info("Lease expired for client %i, freed %i sessions, "
+                    "%i state entries, and %i bytes of cached replies" %
+                    (c.clientid, freed["sessions"], freed["states"],
+                     freed["cache_bytes"]))
+
     def client_reboot(self, c):
         # STUB - locking?
         for sess in c.sessions:
             del self.sessions[sess.sessionid]
+            sess.release_cache()
         c.rebooted()
 
     def draft10_op_bind_conn_to_session(self, arg, env):
@@ -1221,13 +1658,13 @@ class NFS4Server(rpc.Server):
         env.cfh.check_dir()
         name = arg.objname
         self.check_component(name)
-        env.cfh.lock.acquire()
-        try:
-            obj = env.cfh.lookup(name, env.session.client, env.principal)
-        finally:
-            env.cfh.lock.release()
+        obj = self.names.lookup(env.cfh, name, env.session.client,
+                                env.principal)
         if obj is None:
             return encode_status(NFS4ERR_NOENT)
+        while obj.covered_by is not None:
+            # Directory is hidden by a mount
+            obj = obj.covered_by
         env.set_cfh(obj)
         return encode_status(NFS4_OK)
 
@@ -1326,7 +1763,7 @@ class NFS4Server(rpc.Server):
                 how = env.cfh.sync(arg.stable)
             finally:
                 state.mark_done_writing()
-        res = WRITE4resok(count, how, self.verifier)
+        res = WRITE4resok(count, how, self.write_verifier(env.cfh.fs))
         return encode_status(NFS4_OK, res)
 
     def op_read(self, arg, env):
@@ -1346,6 +1783,47 @@ class NFS4Server(rpc.Server):
         res = READ4resok(eof, data)
         return encode_status(NFS4_OK, res)
 
+    def op_seek(self, arg, env):
+        check_session(env)
+        check_cfh(env)
+        env.cfh.verify_file()
+        with find_state(env, arg.sa_stateid, allow_bypass= \
+                            env.session.client.config.allow_stateid1) as state:
+            state.has_permission(OPEN4_SHARE_ACCESS_READ)
+            eof, offset = env.cfh.seek(arg.sa_offset, arg.sa_what,
+                                       env.principal)
+        return encode_status(NFS4_OK, seek_res4(eof, offset))
+
+    def op_allocate(self, arg, env):
+        check_session(env)
+        check_cfh(env)
+        env.cfh.verify_file()
+        if arg.aa_offset + arg.aa_length > 0x7fffffffffffffff:
+            return encode_status(NFS4ERR_FBIG)
+        with find_state(env, arg.aa_stateid) as state:
+            state.has_permission(OPEN4_SHARE_ACCESS_WRITE)
+            state.mark_writing()
+            try:
+                env.cfh.allocate(arg.aa_offset, arg.aa_length, env.principal)
+            finally:
+                state.mark_done_writing()
+        return encode_status(NFS4_OK)
+
+    def op_deallocate(self, arg, env):
+        check_session(env)
+        check_cfh(env)
+        env.cfh.verify_file()
+        if arg.da_offset + arg.da_length > 0x7fffffffffffffff:
+            return encode_status(NFS4ERR_FBIG)
+        with find_state(env, arg.da_stateid) as state:
+            state.has_permission(OPEN4_SHARE_ACCESS_WRITE)
+            state.mark_writing()
+            try:
+                env.cfh.deallocate(arg.da_offset, arg.da_length, env.principal)
+            finally:
+                state.mark_done_writing()
+        return encode_status(NFS4_OK)
+
     def op_open(self, arg, env):
         self.check_opsconfig(env, "open")
         check_session(env)
@@ -1386,7 +1864,18 @@ class NFS4Server(rpc.Server):
         if not env.cfh.isdir:
             raise NFS4Error(NFS4ERR_NOTDIR)
         self.check_component(arg.claim.file) # XXX Done as part of lookup?
-        # BUG - file locking needs to be fixed
+        dir = env.cfh
+        if arg.openhow.opentype == OPEN4_CREATE:
+            dir.lock.acquire_write()
+        else:
+            dir.lock.acquire()
+        try:
+            return self._open_claim_null(arg, env, bitmask)
+        finally:
+            dir.lock.release()
+
+    def _open_claim_null(self, arg, env, bitmask):
+        """open_claim_null with lock held on the dir"""
         old_change = env.cfh.fattr4_change
         existing = env.cfh.lookup(arg.claim.file, env.session.client, 
                                   env.principal)
@@ -1432,7 +1921,6 @@ class NFS4Server(rpc.Server):
         new_change = env.cfh.fattr4_change
         cinfo = change_info4(True, old_change, new_change)
         return existing, cinfo, bitmask
-        # XXX before rewrite was a BUG race here until we grab state lock
 
     def open_claim_fh(self, arg, env):
         """Simulated switch function from op_open that handles CLAIM_FH"""
@@ -1546,43 +2034,37 @@ class NFS4Server(rpc.Server):
         return encode_status(NFS4_OK, res)
 
     def op_readdir(self, arg, env):
+        p = nfs4lib.FancyNFS4Packer()
         def find_size(e):
             # Find size of xdr encoded response
-            p = nfs4lib.FancyNFS4Packer()
+            p.reset()
             p.pack_entry4(e)
             return len(p.get_buffer())
             
-        offset = 3 # index offset used to avoid reserved cookies
         check_session(env)
         check_cfh(env)
         env.cfh.check_dir()
         if arg.cookie in (1, 2) or \
                (arg.cookie==0 and arg.cookieverf != "\0" * 8):
             return encode_status(NFS4ERR_BAD_COOKIE)
-        objlist, verifier = env.cfh.readdir(arg.cookieverf, env.session.client, env.principal) # (name, obj) pairs
+        # Generates (cookie, name, obj), only finding obj when asked
+        objiter, verifier = env.cfh.readdir(arg.cookie, arg.cookieverf,
+                                            env.session.client, env.principal)
         # STUB - think through rdattr_error handling
-        if arg.cookie == 0:
-            i = 0
-        else:
-            i = arg.cookie - offset + 1
-        eof = False
+        eof = True
         entrylist = []
         size = 16 # Size of packing an empty list into READDIR4resok
-        while True:
-            try:
-                name, obj = objlist[i]
-            except IndexError:
-                eof = True
-                break
-            e = entry4(i+offset, name,
-                       self.get_attributes(obj, arg.attr_request), [])
+        for cookie, name, obj in objiter:
+            # Encode attrs once, rather than each time the entry is packed
+            attrs = self.get_attributes(obj, arg.attr_request)
+            e = entry4(cookie, name, nfs4lib.dict2fattr(attrs), [])
             size += find_size(e)
             if size > arg.maxcount:
                 if not entrylist:
                     return encode_status(NFS4ERR_TOOSMALL)
+                eof = False
                 break
             entrylist.append(e)
-            i += 1
         log_41.debug("ENTRIES: %r" % entrylist)
         res = READDIR4resok(verifier, dirlist4(entrylist, eof))
         return encode_status(NFS4_OK, res)
@@ -1620,6 +2102,7 @@ class NFS4Server(rpc.Server):
         # STUB - need to think through any locking issues
         del self.sessions[arg.dsa_sessionid]
         session.client.sessions.remove(session)
+        session.release_cache()
         return encode_status(NFS4_OK)
 
     def op_remove(self, arg, env):
@@ -1628,17 +2111,21 @@ class NFS4Server(rpc.Server):
         self.check_component(arg.target)
         dir = env.cfh
         dir.check_dir()
-        # BUG fs locking
-        obj = dir.lookup(arg.target, env.session.client, env.principal)
-        if obj is None:
-            return encode_status(NFS4ERR_NOENT)
-        old_change = dir.fattr4_change
-        with obj.state:
-            obj.state.test_share(OPEN4_SHARE_ACCESS_WRITE,
-                                 error=NFS4ERR_FILE_OPEN)
-            dir.unlink(arg.target, env.principal) # Why is this under lock?
-        new_change = dir.fattr4_change
-        dir.sync()
+        dir.lock.acquire_write()
+        try:
+            obj = dir.lookup(arg.target, env.session.client, env.principal)
+            if obj is None:
+                return encode_status(NFS4ERR_NOENT)
+            old_change = dir.fattr4_change
+            with obj.state:
+                # Hold state lock so no OPEN sneaks in before the unlink
+                obj.state.test_share(OPEN4_SHARE_ACCESS_WRITE,
+                                     error=NFS4ERR_FILE_OPEN)
+                dir.unlink(arg.target, env.principal)
+            new_change = dir.fattr4_change
+            dir.sync()
+        finally:
+            dir.lock.release()
         cinfo = change_info4(True, old_change, new_change)
         res = REMOVE4resok(cinfo)
         return encode_status(NFS4_OK, res)
@@ -1661,10 +2148,8 @@ class NFS4Server(rpc.Server):
         check_session(env)
         check_cfh(env)
         env.cfh.verify_file()
-        with env.cfh.state: # Is this necessary?
-            # BUG fs locking
-            env.cfh.sync()
-        res = COMMIT4resok(self.verifier)
+        env.cfh.commit(arg.offset, arg.count)
+        res = COMMIT4resok(self.write_verifier(env.cfh.fs))
         return encode_status(NFS4_OK, res)
 
     def op_link(self, arg, env):
@@ -1735,42 +2220,66 @@ class NFS4Server(rpc.Server):
         if not nfs4lib.test_equal(env.sfh.fattr4_fsid, env.cfh.fattr4_fsid,
                                   kind="fsid4"):
             return encode_status(NFS4ERR_XDEV, msg="%r != %r" % (env.sfh.fattr4_fsid, env.cfh.fattr4_fsid))
-        order = sorted(set([env.cfh, env.sfh])) # Used to prevent locking problems
-        # BUG fs locking
+        # Lock both dirs, in a fixed order to prevent deadlock
+        order = sorted(set([env.cfh, env.sfh]), key=lambda d: d.id)
+        for dir in order:
+            dir.lock.acquire_write()
+        try:
+            res = self._rename(arg, env)
+        finally:
+            for dir in reversed(order):
+                dir.lock.release()
+        return encode_status(NFS4_OK, res)
+
+    def _rename(self, arg, env):
+        """op_rename with locks held on both dirs, returns RENAME4resok"""
         old_change_src = env.sfh.fattr4_change
         old_change_dst = env.cfh.fattr4_change
         src = env.sfh.lookup(arg.oldname, env.session.client, env.principal, follow_mount=False)
         if src is None:
-            return encode_status(NFS4ERR_NOENT)
+            raise NFS4Error(NFS4ERR_NOENT)
+        if src.isdir:
+            # Can't move a dir inside itself
+            dir = env.cfh
+            while dir is not None:
+                if dir is src:
+                    raise NFS4Error(NFS4ERR_INVAL)
+                dir = (None if dir.parent is None else dir.fs.find(dir.parent))
         dst = env.cfh.lookup(arg.newname, env.session.client, env.principal, follow_mount=False)
         if dst is not None:
             if dst.fattr4_fileid == src.fattr4_fileid:
+                if env.cfh is env.sfh and arg.oldname != arg.newname and \
+                   env.cfh.entry_name(arg.newname) == arg.oldname:
+                    # Only the case differs, on a case-insensitive fs
+                    env.cfh.respell(arg.oldname, arg.newname, env.principal)
+                    res = RENAME4resok(change_info4(True, old_change_src,
+                                                    env.sfh.fattr4_change),
+                                       change_info4(True, old_change_dst,
+                                                    env.cfh.fattr4_change))
+                    return res
                 # They are the same file, do nothing
                 res = RENAME4resok(change_info4(True, old_change_src,
                                                 old_change_src),
                                    change_info4(True, old_change_dst,
                                                 old_change_dst))
-                return encode_status(NFS4_OK, res)
+                return res
             compatible = dst.fattr4_type == src.fattr4_type
             if dst.isdir and not dst.isempty:
                 # BUG there is a race here, since we don't have any
                 # lock on dst
                 compatible = False
             if not compatible:
-                return encode_status(NFS4ERR_EXIST)
+                raise NFS4Error(NFS4ERR_EXIST)
             with dst.state:
                 dst.state.test_share(OPEN4_SHARE_ACCESS_WRITE,
                                      error=NFS4ERR_FILE_OPEN)
                 env.cfh.unlink(arg.newname, env.principal)
-        # We need to link obj in new spot, then unlink in old
-        # We don't do it in the other order to prevent refcnt going to zero
-        env.cfh.link(arg.newname, src, env.principal)
-        env.sfh.unlink(arg.oldname, env.principal)
+        env.cfh.move(arg.newname, env.sfh, arg.oldname, src, env.principal)
         new_change_src = env.sfh.fattr4_change
         new_change_dst = env.cfh.fattr4_change
         res = RENAME4resok(change_info4(True, old_change_src, new_change_src),
                            change_info4(True, old_change_dst, new_change_dst))
-        return encode_status(NFS4_OK, res)
+        return res
 
     def _getlockend(self, offset, length):
         if length == 0:
@@ -1954,7 +2463,7 @@ class NFS4Server(rpc.Server):
             return xdrdef.sctrl_const.CTRLSTAT_NOT_AVAIL, \
                    xdrdef.sctrl_type.resdata_t(arg.ctrlop, xdrdef.sctrl_type.GRABres([],[]))
         max = arg.number
-        if max == 0:
+        if max == 0 or max > len(queue):
             max = len(queue)
         calls = []
         replies = []
@@ -1990,6 +2499,9 @@ class NFS4Server(rpc.Server):
             fs = self.fsid2fs((major, minor))
             log_41.log(5, "fh2obj - chooses fsid %r" % (fs.fsid,))
             obj = fs.find(id)
+        except NFS4Error:
+            # For example, STALE from an fs that can tell
+            raise
         except:
             raise NFS4Error(NFS4ERR_BADHANDLE)
         return obj
@@ -2095,11 +2607,33 @@ def scan_options():
                  help="File used to determine dataserver addresses")
     p.add_option("--port", type="int", default=2049,
                  help="Set port to listen on (2049)")
+    p.add_option("--record_dir", default=None,
+                 help="Directory to save recorded traffic that overflows "
+                 "the in memory record_size limit")
+    p.add_option("--mmap", default=None, metavar="DIR",
+                 help="Export an in-memory fs at /mmap, with file data "
+                 "kept in DIR, which must be empty unless --reset is given")
+    p.add_option("--passthrough", default=None, metavar="DIR",
+                 help="Export the local directory DIR read-only at /export")
+    p.add_option("--passthrough_rw", action="store_true", default=False,
+                 help="Allow clients to modify the --passthrough export")
+    p.add_option("--mockgss", action="store_true", default=False,
+                 help="Accept RPCSEC_GSS using the mock mechanism, which "
+                 "gives no real security.  Also set by the "
+                 "PYNFS_MOCKGSS_SECRET environment variable")
+    p.add_option("--workers", type="int", default=1,
+                 help="Number of server processes sharing the port. "
+                 "State is not shared, so exports kept on disk are "
+                 "served read-only, and each worker has its own copy "
+                 "of in-memory exports (1)")
 
     g = OptionGroup(p, "Debug options",
                     "These affect information collected and printed.")
     g.add_option("--debug_locks", action="store_true", default=False,
                  help="Threads track locks and their state")
+    g.add_option("--profile_locks", action="store_true", default=False,
+                 help="Count lock waits, and print the most contended "
+                 "locks on SIGUSR1 and at exit")
     p.add_option_group(g)
 
     opts, args = p.parse_args()
@@ -2112,14 +2646,32 @@ if __name__ == "__main__":
     if opts.debug_locks:
         import locking
         locking.DEBUG = True
+    if opts.profile_locks:
+        import locking, signal
+        locking.PROFILE = True
+        def show_contention(*args):
+            print locking.contention_report()
+        signal.signal(signal.SIGUSR1, show_contention)
+    if opts.mockgss:
+        rpc.security.enable_mock()
+    forking = opts.workers > 1
     S = NFS4Server(port=opts.port,
                    is_mds=opts.use_block or opts.use_files,
                    is_ds = opts.is_ds,
                    verbose = opts.verbose,
-                   show_summary = opts.show_summary)
+                   show_summary = opts.show_summary,
+                   record_dir = opts.record_dir,
+                   reuseport = forking)
     read_exports(S, opts)
+    if forking:
+        # Exports are built once, then copied into each worker
+        S.fork_workers(opts.workers)
     if True:
-        S.start()
+        try:
+            S.start()
+        finally:
+            if opts.profile_locks:
+                show_contention()
     else:
         import profile
         # This doesn't work well - only looks at main thread
@@ -518,8 +518,17 @@ class FileState(object):
                 self.file.destroy()
 
     def has_no_state(self):
-        # STUB - used by close
-        return False
+        """True if no client holds opens, locks, delegations or layouts,
+        and no anonymous READ or WRITE is in progress."""
+        for typed in self.types:
+            if typed.type != ANON:
+                if typed._tree:
+                    return False
+            else:
+                for entry in typed.itervalues():
+                    if entry.read_count or entry.write_count:
+                        return False
+        return True
 
     def test_lock(self, client, lock_owner, type, start, end):
         new_lock = ByteLock(type, start, end)
@@ -593,7 +602,9 @@ class StateTableEntry(object):
     def delete(self):
         """Remove this entry from self.file.state table"""
         self.invalid = True
-        del self._state._tree[self.key]
+        if self._state._tree.get(self.key) is self:
+            # Otherwise already pruned, for example by CLOSE
+            del self._state._tree[self.key]
         del self.key[0].state[self.other]
 
 class DSEntry(StateTableEntry):
@@ -124,7 +124,7 @@ class Environment(testmod.Environment):
             call = self.c1.make_call_function(self.c1.c1, 0,
                                               self.c1.default_prog,
                                               self.c1.default_vers)
-            krb5_cred = AuthGss().init_cred(call, target="nfs@%s" % opts.server)
+            krb5_cred = AuthGss(opts.mechanism).init_cred(call, target="nfs@%s" % opts.server)
             krb5_cred.service = opts.service
             self.cred1 = krb5_cred
         self.c1.set_cred(self.cred1)
@@ -631,12 +631,12 @@ def maketree(sess, tree, root=None, owner=None):
             create_close(sess, owner, root + [obj])
 
 def lookup_obj(sess, path):
-    compound = [op.putrootfh()]
-    compound += [op.lookup(comp) for comp in path]
-    compound += [op.getfh()]
-    res = sess.compound(compound)
-    check(res)
-    return res.resarray[-1].object
+    """Returns fh of path, using the fhs sess has cached for its dirs"""
+    try:
+        return sess.lookup_path(path)
+    except nfs4lib.NFS4Error, e:
+        raise testmod.FailureException("Looking up /%s: %s" %
+                                       ('/'.join(path), e))
 
 def rename_obj(sess, oldpath, newpath):
     olddir = lookup_obj(sess, oldpath[:-1])
@@ -644,7 +644,11 @@ def rename_obj(sess, oldpath, newpath):
     ops =  [op.putfh(olddir), op.savefh()]
     ops += [op.putfh(newdir)]
     ops += [op.rename(oldpath[-1], newpath[-1])]
-    return sess.compound(ops)
+    res = sess.compound(ops)
+    if res.status == NFS4_OK:
+        sess.forget_path(oldpath)
+        sess.forget_path(newpath)
+    return res
 
 def link(sess, old, new):
     ops = use_obj(old) + [op.savefh()]
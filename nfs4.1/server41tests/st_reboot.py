@@ -1,6 +1,7 @@
 from xdrdef.nfs4_const import *
 from xdrdef.nfs4_type import *
-from environment import check, fail, create_file, open_file, create_confirm
+from environment import check, fail, create_file, open_file, create_confirm, \
+    create_close, create_obj, close_file, do_readdir, do_getattrdict, use_obj
 import sys
 import os
 import nfs4lib
@@ -35,6 +36,29 @@ def reclaim_complete(sess):
     res = sess.compound([rc_op])
     check(res, msg="reclaim_complete")
 
+def _checkpoint(sess, owner):
+    """Have the server checkpoint its metadata logs, through pynfs's
+    config/actions/checkpoint file"""
+    path = ["config", "actions", "checkpoint"]
+    res = open_file(sess, owner, path, access=OPEN4_SHARE_ACCESS_WRITE)
+    check(res, msg="Opening config/actions/checkpoint")
+    fh = res.resarray[-1].object
+    stateid = res.resarray[-2].stateid
+    res = sess.compound([op.putfh(fh),
+                         op.setattr(stateid, {FATTR4_SIZE: 0}),
+                         op.write(stateid, 0, FILE_SYNC4, "1\n")])
+    check(res, msg="Writing config/actions/checkpoint")
+    res = close_file(sess, fh, stateid)
+    check(res, msg="Closing config/actions/checkpoint")
+
+def _entries(sess, dir):
+    """Returns {name: fileid} for the entries of dir"""
+    out = {}
+    for e in do_readdir(sess, dir):
+        attrs = do_getattrdict(sess, dir + [e.name], [FATTR4_FILEID])
+        out[e.name] = attrs[FATTR4_FILEID]
+    return out
+
 #####################################################
 
 def testRebootValid(t, env):
@@ -67,3 +91,37 @@ def testRebootValid(t, env):
         reclaim_complete(sess)
     finally:
         env.sleep(sleeptime, "Waiting for grace period to end")
+
+def testRebootCheckpoint(t, env):
+    """REBOOT keeps dir changes made both before and after a checkpoint
+
+    FLAGS: reboot
+    DEPEND:
+    CODE: REBT2
+    """
+    name = env.testname(t)
+    c = env.c1.new_client(name)
+    sess = c.create_session()
+    dir = sess.c.homedir + [name]
+    res = create_obj(sess, dir)
+    check(res, msg="Creating dir %s" % name)
+    for i in range(20):
+        create_close(sess, name, dir + ["a%i" % i])
+    _checkpoint(sess, name)
+    for i in range(20):
+        create_close(sess, name, dir + ["b%i" % i])
+    for i in range(0, 20, 2):
+        res = sess.compound(use_obj(dir) + [op.remove("a%i" % i)])
+        check(res, msg="Removing a%i" % i)
+    before = _entries(sess, dir)
+    sleeptime = 5 + _getleasetime(sess)
+    _waitForReboot(c, sess, env)
+    try:
+        c = env.c1.new_client(name)
+        sess = c.create_session()
+        after = _entries(sess, dir)
+        if after != before:
+            fail("After reboot dir has %r, expected %r" %
+                 (sorted(after.items()), sorted(before.items())))
+    finally:
+        env.sleep(sleeptime, "Waiting for grace period to end")
@@ -1,5 +1,5 @@
 from xdrdef.nfs4_const import *
-from environment import check, fail, maketree, rename_obj, get_invalid_utf8strings, create_obj, create_confirm, link, use_obj, create_file
+from environment import check, fail, maketree, rename_obj, get_invalid_utf8strings, create_obj, create_confirm, link, use_obj, create_file, lookup_obj, do_readdir, do_getattrdict
 import nfs_ops
 op = nfs_ops.NFS4ops()
 from xdrdef.nfs4_type import *
@@ -515,3 +515,73 @@ def testLinkRename(t, env):
     if scinfo.before != scinfo.after or tcinfo.before != tcinfo.after:
         t.fail("RENAME of file into its hard link should do nothing, "
                "but cinfo was changed")
+
+def testDirIntoOwnChild(t, env):
+    """RENAME dir into its own subdirectory should return NFS4ERR_INVAL
+
+    FLAGS: rename all
+    CODE: RNM21
+    """
+    name = env.testname(t)
+    sess = env.c1.new_client_session(name)
+    maketree(sess, [name, ['dir', ['child', ['grandchild']]]])
+    basedir = env.c1.homedir + [name]
+    res = rename_obj(sess, basedir + ['dir'], basedir + ['dir', 'child', 'new'])
+    check(res, NFS4ERR_INVAL, "RENAME dir into its own child")
+    res = rename_obj(sess, basedir + ['dir'],
+                     basedir + ['dir', 'child', 'grandchild', 'new'])
+    check(res, NFS4ERR_INVAL, "RENAME dir into its own grandchild")
+
+def testCaseOnlyRename(t, env):
+    """On a case-insensitive fs, LOOKUP should ignore case, and a RENAME
+    that only changes case should respell the entry READDIR returns
+
+    FLAGS: rename all
+    CODE: RNM22
+    """
+    name = env.testname(t)
+    sess = env.c1.new_client_session(name)
+    attrs = do_getattrdict(sess, env.c1.homedir, [FATTR4_CASE_INSENSITIVE])
+    if not attrs.get(FATTR4_CASE_INSENSITIVE):
+        t.fail_support("fs is case-sensitive")
+    basedir = env.c1.homedir + [name]
+    maketree(sess, [name, 'MixedCase', 'other'])
+    fh = lookup_obj(sess, basedir + ['MixedCase'])
+    for spelling in ['mixedcase', 'MIXEDCASE']:
+        if lookup_obj(sess, basedir + [spelling]) != fh:
+            fail("LOOKUP of %r did not find 'MixedCase'" % spelling)
+    res = create_file(sess, name, basedir + ['MIXEDCASE'])
+    check(res, NFS4ERR_EXIST, "Creating 'MIXEDCASE' when 'MixedCase' exists")
+    names = sorted([e.name for e in do_readdir(sess, basedir)])
+    if names != ['MixedCase', 'other']:
+        fail("READDIR returned %r, expected ['MixedCase', 'other']" % names)
+    res = rename_obj(sess, basedir + ['MixedCase'], basedir + ['mixedCASE'])
+    check(res, msg="RENAME of 'MixedCase' to 'mixedCASE'")
+    names = sorted([e.name for e in do_readdir(sess, basedir)])
+    if names != ['mixedCASE', 'other']:
+        fail("READDIR after RENAME returned %r, expected "
+             "['mixedCASE', 'other']" % names)
+    if lookup_obj(sess, basedir + ['MIXEDCASE']) != fh:
+        fail("LOOKUP of 'MIXEDCASE' did not find the renamed file")
+
+def testLookupAfterOtherRename(t, env):
+    """LOOKUP by path should find a dir that another client put in place
+    of one it had looked up
+
+    FLAGS: rename all
+    CODE: RNM23
+    """
+    name = env.testname(t)
+    sess1 = env.c1.new_client_session(name)
+    sess2 = env.c1.new_client_session(name + "_2")
+    basedir = env.c1.homedir + [name]
+    maketree(sess1, [name, ['dir']])
+    fh_dir = lookup_obj(sess1, basedir + ['dir'])
+    res = rename_obj(sess2, basedir + ['dir'], basedir + ['moved'])
+    check(res, msg="RENAME of dir by second client")
+    maketree(sess2, [['dir', 'b']], basedir, name)
+    fh_b = lookup_obj(sess2, basedir + ['dir', 'b'])
+    if lookup_obj(sess1, basedir + ['dir', 'b']) != fh_b:
+        fail("LOOKUP of dir/b did not find the file in the new dir")
+    if lookup_obj(sess1, basedir + ['moved']) != fh_dir:
+        fail("LOOKUP of moved did not find the moved dir")
@@ -1,10 +1,34 @@
 from st_create_session import create_session
 from xdrdef.nfs4_const import *
-from environment import check, fail, create_file
+from environment import check, fail, create_file, do_getattrdict
 import nfs_ops
 op = nfs_ops.NFS4ops()
 import nfs4lib
 
+def _write(sess, fh, stateid, offset, data):
+    """WRITE data at offset, 2k at a time"""
+    for i in range(0, len(data), 2048):
+        res = sess.compound([op.putfh(fh),
+                             op.write(stateid, offset + i, FILE_SYNC4,
+                                      data[i:i + 2048])])
+        check(res, msg="WRITE at %i" % (offset + i))
+
+def _read(sess, fh, stateid, offset, count):
+    """READ count bytes at offset, 2k at a time"""
+    data = ""
+    while len(data) < count:
+        res = sess.compound([op.putfh(fh),
+                             op.read(stateid, offset + len(data),
+                                     min(count - len(data), 2048))])
+        check(res, msg="READ at %i" % (offset + len(data)))
+        data += res.resarray[-1].data
+        if res.resarray[-1].eof:
+            break
+    return data
+
+def _seek(sess, fh, stateid, offset, what):
+    return sess.compound([op.putfh(fh), op.seek(stateid, offset, what)])
+
 def testAllocateSupported(t, env):
     """Do a simple ALLOCATE
        send PUTROOTFH+ALLOCATE, check for legal result
@@ -48,3 +72,88 @@ def testAllocateStateidOne(t, env):
 
     res = sess.compound([op.putfh(fh), op.allocate(env.stateid1, 0, 1)])
     check(res)
+
+def testSeekDataHole(t, env):
+    """SEEK for DATA and HOLE around two written ranges
+
+    FLAGS: all sparse
+    CODE: SEEK1
+    VERS: 2-
+    """
+    sess = env.c1.new_client_session(env.testname(t))
+    res = create_file(sess, env.testname(t))
+    check(res)
+    fh = res.resarray[-1].object
+    stateid = res.resarray[-2].stateid
+    gap = 1 << 20
+    _write(sess, fh, stateid, 0, "x" * 4096)
+    _write(sess, fh, stateid, gap, "y" * 4096)
+    size = gap + 4096
+
+    res = _seek(sess, fh, stateid, 0, NFS4_CONTENT_DATA)
+    check(res, msg="SEEK for DATA at 0")
+    if res.resarray[-1].sr_offset != 0 or res.resarray[-1].sr_eof:
+        fail("SEEK for DATA at 0 returned %i, eof=%r" %
+             (res.resarray[-1].sr_offset, res.resarray[-1].sr_eof))
+
+    res = _seek(sess, fh, stateid, 0, NFS4_CONTENT_HOLE)
+    check(res, msg="SEEK for HOLE at 0")
+    hole = res.resarray[-1].sr_offset
+    if not 4096 <= hole <= size:
+        fail("SEEK for HOLE at 0 returned %i, expected in [4096, %i]" %
+             (hole, size))
+    if hole < gap:
+        # There is a real hole, and data after it
+        res = _seek(sess, fh, stateid, hole, NFS4_CONTENT_DATA)
+        check(res, msg="SEEK for DATA at %i" % hole)
+        found = res.resarray[-1].sr_offset
+        if not hole < found <= gap or res.resarray[-1].sr_eof:
+            fail("SEEK for DATA at %i returned %i, expected in (%i, %i]" %
+                 (hole, found, hole, gap))
+
+    res = _seek(sess, fh, stateid, size - 1, NFS4_CONTENT_DATA)
+    check(res, msg="SEEK for DATA at %i" % (size - 1))
+    if res.resarray[-1].sr_offset != size - 1:
+        fail("SEEK for DATA at %i returned %i" %
+             (size - 1, res.resarray[-1].sr_offset))
+
+def testSeekAtEof(t, env):
+    """SEEK starting at EOF should return NFS4ERR_NXIO
+
+    FLAGS: all sparse
+    CODE: SEEK2
+    VERS: 2-
+    """
+    sess = env.c1.new_client_session(env.testname(t))
+    res = create_file(sess, env.testname(t))
+    check(res)
+    fh = res.resarray[-1].object
+    stateid = res.resarray[-2].stateid
+    _write(sess, fh, stateid, 0, "x" * 100)
+    for what, name in ((NFS4_CONTENT_DATA, "DATA"),
+                       (NFS4_CONTENT_HOLE, "HOLE")):
+        res = _seek(sess, fh, stateid, 100, what)
+        check(res, NFS4ERR_NXIO, "SEEK for %s at EOF" % name)
+
+def testDeallocateReadsZeroes(t, env):
+    """READ after DEALLOCATE should return zeroes, and the same size
+
+    FLAGS: all sparse
+    CODE: DEALLOC1
+    VERS: 2-
+    """
+    sess = env.c1.new_client_session(env.testname(t))
+    res = create_file(sess, env.testname(t))
+    check(res)
+    fh = res.resarray[-1].object
+    stateid = res.resarray[-2].stateid
+    _write(sess, fh, stateid, 0, "x" * 8192)
+    res = sess.compound([op.putfh(fh), op.deallocate(stateid, 1024, 4096)])
+    check(res, msg="DEALLOCATE of [1024, 5120)")
+    data = _read(sess, fh, stateid, 0, 8192)
+    expect = "x" * 1024 + "\0" * 4096 + "x" * 3072
+    if data != expect:
+        fail("READ after DEALLOCATE did not return zeroes over the range")
+    size = do_getattrdict(sess, fh, [FATTR4_SIZE])[FATTR4_SIZE]
+    if size != 8192:
+        fail("DEALLOCATE changed size from 8192 to %i" % size)
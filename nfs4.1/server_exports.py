@@ -1,5 +1,7 @@
-from fs import StubFS_Mem, StubFS_Disk, BlockLayoutFS, FileLayoutFS
+from fs import StubFS_Mem, StubFS_Disk, StubFS_Mmap, PassthroughFS, \
+     BlockLayoutFS, FileLayoutFS
 from dataserver import DSDevice
+import os
 
 def mount_stuff(server, opts):
     """Mount some filesystems to the server"""
@@ -10,6 +12,17 @@ def mount_stuff(server, opts):
     server.mount(A, path="/a")
     server.mount(B, path="/b")
     server.mount(C, path="/foo/bar/c")
+    CI = StubFS_Mem(8, case_insensitive=True)
+    server.mount(CI, path="/ci")
+    if opts.mmap:
+        D = StubFS_Mmap(4, opts.mmap, opts.reset)
+        server.mount(D, path="/mmap")
+    if opts.passthrough:
+        if not os.path.isdir(opts.passthrough):
+            os.makedirs(opts.passthrough)
+        P = PassthroughFS(7, opts.passthrough,
+                          read_only=not opts.passthrough_rw)
+        server.mount(P, path="/export")
     if opts.use_block:
         dev = _create_simple_block_dev()
         E = BlockLayoutFS(5, backing_device=dev)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# ssvbench.py - time the SSV (SP4_SSV state protection) GSS mechanism
+#
+# Each iteration protects a packed SEQUENCE+PUTFH+WRITE COMPOUND the way
+# an SSV credential does: the client side wraps (privacy) or MICs
+# (integrity) the argument body and the server side undoes it.
+
+import use_local # HACK so don't have to rebuild constantly
+import sys
+import time
+from optparse import OptionParser
+
+import nfs4lib
+from nfs4lib import hash_oids, hash_algs, encrypt_oids, encrypt_algs, \
+     FancyNFS4Packer
+from xdrdef.nfs4_const import *
+from xdrdef.nfs4_type import *
+
+op4 = nfs4lib.op4
+
+class _NullCipher(object):
+    """Stands in for a CBC cipher object, but does no real work"""
+    def __init__(self, key, **kwargs):
+        pass
+
+    def encrypt(self, data):
+        return data[::-1]
+
+    def decrypt(self, data):
+        return data[::-1]
+
+class _NullFactory(object):
+    """Stands in for nfs4lib._e_wrap, so the SSV code alone can be timed"""
+    block_size = 16
+    key_size = 16
+
+    def new(self, key, **kwargs):
+        return _NullCipher(key, **kwargs)
+
+def make_compound(size):
+    """Return the packed args of a COMPOUND writing size bytes"""
+    ops = [op4.sequence("\0" * 16, 1, 0, 0, False),
+           op4.putfh("\0" * 32),
+           op4.write(nfs4lib.state00, 0, UNSTABLE4, "x" * size)]
+    p = FancyNFS4Packer()
+    p.pack_COMPOUND4args(COMPOUND4args("ssvbench", 1, ops))
+    return p.get_buffer()
+
+def make_contexts(hash_name, cipher_name):
+    hash_funct = hash_algs[hash_oids[hash_name]]
+    if cipher_name == "null":
+        factory = _NullFactory()
+    else:
+        factory = encrypt_algs[encrypt_oids[cipher_name]]
+    client = nfs4lib.SSVContext(hash_funct, factory, 16, client=True)
+    server = nfs4lib.SSVContext(hash_funct, factory, 16, client=False)
+    ssv = nfs4lib.random_string(client.ssv_len)
+    client.set_ssv(ssv)
+    server.set_ssv(ssv)
+    return client, server
+
+def time_privacy(client, server, data, count):
+    start = time.time()
+    for i in xrange(count):
+        if server.unwrap(client.wrap(data))[0] != data:
+            raise RuntimeError("unwrap did not return the wrapped data")
+    return time.time() - start
+
+def time_integrity(client, server, data, count):
+    start = time.time()
+    for i in xrange(count):
+        if server.verifyMIC(data, client.getMIC(data)) != 0:
+            raise RuntimeError("verifyMIC rejected the MIC")
+    return time.time() - start
+
+def main():
+    p = OptionParser("%prog [options]",
+                     description="Time SSV protection of COMPOUND args. "
+                     "Each iteration does the client and the server half "
+                     "of one call.")
+    p.add_option("--hash", default="sha256", choices=sorted(hash_oids),
+                 help="Hash algorithm [%default]")
+    p.add_option("--cipher", default="aes256-CBC",
+                 choices=sorted(encrypt_oids) + ["null"],
+                 help="Encryption algorithm, or 'null' to leave out the "
+                 "cipher cost [%default]")
+    p.add_option("--size", type="int", default=1024,
+                 help="Bytes of WRITE data in each COMPOUND [%default]")
+    p.add_option("--count", type="int", default=20000,
+                 help="Number of COMPOUNDs to protect [%default]")
+    opts, args = p.parse_args()
+    if args:
+        p.error("unexpected arguments %r" % args)
+    if opts.cipher != "null" and not hasattr(nfs4lib.AES, "block_size"):
+        # nfs4lib falls back to a placeholder class without Crypto.Cipher
+        p.error("could not import Crypto.Cipher, try '--cipher null'")
+    client, server = make_contexts(opts.hash, opts.cipher)
+    data = make_compound(opts.size)
+    print "%s, %s, %i byte COMPOUND args, %i calls" % \
+          (opts.hash, opts.cipher, len(data), opts.count)
+    for name, test in (("wrap+unwrap", time_privacy),
+                       ("getMIC+verifyMIC", time_integrity)):
+        t = test(client, server, data, opts.count)
+        print "%-17s %8.0f/s" % (name, opts.count / t)
+
+if __name__ == "__main__":
+    main()
@@ -78,7 +78,7 @@ def scan_options(p):
     g = OptionGroup(p, "Security flavor options",
                     "These options choose or affect the security flavor used.")
     g.add_option("--security", default='sys',
-                 help="Choose security flavor such as krb5i [%default]")
+                 help="Choose security flavor such as krb5i or mocki [%default]")
     g.add_option("--uid", default=UID, type='int',
                  help="uid for auth_sys [%i]" % UID)
     g.add_option("--gid", default=GID, type='int',
@@ -275,25 +275,31 @@ def main():
 
     # Check that --security option is valid
     # FIXME STUB
-    tempd = {'none' : (rpc.AUTH_NONE, 0),
-             'sys'  : (rpc.AUTH_SYS, 0),
-             'krb5' : (rpc.RPCSEC_GSS, 1),
-             'krb5i': (rpc.RPCSEC_GSS, 2),
-             'krb5p': (rpc.RPCSEC_GSS, 3),
+    # The mock flavors use a local GSS mechanism needing no kerberos setup
+    tempd = {'none' : (rpc.AUTH_NONE, 0, None),
+             'sys'  : (rpc.AUTH_SYS, 0, None),
+             'krb5' : (rpc.RPCSEC_GSS, 1, 'krb5'),
+             'krb5i': (rpc.RPCSEC_GSS, 2, 'krb5'),
+             'krb5p': (rpc.RPCSEC_GSS, 3, 'krb5'),
+             'mock' : (rpc.RPCSEC_GSS, 1, 'mock'),
+             'mocki': (rpc.RPCSEC_GSS, 2, 'mock'),
+             'mockp': (rpc.RPCSEC_GSS, 3, 'mock'),
              }
     if opt.security not in tempd:
         p.error("Unknown security: %s\nValid flavors are %s" %
                 (opt.security, str(tempd.keys())))
 
     # flavor has changed from class to int
-    opt.flavor, opt.service = tempd[opt.security]
+    opt.flavor, opt.service, opt.mechanism = tempd[opt.security]
+    if opt.mechanism == 'mock':
+        rpc.security.enable_mock()
 
     if opt.flavor not in rpc.security.supported:
-        if opt.flavor == rpc.RPCSEC_GSS:
-            p.error("RPCSEC_GSS not supported,"
-                    " could not find compile gssapi module")
-        else:
-            p.error("Unsupported security flavor")
+        p.error("Unsupported security flavor")
+    if opt.mechanism is not None and \
+            opt.mechanism not in rpc.security.mechanisms:
+        p.error("RPCSEC_GSS mechanism %s not supported,"
+                " could not find compile gssapi module" % opt.mechanism)
 
     # Make sure args are valid
     opt.args = []
@@ -0,0 +1,266 @@
+"""A local, keytab-free GSS mechanism for testing RPCSEC_GSS.
+
+This mimics the class interface of the SWIG-wrapped gssapi module
+(Name, Credential, Context, Error and the GSS_S_* constants), so that
+AuthGss can run krb5/krb5i/krb5p style traffic between a client and server
+that share nothing but a secret string.  It provides NO real security:
+the "keytab" is the module level secret, which by default is a
+well known constant.  So security.py only offers it after
+enable_mock(), which is called when PYNFS_MOCKGSS_SECRET is set.
+
+Context establishment takes one round trip:
+    client init()   -> initial token (framed as in RFC 2743 sect 3.1)
+    server accept() -> reply token proving knowledge of the session key
+    client init()   -> verifies reply, context is open
+
+Integrity uses HMAC-SHA1, confidentiality XORs the data with a
+SHA-512 counter mode keystream.
+"""
+import os
+import struct
+import hmac
+import hashlib
+import getpass
+import binascii
+import threading
+from gss_const import *
+
+# Made up OID, under the arc reserved for examples
+mock_oid = "\x2b\x06\x01\x04\x01\xb6\x45\x01\x01"
+OID = mock_oid
+
+NT_HOSTBASED_SERVICE = "hostbased_service"
+NT_USER_NAME = "user_name"
+
+INITIATE = 1
+ACCEPT = 2
+BOTH = 0
+
+secret = os.environ.get("PYNFS_MOCKGSS_SECRET", "pynfs mock gss secret")
+
+NONCE_LEN = 16
+MIC_LEN = 20 # Size of sha1 digest
+
+class Error(Exception):
+    def __init__(self, major, minor=0):
+        self.major = major
+        self.minor = minor
+        self.name = gss_major_codes.get(major, "UNKNOWN_MAJOR_CODE_%i" % major)
+
+    def __repr__(self):
+        return "mockgss.Error(major=%s, minor=%i)" % (self.name, self.minor)
+
+    def __str__(self):
+        return self.name
+
+class Name(object):
+    def __init__(self, name, oid=NT_USER_NAME):
+        self.name = name
+        self.oid = oid
+
+    ptr = property(lambda s: s) # Mimic gssapi.Name.ptr
+
+    def __repr__(self):
+        return "mockgss.Name(%r)" % self.name
+
+class Credential(object):
+    def __init__(self, usage=INITIATE, name=None, mechs=None, lifetime=0):
+        if name is None:
+            name = Name(getpass.getuser())
+        self.name = name
+        self.usage = usage
+        self.mechs = (OID,)
+        self.lifetime = lifetime
+
+def _opaque(data):
+    return struct.pack(">L", len(data)) + data
+
+def _unopaque(data, pos):
+    """Return (data, pos) of opaque starting at pos"""
+    if pos + 4 > len(data):
+        raise Error(GSS_S_DEFECTIVE_TOKEN)
+    size = struct.unpack(">L", data[pos:pos + 4])[0]
+    pos += 4
+    if pos + size > len(data):
+        raise Error(GSS_S_DEFECTIVE_TOKEN)
+    return data[pos:pos + size], pos + size
+
+def _der_length(size):
+    if size < 0x80:
+        return chr(size)
+    out = ""
+    while size:
+        out = chr(size & 0xff) + out
+        size >>= 8
+    return chr(0x80 | len(out)) + out
+
+def _frame(inner):
+    """Wrap inner token with mech-independent framing of RFC 2743 sect 3.1"""
+    body = "\x06" + chr(len(OID)) + OID + inner
+    return "\x60" + _der_length(len(body)) + body
+
+def _unframe(token):
+    """Return inner token if token is a mockgss initial token, else None"""
+    if token[:1] != "\x60" or len(token) < 2:
+        return None
+    pos = 2
+    first = ord(token[1])
+    if first & 0x80:
+        pos += first & 0x7f
+    header = "\x06" + chr(len(OID)) + OID
+    if token[pos:pos + len(header)] != header:
+        return None
+    return token[pos + len(header):]
+
+def is_initial_token(token):
+    """Returns True if token starts context establishment using this mech"""
+    return _unframe(token) is not None
+
+def _xor(data, pad):
+    if not data:
+        return data
+    size = 2 * len(data)
+    out = int(binascii.hexlify(data), 16) ^ \
+          int(binascii.hexlify(pad[:len(data)]), 16)
+    return binascii.unhexlify("%0*x" % (size, out))
+
+class Context(object):
+    _count_lock = threading.Lock()
+    _count = 0
+
+    def __init__(self):
+        Context._count_lock.acquire()
+        Context._count += 1
+        self.handle = "mockgss_%i_%s" % (Context._count,
+                                         binascii.hexlify(os.urandom(4)))
+        Context._count_lock.release()
+        self._lock = threading.Lock()
+        self.mech = OID
+        self.flags = 0
+        self.lifetime = 0
+        self.open = False
+        self.local = False # True for initiator
+        self.source_name = None
+        self.target_name = None
+        self._nonce = None
+        self._seal_counter = 0
+
+    def _set_keys(self, cnonce, snonce):
+        base = hmac.new(secret, cnonce + snonce, hashlib.sha256).digest()
+        def derive(label):
+            return hmac.new(base, label, hashlib.sha256).digest()
+        self._proof = derive("proof")
+        sign = {True: derive("sign initiator"), False: derive("sign acceptor")}
+        seal = {True: derive("seal initiator"), False: derive("seal acceptor")}
+        # Precompute keyed state, so each message only pays for copy()
+        self._send_mac = hmac.new(sign[self.local], digestmod=hashlib.sha1)
+        self._recv_mac = hmac.new(sign[not self.local], digestmod=hashlib.sha1)
+        self._send_seal = seal[self.local]
+        self._recv_seal = seal[not self.local]
+
+    def init(self, target, token=None, cred=None, mech=None,
+             flags=0, lifetime=0, bindings=None):
+        """Called by client to establish context, returns token to send"""
+        if cred is None:
+            cred = Credential(INITIATE)
+        if self._nonce is None:
+            # First call
+            if token:
+                raise Error(GSS_S_DEFECTIVE_TOKEN)
+            self.local = True
+            self.source_name = cred.name
+            self.target_name = target
+            self._nonce = os.urandom(NONCE_LEN)
+            return _frame(_opaque(cred.name.name) + _opaque(target.name) +
+                          self._nonce)
+        if self.open:
+            raise Error(GSS_S_FAILURE)
+        if token is None or len(token) != NONCE_LEN + MIC_LEN:
+            raise Error(GSS_S_DEFECTIVE_TOKEN)
+        snonce, proof = token[:NONCE_LEN], token[NONCE_LEN:]
+        self._set_keys(self._nonce, snonce)
+        if hmac.new(self._proof, self._nonce, hashlib.sha1).digest() != proof:
+            raise Error(GSS_S_DEFECTIVE_CREDENTIAL)
+        self.open = True
+        return ""
+
+    def accept(self, token, cred=None, bindings=None):
+        """Called by server on client's initial token, returns reply token"""
+        if self.open:
+            raise Error(GSS_S_FAILURE)
+        inner = _unframe(token)
+        if inner is None:
+            raise Error(GSS_S_BAD_MECH)
+        source, pos = _unopaque(inner, 0)
+        target, pos = _unopaque(inner, pos)
+        cnonce = inner[pos:]
+        if len(cnonce) != NONCE_LEN:
+            raise Error(GSS_S_DEFECTIVE_TOKEN)
+        self.source_name = Name(source, NT_USER_NAME)
+        self.target_name = Name(target, NT_HOSTBASED_SERVICE)
+        snonce = os.urandom(NONCE_LEN)
+        self._set_keys(cnonce, snonce)
+        self.open = True
+        return snonce + hmac.new(self._proof, cnonce, hashlib.sha1).digest()
+
+    def _check_open(self, qop=0):
+        if not self.open:
+            raise Error(GSS_S_NO_CONTEXT)
+        if qop != 0:
+            raise Error(GSS_S_BAD_QOP)
+
+    def getMIC(self, msg, qop=0):
+        self._check_open(qop)
+        mac = self._send_mac.copy()
+        mac.update(msg)
+        return mac.digest()
+
+    def verifyMIC(self, msg, token):
+        """Returns qop"""
+        self._check_open()
+        mac = self._recv_mac.copy()
+        mac.update(msg)
+        if mac.digest() != token:
+            raise Error(GSS_S_BAD_SIG)
+        return 0
+
+    def _keystream(self, key, nonce, size):
+        base = hashlib.sha512(key + nonce)
+        out = []
+        for i in xrange((size + 63) // 64):
+            h = base.copy()
+            h.update(struct.pack(">L", i))
+            out.append(h.digest())
+        return "".join(out)
+
+    def wrap(self, msg, qop=0, conf=1):
+        """Returns token: conf(1) + nonce(8) + body + mic(20)"""
+        self._check_open(qop)
+        self._lock.acquire()
+        self._seal_counter += 1
+        nonce = struct.pack(">Q", self._seal_counter)
+        self._lock.release()
+        header = chr(bool(conf)) + nonce
+        if conf:
+            msg = _xor(msg, self._keystream(self._send_seal, nonce, len(msg)))
+        mac = self._send_mac.copy()
+        mac.update(header)
+        mac.update(msg)
+        return header + msg + mac.digest()
+
+    def unwrap(self, token):
+        """Returns (msg, qop)"""
+        self._check_open()
+        if len(token) < 9 + MIC_LEN:
+            raise Error(GSS_S_DEFECTIVE_TOKEN)
+        header = token[:9]
+        body = token[9:-MIC_LEN]
+        mac = self._recv_mac.copy()
+        mac.update(header)
+        mac.update(body)
+        if mac.digest() != token[-MIC_LEN:]:
+            raise Error(GSS_S_BAD_SIG)
+        if header[0] != "\0":
+            body = _xor(body, self._keystream(self._recv_seal, header[1:],
+                                              len(body)))
+        return body, 0
@@ -2,6 +2,10 @@ from __future__ import with_statement
 
 import socket, select
 import struct
+import errno
+import os
+import signal
+import sys
 import threading
 import logging
 from collections import deque as Deque
@@ -86,6 +90,7 @@ class FancyRPCUnpacker(rpc_pack.RPCUnpacker):
             out = opaque_auth(py_data.flavor, body)
             # HACK - lets other code know this has been expanded
             out.opaque = False
+            out.raw = py_data.body
             return out
         except:
             # We had a bad XDR within GSS cred.  This shouldn't propagate up
@@ -455,6 +460,17 @@ class ConnectionHandler(object):
         # A list of the sockets set to listen for connections
         self.listeners = set()
 
+        self._init_alarm()
+
+        # Set up some constants that effect general behavior
+        self.rsize = 4096 # Read data in chunks of this size
+        self.wsize = 4098 # Read data in chunks of this size
+        self.rpcversions = (2,) # Supported RPC versions
+
+        # Dictionary {flavor: handler} used for server-side authentication
+        self.sec_flavors = security.instances()
+
+    def _init_alarm(self):
         # Create internal server for alarm system to connect to
         self.s = self.expose((LOOPBACK, 0), socket.AF_INET, False)
         
@@ -466,14 +482,6 @@ class ConnectionHandler(object):
         self._alarm_poll = self._event_connect_incoming(self.s.fileno(),
                                                         internal=True)
 
-        # Set up some constants that effect general behavior
-        self.rsize = 4096 # Read data in chunks of this size
-        self.wsize = 4098 # Read data in chunks of this size
-        self.rpcversions = (2,) # Supported RPC versions
-
-        # Dictionary {flavor: handler} used for server-side authentication
-        self.sec_flavors = security.instances()
-
     def _buzz_write_ready(self, pipe):
         """Pipe has data ready to be sent out"""
         pipe.pop_record(self.wsize)
@@ -505,7 +513,14 @@ class ConnectionHandler(object):
             log_p.debug("Calling select")
             log_p.log(5, "Sleeping for: %s, %s, %s" %
                  (self.readlist, self.writelist, self.errlist))
-            r,w,e = select.select(self.readlist, self.writelist, self.errlist)
+            try:
+                r,w,e = select.select(self.readlist, self.writelist,
+                                      self.errlist)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    # A signal handler ran, just go back to sleep
+                    continue
+                raise
             log_p.log(5, "Woke with: %s, %s, %s" % (r, w, e))
             for fd in e:
                 log_p.warn(1, "polling error from %i" % fd)
@@ -843,10 +858,19 @@ class ConnectionHandler(object):
                     raise
 
 
-    def expose(self, address, af, safe=True):
-        """Start listening for incoming connections on the given address"""
+    def expose(self, address, af, safe=True, reuseport=False):
+        """Start listening for incoming connections on the given address
+
+        If reuseport is set, other sockets (typically in other processes)
+        may bind the same address, and the kernel spreads connections
+        among them.
+        """
         s = socket.socket(af, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            # Python 2 does not export the constant, this is linux's value
+            s.setsockopt(socket.SOL_SOCKET,
+                         getattr(socket, "SO_REUSEPORT", 15), 1)
         s.bind(address)
         s.setblocking(0)
         s.listen(5)
@@ -884,17 +908,85 @@ class ConnectionHandler(object):
 #################################################
 
 class Server(ConnectionHandler):
-    def __init__(self, prog, versions, port, interface=''):
+    def __init__(self, prog, versions, port, interface='', reuseport=False):
         ConnectionHandler.__init__(self)
         self.prog = prog
         self.versions = versions # List of supported versions of prog
         self.default_cred = security.CredInfo()
+        self.address = (interface, port)
+        self.reuseport = reuseport
+        self._listen()
+
+    def _listen(self):
         try:
             # This listens on both AF_INET and AF_INET6
-            self.expose((interface, port), socket.AF_INET6, False)
+            return self.expose(self.address, socket.AF_INET6, False,
+                               self.reuseport)
         except:
             # ipv6 not supported, fall back to ipv4
-            self.expose((interface, port), socket.AF_INET, False)
+            return self.expose(self.address, socket.AF_INET, False,
+                               self.reuseport)
+
+    def _forget(self, fd):
+        """Close a socket set up before start, and stop polling it"""
+        self.listeners.discard(fd)
+        self.readlist.discard(fd)
+        self.errlist.discard(fd)
+        self.sockets.pop(fd).close()
+
+    def fork_workers(self, count):
+        """Split the server into count processes sharing the listening port.
+
+        Requires the server was created with reuseport=True, and must be
+        called before start().  Each worker gets its own listening socket,
+        and the kernel spreads incoming connections among them.  Workers
+        share nothing after the fork, so any state created later is
+        private to the worker whose connection created it.
+
+        Returns the worker's index in each child.  The parent never
+        returns: it waits for the workers, then exits.
+        """
+        if not self.reuseport:
+            raise RuntimeError("fork_workers requires reuseport")
+        old = list(self.listeners)
+        children = []
+        for index in range(count):
+            pid = os.fork()
+            if pid == 0:
+                # Worker - open our own listener and alarm, since the
+                # inherited ones are shared with the other processes
+                alarm = (self._alarm, self._alarm_poll.fileno())
+                self._listen()
+                self._init_alarm()
+                for fd in old:
+                    self._forget(fd)
+                self._forget(alarm[1])
+                alarm[0].close()
+                self.worker_started(index, count)
+                return index
+            children.append(pid)
+        for fd in old:
+            self._forget(fd)
+        # Take the workers down with us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while children:
+                pid, status = os.wait()
+                if pid in children:
+                    children.remove(pid)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        sys.exit(0)
+
+    def worker_started(self, index, count):
+        """Called in each process created by fork_workers"""
+        pass
 
     def _check_program(self, prog):
         return (self.prog == prog)
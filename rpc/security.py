@@ -13,14 +13,27 @@ try:
 except ImportError:
     print("Could not find gssapi module, proceeding without")
     gssapi = None
+import mockgss
 import threading
 import logging
+import os
 
 log_gss = logging.getLogger("rpc.sec.gss")
 log_gss.setLevel(logging.INFO)
 
 WINDOWSIZE = 8 # STUB, curently just a completely random number
 
+# GSS mechanisms AuthGss can use, keyed by name.  Each is a module
+# exporting the interface of the gssapi extension.  The mock one is
+# only added by enable_mock().
+mechanisms = {}
+if gssapi is not None:
+    mechanisms["krb5"] = gssapi
+default_mechanism = "krb5" if gssapi is not None else None
+
+# Catches failures from any mechanism
+GSSError = tuple(set([mockgss.Error] + [m.Error for m in mechanisms.values()]))
+
 class SecError(Exception):
     pass
 
@@ -52,6 +65,7 @@ class CredInfo(object):
         self.service = service
         self.qop = qop
         self.gss_proc = gss_proc
+        self.packed = None # (key, opaque_auth) cached by make_cred
         # self.triple = triple # (OID, QOP, service), only valid with GSS
 
 class AuthNone(object):
@@ -131,11 +145,24 @@ class AuthSys(AuthNone):
         p.pack_authsys_parms(py_cred)
         return p.get_buffer()
 
-    @staticmethod
-    def unpack_cred(cred):
-        p = RPCUnpacker(cred)
-        py_cred = p.unpack_authsys_parms()
-        p.done()
+    # Server cache of decoded creds, since a client tends to reuse the
+    # same few.  NOTE the cached authsys_parms are shared, do not modify.
+    _unpacked = {} # {raw cred: authsys_parms}
+    _unpacked_max = 1024
+
+    @classmethod
+    def unpack_cred(cls, cred):
+        py_cred = cls._unpacked.get(cred)
+        if py_cred is None:
+            p = RPCUnpacker(cred)
+            py_cred = p.unpack_authsys_parms()
+            p.done()
+            if len(cls._unpacked) >= cls._unpacked_max:
+                try:
+                    cls._unpacked.popitem()
+                except KeyError:
+                    pass
+            cls._unpacked[cred] = py_cred
         return py_cred
 
     def init_cred(self, uid=None, gid=None, name=None, stamp=42, gids=None):
@@ -151,16 +178,20 @@ class AuthSys(AuthNone):
         return CredInfo(self, authsys_parms(stamp, name, uid, gid, gids))
 
     def make_cred(self, credinfo):
-        """Create credential"""
+        """Create credential
+
+        The packed cred is cached in credinfo, and only rebuilt if
+        the authsys_parms it came from have changed.
+        """
         if credinfo is None:
             # Create a default cred
-            who = self.init_cred()
-        else:
-            # XXX Check credinfo.flavor?
-            who = credinfo.context
-        out = opaque_auth(AUTH_SYS, who)
-        out.opaque = False # HACK
-        return out
+            credinfo = self.init_cred()
+        # XXX Check credinfo.flavor?
+        who = credinfo.context
+        key = (who.stamp, who.machinename, who.uid, who.gid, tuple(who.gids))
+        if credinfo.packed is None or credinfo.packed[0] != key:
+            credinfo.packed = (key, opaque_auth(AUTH_SYS, self.pack_cred(who)))
+        return credinfo.packed[1]
 
     def check_auth(self, msg, data):
         """Server check of credentials, which can raise a RPCFlowControl"""
@@ -218,7 +249,11 @@ class AuthGss(AuthNone):
     flavor = RPCSEC_GSS
     name = "RPCSEC_GSS"
 
-    def __init__(self):
+    def __init__(self, mech=None):
+        if mech is None:
+            mech = default_mechanism
+        # None if unavailable, leaving only contexts set up elsewhere (SSV)
+        self.mech = mechanisms.get(mech)
         self.contexts = {} # {str handle: GSSContext}
 
     def _add_context(self, context, handle=None):
@@ -242,7 +277,10 @@ class AuthGss(AuthNone):
 
     def init_cred(self, call, target="nfs@jupiter", source=None, oid=None):
         # STUB - need intelligent way to set defaults
-        good_major = [gssapi.GSS_S_COMPLETE, gssapi.GSS_S_CONTINUE_NEEDED]
+        gssapi = self.mech
+        if gssapi is None:
+            raise SecError("No GSS mechanism available")
+        good_major = [GSS_S_COMPLETE, GSS_S_CONTINUE_NEEDED]
         p = Packer()
         up = GSSUnpacker('')
         # Set target (of form nfs@SERVER)
@@ -379,7 +417,7 @@ class AuthGss(AuthNone):
             else:
                 # Can't get here, but doesn't hurt
                 log_gss.error("Unknown service %i for RPCSEC_GSS" % cred.service)
-        except gssapi.Error, e:
+        except GSSError, e:
             log_gss.warn("unsecure_data: gssapi call returned %s" % e.name)
             raise rpclib.RPCUnsuccessfulReply(GARBAGE_ARGS)
         return data
@@ -413,7 +451,7 @@ class AuthGss(AuthNone):
             else:
                 # Can't get here, but doesn't hurt
                 log_gss.error("Unknown service %i for RPCSEC_GSS" % cred.service)
-        except gssapi.Error, e:
+        except GSSError, e:
             # XXX What now?
             log_gss.warn("secure_data: gssapi call returned %s" % e.name)
             raise
@@ -449,7 +487,7 @@ class AuthGss(AuthNone):
             data = self.partially_packed_header(xid, body)
             try:
                 qop = self._get_context(body.cred.body.handle).verifyMIC(data, body.verf.body)
-            except gssapi.Error, e:
+            except GSSError, e:
                 log_gss.warn("Verifier checksum failed verification with %s" %
                              e.name)
                 return False
@@ -511,18 +549,24 @@ class AuthGss(AuthNone):
         # STUB - think through this more carefully
         self.handle_gss_init(cred, data, first=False)
 
+    def _accepting_mech(self, token):
+        """Server choice of mechanism, based on client's initial token"""
+        if "mock" in mechanisms and mockgss.is_initial_token(token):
+            return mockgss
+        return self.mech
+
     def handle_gss_init(self, cred, data, first):
         p = GSSUnpacker(data)
         token = p.unpack_opaque()
         p.done()
         log_gss.debug("***ACCEPTSECCONTEXT***")
         if first:
-            context = gssapi.Context()
+            context = self._accepting_mech(token).Context()
         else:
             context = self._get_context(cred.body.handle)
         try:
             token = context.accept(token)
-        except gssapi.Error, e:
+        except GSSError, e:
             log_gss.debug("RPCSEC_GSS_INIT failed (%s, %i)!" %
                           (e.name, e.minor))
             res = rpc_gss_init_res('', e.major, e.minor, 0, '')
@@ -538,9 +582,9 @@ class AuthGss(AuthNone):
             else:
                 handle = cred.body.handle
             if context.open:
-                major = gssapi.GSS_S_COMPLETE
+                major = GSS_S_COMPLETE
             else:
-                major = gssapi.GSS_S_CONTINUE_NEEDED
+                major = GSS_S_CONTINUE_NEEDED
             res = rpc_gss_init_res(handle, major, 0, # XXX can't see minor
                                    WINDOWSIZE, token)
         # Prepare response
@@ -611,6 +655,21 @@ supported = {AUTH_NONE:  AuthNone,
 if gssapi is not None:
     supported[RPCSEC_GSS] = AuthGss
 
+def enable_mock():
+    """Let AuthGss use the mock mechanism, and servers accept it.
+
+    It gives no real security, so is only for testing.  Must be called
+    before any server is created.
+    """
+    global default_mechanism
+    mechanisms["mock"] = mockgss
+    if default_mechanism is None:
+        default_mechanism = "mock"
+    supported[RPCSEC_GSS] = AuthGss
+
+if "PYNFS_MOCKGSS_SECRET" in os.environ:
+    enable_mock()
+
 def klass(flavor):
     """Importers should only refer to the classes via flavor.
 